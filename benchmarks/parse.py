@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+######################################################
+#
+# Parse benchmark of the answer and link extraction.
+#
+# The question and search pages from benchmarks/fixtures are parsed with both
+# extraction engines (HOWDOI_PARSER=pyquery and lxml) and the time per page is
+# written as JSON. The outputs of the engines are compared first, the benchmark
+# fails when they differ. --scale repeats the answers of question pages to get
+# closer to the size of real pages.
+#
+# Usage:
+#   python benchmarks/parse.py [--repeat N] [--scale N] [--output FILE]
+#
+######################################################
+
+import argparse
+import io
+import json
+import os
+import sys
+import timeit
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'fixtures')
+sys.path.insert(0, ROOT_DIR)
+
+from howdoi import howdoi  # noqa: E402
+
+PARSERS = ('pyquery', 'lxml')
+# Command line options of the measured question page extractions
+OPTIONS = {
+    'default': '',
+    'all': '-a',
+    'json': '-j --answers-per-question 3',
+}
+QUESTION_LINK = 'https://stackoverflow.com/questions/1401482/how-to-format-a-date'
+
+
+def load_fixtures(scale):
+    """ dict name -> page, question pages with answers repeated scale times """
+    fixtures = {}
+    for name in sorted(os.listdir(FIXTURES_DIR)):
+        if not name.endswith('.html'):
+            continue
+        with io.open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as in_file:
+            page = in_file.read()
+        start, end = page.find('<div id="answers">'), page.rfind('<div id="sidebar">')
+        if scale > 1 and start != -1 and end != -1:
+            answers = page[start + len('<div id="answers">'):end]
+            page = page[:end] + answers * (scale - 1) + page[end:]
+        fixtures[name[:-len('.html')]] = page
+    return fixtures
+
+
+def make_args(options):
+    args = vars(howdoi.get_parser().parse_args(['format', 'date', 'bash'] + options.split()))
+    args['query'] = ' '.join(args['query'])
+    return args
+
+
+def extract(parser, name, page, args):
+    os.environ['HOWDOI_PARSER'] = parser
+    if name.startswith('search_'):
+        return [howdoi._extract_links_from_page(page, engine) for engine in ('google', 'bing')]
+    args = dict(args)
+    if args['json']:
+        return howdoi._get_answer_records(args, [QUESTION_LINK], {QUESTION_LINK: page})
+    return howdoi._get_answers(args, [QUESTION_LINK], {QUESTION_LINK: page})
+
+
+def run(repeat, scale):
+    results = {}
+    mismatches = []
+    for name, page in sorted(load_fixtures(scale).items()):
+        cases = {'links': ''} if name.startswith('search_') else OPTIONS
+        for case, options in sorted(cases.items()):
+            key = '{0}/{1}'.format(name, case)
+            args = make_args(options)
+            outputs = [extract(parser, name, page, args) for parser in PARSERS]
+            if outputs[0] != outputs[1]:
+                mismatches.append(key)
+            results[key] = {'bytes': len(page.encode('utf-8'))}
+            for parser in PARSERS:
+                timer = timeit.Timer(lambda: extract(parser, name, page, args))
+                number = max(1, repeat // 10)
+                best = min(timer.repeat(repeat=10, number=number)) / number
+                results[key][parser + '_ms'] = round(best * 1000, 3)
+            results[key]['speedup'] = round(results[key]['pyquery_ms'] / max(results[key]['lxml_ms'], 1e-6), 2)
+    os.environ.pop('HOWDOI_PARSER', None)
+    return results, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare speed of the pyquery and lxml extraction engines')
+    parser.add_argument('--repeat', help='extractions per page and engine (default: 200)', default=200, type=int)
+    parser.add_argument('--scale', help='repeat answers of question pages N times (default: 20)', default=20,
+                        type=int)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args()
+
+    results, mismatches = run(args.repeat, args.scale)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            out_file.write(output + '\n')
+    for mismatch in mismatches:
+        print('MISMATCH {0}: engines extracted different output'.format(mismatch))
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+######################################################
+#
+# Benchmark of the whole query pipeline without network.
+#
+# The search page and the question pages from benchmarks/fixtures are served by
+# a local HTTP server (with --latency seconds of delay per response, to stand in
+# for the network) and every stage of a query is timed on its own:
+#
+#   links          _get_links, search request and link extraction
+#   questions      _get_questions, filtering of question links
+#   fetch_pages    _fetch_question_pages, question pages of -n answers
+#   answer         _get_answer, parsing of the downloaded pages
+#   get_text       get_text of one answer
+#   format_output  _format_output, highlighting of one code block (-c)
+#   howdoi         end-to-end howdoi()
+#
+# Scenarios:
+#   cold      no caches, new HTTP session for every run (like a new CLI process)
+#   warm      page, link and answer caches filled; howdoi_pages is end-to-end with
+#             the answer cache emptied, so only the pages come from the cache
+#   parallel  --queries different queries answered by 1 and by --workers threads
+#             sharing one session (like --batch and howdoi --serve); with
+#             --processes also by --workers threads parsing and highlighting in
+#             a pool of that many processes (HOWDOI_PARSE_PROCESSES)
+#
+# The results are written as JSON. Pass an earlier result with --baseline to fail
+# when a stage became slower. HOWDOI_PARSER and HOWDOI_STREAM_PARSE are taken
+# from the environment, so their variants can be compared.
+#
+# Usage:
+#   python benchmarks/pipeline.py [--repeat N] [--latency S] [--workers N] [--queries N] [--processes N]
+#                                 [--output FILE] [--baseline FILE] [--tolerance 0.25]
+#
+######################################################
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(ROOT_DIR, 'benchmarks', 'fixtures')
+sys.path.insert(0, ROOT_DIR)
+
+from howdoi import howdoi  # noqa: E402
+from howdoi.testing import StubServer  # noqa: E402
+
+QUERY = 'format date bash'
+NUM_ANSWERS = 3
+# Question pages served for the links of the search page, in order
+QUESTION_FIXTURES = ('question', 'question_xhtml', 'question_no_code')
+
+
+def load_fixture(name):
+    with io.open(os.path.join(FIXTURES_DIR, name + '.html'), encoding='utf-8') as in_file:
+        return in_file.read()
+
+
+def start_fixture_server(latency):
+    """ StubServer (howdoi/testing.py) with the search page and question pages of the fixtures, links point to it """
+    server = StubServer({})
+    search_page = load_fixture('search_google').replace('https://stackoverflow.com/', server.url + '/')
+    server.routes['/search'] = (200, search_page, latency)
+    links = [link for link in howdoi._extract_links_from_page(search_page, 'google') if howdoi._is_question(link)]
+    for link, name in zip(links, QUESTION_FIXTURES):
+        server.routes[link[len(server.url):]] = (200, load_fixture(name), latency)
+    return server
+
+
+def make_args(query=QUERY, options=''):
+    return vars(howdoi.get_parser().parse_args(query.split() + options.split()))
+
+
+def timed(func, setup=None, repeat=10):
+    """
+        Run func repeat times, setup (not timed) before every run.
+    :return: dict with best_ms and median_ms
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    times.sort()
+    return {'best_ms': round(times[0] * 1000, 3), 'median_ms': round(times[len(times) // 2] * 1000, 3)}
+
+
+def new_session():
+    if howdoi.howdoi_session is not None:
+        howdoi.howdoi_session.close()
+    howdoi.howdoi_session = None
+
+
+def clear_highlight_cache():
+    from howdoi import highlight
+    highlight._highlighted.clear()
+
+
+def first_answer_text_element(page):
+    """ Element of the first answer text of the page for the configured parser (HOWDOI_PARSER) """
+    if howdoi._get_html_parser() == 'pyquery':
+        from pyquery import PyQuery as pq
+        return pq(page)('.answer').eq(0).find('.post-text').eq(0)
+    from howdoi import extract
+    return extract.POST_TEXT(extract.get_answers(extract.parse(page))[0])[0]
+
+
+def get_text(element):
+    if howdoi._get_html_parser() == 'pyquery':
+        return howdoi.get_text(element)
+    from howdoi import extract
+    return extract.get_text(element)
+
+
+def run_stages(repeat, warm):
+    """ Time of every stage, caches are filled first with warm """
+    args = make_args(options='-n {0}'.format(NUM_ANSWERS))
+    query = ' '.join(args['query'])
+    links = howdoi._get_links(query)
+    question_links = howdoi._get_questions(links)[:NUM_ANSWERS]
+    pages = howdoi._fetch_question_pages(question_links)
+    code = howdoi._get_answer(dict(args, query=query, pos=1), question_links, pages)
+    color_args = dict(args, query=query, color=True, tags=['bash', 'date'])
+    setup = None if warm else new_session
+    state = {}
+
+    def prepare_get_text():
+        state['element'] = first_answer_text_element(pages[question_links[0]])
+
+    def empty_answer_cache():
+        howdoi.answer_cache.clear()
+
+    results = {
+        'links': timed(lambda: howdoi._get_links(query), setup, repeat),
+        'questions': timed(lambda: howdoi._get_questions(links), None, repeat),
+        'fetch_pages': timed(lambda: howdoi._fetch_question_pages(question_links), setup, repeat),
+        'answer': timed(lambda: howdoi._get_answer(dict(args, query=query, pos=1), question_links, pages),
+                        None, repeat),
+        'get_text': timed(lambda: get_text(state['element']), prepare_get_text, repeat),
+        'format_output': timed(lambda: howdoi._format_output(code, color_args),
+                               None if warm else clear_highlight_cache, repeat),
+        'howdoi': timed(lambda: howdoi.howdoi(dict(args)), setup, repeat),
+    }
+    if warm:
+        results['howdoi_pages'] = timed(lambda: howdoi.howdoi(dict(args)), empty_answer_cache, repeat)
+    return results
+
+
+def run_parallel(queries, workers, processes=0):
+    """ Throughput of queries answered by a pool of threads, without caches """
+    from multiprocessing.pool import ThreadPool
+    from howdoi import workers as parse_workers
+    results = {}
+    runs = [(pool_size, 0) for pool_size in sorted(set([1, workers]))]
+    if processes:
+        runs.append((workers, processes))
+    for pool_size, pool_processes in runs:
+        latencies = []
+
+        def answer(index):
+            start = time.time()
+            howdoi.howdoi(make_args('{0} {1}'.format(QUERY, index)))
+            latencies.append(time.time() - start)
+
+        name = 'workers_{0}'.format(pool_size)
+        if pool_processes:
+            parse_workers.start(pool_processes)
+            name += '_processes_{0}'.format(pool_processes)
+        pool = ThreadPool(pool_size)
+        start = time.time()
+        try:
+            pool.map(answer, range(queries))
+        finally:
+            pool.close()
+            pool.join()
+            parse_workers.stop()
+        wall_time = time.time() - start
+        latencies.sort()
+        results[name] = {
+            'wall_ms': round(wall_time * 1000, 1),
+            'queries_per_s': round(queries / wall_time, 2),
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 1),
+            'p95_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 1),
+        }
+    return results
+
+
+def disable_caches():
+    for cache in [howdoi.page_cache, howdoi.answer_cache] + list(howdoi.link_caches.values()):
+        if cache is not None:
+            cache.close()
+    howdoi.page_cache = howdoi.answer_cache = None
+    howdoi.link_caches = {}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.STDOUT, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(repeat, latency, workers, queries, processes=0):
+    temp_dir = tempfile.mkdtemp()
+    server = start_fixture_server(latency)
+    temp_search_url = howdoi.SEARCH_URLS['google']
+    temp_cache_files = (howdoi.CACHE_DIR, howdoi.PAGE_CACHE_FILE, howdoi.ANSWER_CACHE_FILE, howdoi.LINK_CACHE_FILE)
+    howdoi.SEARCH_URLS['google'] = server.url + '/search?q=site:{0}%20{1}'
+    howdoi.CACHE_DIR = temp_dir
+    howdoi.PAGE_CACHE_FILE = os.path.join(temp_dir, 'pages.sqlite')
+    howdoi.ANSWER_CACHE_FILE = os.path.join(temp_dir, 'answers.sqlite')
+    howdoi.LINK_CACHE_FILE = os.path.join(temp_dir, 'links.sqlite')
+    os.environ['HOWDOI_SEARCH_ENGINE'] = 'google'
+    os.environ['HOWDOI_ANSWER_BACKEND'] = 'scrape'
+    os.environ['HOWDOI_MAX_WORKERS'] = str(workers)
+    # links which are not questions are reported on stderr for every query
+    temp_stderr = sys.stderr
+    sys.stderr = io.StringIO() if sys.version >= '3' else io.BytesIO()
+    results = {'meta': {'commit': get_commit(), 'python': platform.python_version(),
+                        'parser': howdoi._get_html_parser(), 'stream_parse': howdoi._get_stream_parse(),
+                        'repeat': repeat, 'latency_s': latency, 'workers': workers, 'queries': queries,
+                        'processes': processes}}
+    try:
+        disable_caches()
+        results['cold'] = run_stages(repeat, warm=False)
+        howdoi._enable_cache()
+        results['warm'] = run_stages(repeat, warm=True)
+        disable_caches()
+        new_session()
+        results['parallel'] = run_parallel(queries, workers, processes)
+        results['meta']['requests'] = len(server.requested)
+    finally:
+        sys.stderr = temp_stderr
+        disable_caches()
+        new_session()
+        howdoi.SEARCH_URLS['google'] = temp_search_url
+        howdoi.CACHE_DIR, howdoi.PAGE_CACHE_FILE, howdoi.ANSWER_CACHE_FILE, howdoi.LINK_CACHE_FILE = temp_cache_files
+        server.stop()
+        shutil.rmtree(temp_dir)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Return list of regressions against the baseline results """
+    regressions = []
+    for scenario in ('cold', 'warm'):
+        for stage, result in sorted(results[scenario].items()):
+            if stage not in baseline.get(scenario, {}):
+                continue
+            allowed = baseline[scenario][stage]['median_ms'] * (1 + tolerance)
+            if result['median_ms'] > allowed:
+                regressions.append('{0}/{1}: {2}ms > {3:.3f}ms'.format(scenario, stage, result['median_ms'], allowed))
+    for name, result in sorted(results['parallel'].items()):
+        if name not in baseline.get('parallel', {}):
+            continue
+        required = baseline['parallel'][name]['queries_per_s'] / (1 + tolerance)
+        if result['queries_per_s'] < required:
+            regressions.append('parallel/{0}: {1} queries/s < {2:.2f} queries/s'.format(
+                name, result['queries_per_s'], required))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure every stage of a howdoi query against local fixtures')
+    parser.add_argument('--repeat', help='runs per stage (default: 20)', default=20, type=int)
+    parser.add_argument('--latency', help='delay of every response in seconds (default: 0.02)', default=0.02,
+                        type=float)
+    parser.add_argument('--workers', help='threads of the parallel scenario (default: 4)', default=4, type=int)
+    parser.add_argument('--queries', help='queries of the parallel scenario (default: 40)', default=40, type=int)
+    parser.add_argument('--processes', help='also run the parallel scenario with a parsing pool of N processes '
+                        '(default: 0 - off)', default=0, type=int)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', help='allowed slow down against the baseline (default: 0.25)',
+                        default=0.25, type=float)
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.latency, args.workers, args.queries, args.processes)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            out_file.write(output + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as in_file:
+            regressions = compare(results, json.load(in_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
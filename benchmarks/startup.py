@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+######################################################
+#
+# Cold start benchmark of the howdoi command line.
+#
+# Every entry path is started in a fresh interpreter with `python -X importtime`
+# (Python 3.7+). The import time and the heavy modules loaded on the way are
+# written as JSON. Pass an earlier result with --baseline to fail when an entry
+# path became slower or started to load a heavy module.
+#
+# Usage:
+#   python benchmarks/startup.py [--repeat N] [--output FILE] [--baseline FILE] [--tolerance 0.25]
+#
+######################################################
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Command line arguments of each measured entry path
+ENTRY_PATHS = {
+    'version': ['-v'],
+    'clear_cache': ['-C'],
+    'help': ['--help'],
+    'link': ['-l', 'format', 'date', 'bash'],
+}
+# Modules which should be loaded only when the entry path needs them
+HEAVY_MODULES = ('requests', 'requests_cache', 'pyquery', 'lxml', 'pygments', 'urllib.request', 'http.client')
+
+
+def parse_importtime(stderr):
+    """
+        Parse `-X importtime` output.
+    :return: (total import time in microseconds, set of imported module names)
+    """
+    total = 0
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # top level imports are not indented, their cumulative time includes nested imports
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+        modules.add(name.strip())
+    return total, modules
+
+
+def measure(arguments, env):
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-m', 'howdoi.howdoi'] + arguments,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env, cwd=ROOT_DIR,
+                               universal_newlines=True)
+    _, stderr = process.communicate()
+    wall_time = time.time() - start
+    import_time, modules = parse_importtime(stderr)
+    heavy = sorted(name for name in HEAVY_MODULES
+                   if any(module == name or module.startswith(name + '.') for module in modules))
+    return {'import_us': import_time, 'wall_ms': round(wall_time * 1000, 1), 'heavy_modules': heavy}
+
+
+def run(repeat):
+    temp_dir = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env.update({'XDG_CACHE_HOME': temp_dir,
+                'HOWDOI_SOCKET': os.path.join(temp_dir, 'no-server.sock'),
+                'PYTHONPATH': ROOT_DIR})
+    results = {}
+    try:
+        for name, arguments in sorted(ENTRY_PATHS.items()):
+            runs = [measure(arguments, env) for _ in range(repeat)]
+            # the fastest run has the least noise from the rest of the system
+            results[name] = min(runs, key=lambda result: result['import_us'])
+    finally:
+        shutil.rmtree(temp_dir)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Return list of regressions against the baseline results """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        allowed = baseline[name]['import_us'] * (1 + tolerance)
+        if result['import_us'] > allowed:
+            regressions.append('{0}: import time {1}us > {2:.0f}us'.format(name, result['import_us'], allowed))
+        new_modules = set(result['heavy_modules']) - set(baseline[name]['heavy_modules'])
+        if new_modules:
+            regressions.append('{0}: imports {1}'.format(name, ', '.join(sorted(new_modules))))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure howdoi cold start import cost per entry path')
+    parser.add_argument('--repeat', help='runs per entry path (default: 5)', default=5, type=int)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', help='allowed slow down against the baseline (default: 0.25)',
+                        default=0.25, type=float)
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            out_file.write(output + '\n')
+
+    if args.baseline:
+        with open(args.baseline) as in_file:
+            regressions = compare(results, json.load(in_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+######################################################
+#
+# asyncio API of howdoi (Python 3.5+).
+#
+#   from howdoi import aio
+#   answer = await aio.howdoi(args)
+#
+# aio.howdoi(args) answers like howdoi.howdoi(args) without blocking the event
+# loop, so hundreds of queries can be in flight on one loop. The search and
+# question pages are downloaded by one httpx.AsyncClient shared by all queries
+# of the loop (one connection pool sized by HOWDOI_POOL_SIZE and
+# HOWDOI_MAX_CONNECTIONS, the timeouts and retries of transport.fetch). Cache
+# lookups and the CPU bound parsing and highlighting run in the default
+# executor of the loop (parsing and highlighting in the process pool of
+# workers.py, when it is started). Without httpx (pip install httpx) the
+# pages are downloaded with transport.fetch in the executor.
+#
+# The search engines race/merge, the offline index and the Stack Exchange API
+# backend are run in the executor too. HOWDOI_HEDGE and HOWDOI_PREFETCH are not
+# used by this API. With HOWDOI_STREAM_PARSE pages are read completely, but
+# looked up and stored under the page cache keys of the sync API. URLs, cache
+# keys and link extraction come from howdoi.py, only the I/O is async here.
+#
+# This module uses async/await syntax and is not imported by the rest of
+# howdoi, which runs on Python 2 as well. setup.py leaves it out of the
+# package installed on Python < 3.5.
+#
+######################################################
+
+import asyncio
+import functools
+import os
+import time
+import weakref
+
+from . import howdoi as core
+from . import transport
+
+# loop -> client shared by the queries of the loop, a client is bound to the loop it was created in
+_clients = weakref.WeakKeyDictionary()
+
+
+def _create_client():
+    """ httpx.AsyncClient with the settings of transport.create_session or None when httpx is not installed """
+    try:
+        import httpx
+    except ImportError:
+        return None
+    http2 = bool(os.getenv('HOWDOI_HTTP2')) and transport.has_http2()
+    return httpx.AsyncClient(**transport.get_httpx_options(http2))
+
+
+def get_client():
+    """ Client shared by the queries of the running loop """
+    loop = asyncio.get_event_loop()
+    if loop not in _clients:
+        _clients[loop] = _create_client()
+    return _clients[loop]
+
+
+async def close():
+    """ Close the connections of the client of the running loop """
+    client = _clients.pop(asyncio.get_event_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def _run(func, *args):
+    """ Run blocking function in the default executor of the loop """
+    return await asyncio.get_event_loop().run_in_executor(None, functools.partial(func, *args))
+
+
+def _get_async_trace(timings):
+    trace = transport.get_httpx_trace(timings)
+
+    async def async_trace(event, info):
+        trace(event, info)
+    return async_trace
+
+
+async def _get(client, url):
+    """ One GET with timings recorded as by transport sessions """
+    import httpx
+    timings = {}
+    start = time.time()
+    try:
+        request = client.build_request('GET', url, extensions={'trace': _get_async_trace(timings)})
+        response = await client.send(request, stream=True)
+        headers_time = time.time()
+        await response.aread()
+    except httpx.TransportError as e:
+        raise transport.map_httpx_error(e)
+    response.timings = timings
+    transport._record(url, timings, start, headers_time, time.time())
+    return response
+
+
+async def fetch(url):
+    """
+        GET the url with the timeouts and retries of transport.fetch.
+    :return: response (httpx or requests), the last one when all attempts ended with 429/5xx
+    :raise: requests ConnectionError, Timeout or SSLError when no attempt got a response
+    """
+    client = get_client()
+    if client is None:
+        return await _run(transport.fetch, core.get_session(), url)
+    from requests.exceptions import ConnectionError, Timeout
+    retries = transport.get_retries()
+    attempt = 0
+    while True:
+        try:
+            response = await _get(client, url)
+        except (ConnectionError, Timeout) as e:
+            delay = transport.get_retry_delay(attempt, retries, error=e)
+            if delay is None:
+                raise
+        else:
+            delay = transport.get_retry_delay(attempt, retries, response=response)
+            if delay is None:
+                return response
+            await response.aclose()
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def _get_result(url, use_cache=True, stop=None):
+    """
+        Page from the page cache or downloaded, see howdoi._get_result.
+        The page is read completely and cached under the keys of the sync API (howdoi._get_page_cache_keys),
+        a page cached there until the stop condition is used as well.
+    """
+    use_cache = use_cache and core.page_cache is not None
+    keys = core._get_page_cache_keys(url, stop)
+    if use_cache:
+        page = await _run(core._get_cached_page, keys)
+        if page is not None:
+            return page
+    response = await fetch(url)
+    page = response.text
+    if use_cache:
+        await _run(core._set_cached_page, keys, response.status_code, page)
+    return page
+
+
+async def _get_links(query):
+    """ Search result links, see howdoi._get_links """
+    search_engine = core._get_search_engine()
+    if search_engine not in core.SEARCH_URLS:
+        # local index, race and merge
+        return await _run(core._get_links, query)
+    links = await _run(core._get_cached_links, query, search_engine)
+    if links is not None:
+        return links
+    search_url, stop = core._get_search_request(query, search_engine)
+    page = await _get_result(search_url, use_cache=False, stop=stop)
+    links = await _run(core.offload, core._extract_links_from_page, page, search_engine)
+    await _run(core._set_cached_links, query, search_engine, links)
+    return links
+
+
+async def _fetch_question_pages(links, answers=1):
+    """ Question pages downloaded concurrently, see howdoi._fetch_question_pages """
+    unique_links = core._get_unique_links(links)
+    if core._get_search_engine() == 'local' or core._get_answer_backend() == 'api':
+        return await _run(core._fetch_question_pages, unique_links, answers)
+    page_requests = [core._get_question_page_request(link, answers) for link in unique_links]
+    pages = await asyncio.gather(*[_get_result(url, stop=stop) for url, stop in page_requests])
+    return dict(zip(unique_links, pages))
+
+
+def _render_answers(args, question_links, pages, positions):
+    """ Answers of the questions at positions as one text, see howdoi._iter_instructions """
+    if args.get('json'):
+        return core.offload(core._get_json_answers, args, question_links, pages, positions)
+    return core.ANSWER_SPLITER.join(answer for position in positions
+                                    for answer in core._get_position_answers(args, question_links, pages, position))
+
+
+async def _get_instructions(args):
+    """ All answers as one text, '' if there are none """
+    links = await _get_links(args['query'])
+    if not links:
+        return ''
+    question_links = core._get_questions(links)
+    if not question_links:
+        return ''
+    core._report_filtered_links(links, question_links)
+    positions = core._get_positions(args)
+    pages = {}
+    if not args.get('link'):
+        pages = await _fetch_question_pages([core.get_link_at_pos(question_links, position) for position in positions],
+                                            max(1, args.get('answers_per_question') or 1))
+    return await _run(_render_answers, args, question_links, pages, positions)
+
+
+async def howdoi(args):
+    """
+        Answer as howdoi.howdoi(args), without blocking the event loop.
+    :param args: parsed arguments (dict) from howdoi.get_parser()
+    :return: answer text
+    """
+    from requests.exceptions import ConnectionError, SSLError, Timeout
+    args['query'] = ' '.join(args['query']).replace('?', '')
+    cache_key = core._get_answer_cache_key(args)
+    answer = await _run(core._get_cached_answer, cache_key)
+    if answer is not None:
+        return answer
+    try:
+        answer = await _get_instructions(args)
+    except (ConnectionError, SSLError, Timeout):
+        return core.NETWORK_ERROR_MSG
+    if not answer:
+        return core._get_no_answers_message(args)
+    await _run(core._set_cached_answer, cache_key, answer)
+    return answer
@@ -0,0 +1,365 @@
+######################################################
+#
+# Key -> value store on top of SQLite used by howdoi caches.
+#
+# Entries older than ttl seconds are treated as missing. When the summed size
+# of the values grows over max_size bytes the least recently used entries
+# are removed. Hits and misses are counted for the statistics (howdoi --stats).
+#
+# A compressed cache (the page cache) stores the values zlib compressed in a
+# separate table of blobs addressed by the SHA-1 of the value, so the same
+# page stored under several keys (e.g. the complete page and the page read
+# until the needed answers) is stored once. Its size limit applies to the
+# compressed bytes. Entries written by an uncompressed cache are still read.
+#
+# An indexed cache (the answer cache) keeps the words of every entry in an
+# inverted word -> key table, find_similar() looks up the entries sharing words
+# with a query without reading all keys.
+#
+# The database files are read through memory mapping (PRAGMA mmap_size).
+#
+######################################################
+
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+
+# bytes of the database file read through memory mapping instead of read() calls
+MMAP_SIZE = 64 * 1024 * 1024
+COMPRESS_LEVEL = 6
+
+
+class Cache(object):
+
+    def __init__(self, path, table='cache', ttl=None, max_size=None, compress=False, indexed=False):
+        """
+        :param path: SQLite database file
+        :param table: table name, one file can hold many caches
+        :param ttl: time to live of entry in seconds (None - never expires)
+        :param max_size: max summed size of values in bytes (None - no limit), compressed size with compress
+        :param compress: store text values compressed and deduplicated
+        :param indexed: index the words given to set() for find_similar()
+        """
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self.max_size = max_size
+        self.compress = compress
+        self.blob_table = table + '_blobs'
+        self.indexed = indexed
+        self.word_table = table + '_words'
+        self._connection = None
+        # one connection is shared by all threads (howdoi server, batch mode)
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute('PRAGMA mmap_size = {0:d}'.format(MMAP_SIZE))
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS {0} (key TEXT PRIMARY KEY, value BLOB, size INTEGER, '
+                'created REAL, accessed REAL)'.format(self.table))
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS {0}_accessed ON {0} (accessed)'.format(self.table))
+            self._connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+            if self.compress:
+                self._create_blob_table()
+            if self.indexed:
+                self._create_word_table()
+            self._connection.commit()
+        return self._connection
+
+    def _create_blob_table(self):
+        """ Entries of a compressed cache refer to the blob (column blob) instead of holding the value """
+        columns = [row[1] for row in self._connection.execute('PRAGMA table_info({0})'.format(self.table))]
+        if 'blob' not in columns:
+            self._connection.execute('ALTER TABLE {0} ADD COLUMN blob TEXT'.format(self.table))
+        self._connection.execute('CREATE INDEX IF NOT EXISTS {0}_blob ON {0} (blob)'.format(self.table))
+        # size - bytes of the value, stored - bytes of the compressed data
+        self._connection.execute('CREATE TABLE IF NOT EXISTS {0} (hash TEXT PRIMARY KEY, data BLOB, size INTEGER, '
+                                 'stored INTEGER)'.format(self.blob_table))
+
+    def _create_word_table(self):
+        self._connection.execute('CREATE TABLE IF NOT EXISTS {0} (word TEXT, key TEXT)'.format(self.word_table))
+        self._connection.execute('CREATE INDEX IF NOT EXISTS {0}_word ON {0} (word)'.format(self.word_table))
+        self._connection.execute('CREATE INDEX IF NOT EXISTS {0}_key ON {0} (key)'.format(self.word_table))
+        # words of entries removed by eviction, expiry, delete and clear go with them
+        self._connection.execute('CREATE TRIGGER IF NOT EXISTS {0}_delete AFTER DELETE ON {1} BEGIN '
+                                 'DELETE FROM {0} WHERE key = OLD.key; END'.format(self.word_table, self.table))
+
+    def _select_value(self):
+        if not self.compress:
+            return 'value'
+        return 'COALESCE(value, (SELECT data FROM {0} WHERE hash = blob)), blob'.format(self.blob_table)
+
+    @staticmethod
+    def _decompress(data):
+        return zlib.decompress(bytes(data)).decode('utf-8')
+
+    def _is_expired(self, created, now):
+        return self.ttl is not None and now - created > self.ttl
+
+    def get(self, key, count=True):
+        """
+            Return value stored under the key or None when it is missing or expired.
+        :param count: count the lookup as hit or miss in the statistics
+        """
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT created, {0} FROM {1} WHERE key = ?'.format(self._select_value(), self.table),
+                (key,)).fetchone()
+            if row is not None and self._is_expired(row[0], now):
+                self._delete(key)
+                row = None
+            if count:
+                self._count('hits' if row is not None else 'misses')
+            if row is not None:
+                self.connection.execute('UPDATE {0} SET accessed = ? WHERE key = ?'.format(self.table), (now, key))
+            self.connection.commit()
+        if row is None:
+            return None
+        if self.compress and row[2] is not None:
+            return self._decompress(row[1])
+        return row[1]
+
+    def contains(self, key):
+        """ Entry is stored and not expired; unlike get() the value is not read and the lookup is not counted """
+        with self._lock:
+            if self.ttl is None:
+                row = self.connection.execute('SELECT 1 FROM {0} WHERE key = ?'.format(self.table), (key,)).fetchone()
+            else:
+                row = self.connection.execute('SELECT 1 FROM {0} WHERE key = ? AND created >= ?'.format(self.table),
+                                              (key, time.time() - self.ttl)).fetchone()
+        return row is not None
+
+    def count(self, counter):
+        """ Increase counter reported in stats(), e.g. hits """
+        with self._lock:
+            self._count(counter)
+            self.connection.commit()
+
+    def _count(self, counter):
+        name = '{0}_{1}'.format(self.table, counter)
+        self.connection.execute('INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)', (name,))
+        self.connection.execute('UPDATE counters SET value = value + 1 WHERE name = ?', (name,))
+
+    def set(self, key, value, words=None):
+        """
+        :param words: words of the entry, found by find_similar() in an indexed cache
+        """
+        now = time.time()
+        with self._lock:
+            if self.compress:
+                self._insert_compressed(key, value, now)
+            else:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO {0} (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)'.format(
+                        self.table), (key, value, len(value), now, now))
+            if self.indexed:
+                # the delete trigger does not fire for the row replaced by INSERT OR REPLACE
+                self.connection.execute('DELETE FROM {0} WHERE key = ?'.format(self.word_table), (key,))
+                self.connection.executemany('INSERT INTO {0} (word, key) VALUES (?, ?)'.format(self.word_table),
+                                            [(word, key) for word in set(words or ())])
+            self._evict()
+            self.connection.commit()
+
+    def _insert_compressed(self, key, value, now):
+        encoded = value.encode('utf-8')
+        blob = hashlib.sha1(encoded).hexdigest()
+        row = self.connection.execute('SELECT stored FROM {0} WHERE hash = ?'.format(self.blob_table),
+                                      (blob,)).fetchone()
+        if row is None:
+            data = zlib.compress(encoded, COMPRESS_LEVEL)
+            self.connection.execute('INSERT INTO {0} (hash, data, size, stored) VALUES (?, ?, ?, ?)'.format(
+                self.blob_table), (blob, sqlite3.Binary(data), len(encoded), len(data)))
+            stored = len(data)
+        else:
+            stored = row[0]
+        row = self.connection.execute('SELECT blob FROM {0} WHERE key = ?'.format(self.table), (key,)).fetchone()
+        self.connection.execute(
+            'INSERT OR REPLACE INTO {0} (key, value, size, created, accessed, blob) VALUES (?, NULL, ?, ?, ?, ?)'
+            .format(self.table), (key, stored, now, now, blob))
+        if row is not None and row[0] is not None and row[0] != blob:
+            self._remove_blob(row[0])
+
+    def find_similar(self, words):
+        """
+            Entries of an indexed cache sharing some of the words, found through the word index.
+        :return: list of (key, number of shared words, number of words of the entry), entries which are not expired
+        """
+        words = list(set(words))
+        if not words:
+            return []
+        query = ('SELECT found.key, found.shared, (SELECT COUNT(*) FROM {0} WHERE key = found.key) FROM '
+                 '(SELECT key, COUNT(*) AS shared FROM {0} WHERE word IN ({1}) GROUP BY key) AS found '
+                 'JOIN {2} ON {2}.key = found.key').format(self.word_table, ', '.join('?' * len(words)), self.table)
+        parameters = list(words)
+        if self.ttl is not None:
+            query += ' WHERE {0}.created >= ?'.format(self.table)
+            parameters.append(time.time() - self.ttl)
+        with self._lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+    def keys(self):
+        """ Keys of entries which are not expired """
+        with self._lock:
+            if self.ttl is None:
+                rows = self.connection.execute('SELECT key FROM {0}'.format(self.table)).fetchall()
+            else:
+                rows = self.connection.execute('SELECT key FROM {0} WHERE created >= ?'.format(self.table),
+                                               (time.time() - self.ttl,)).fetchall()
+        return [row[0] for row in rows]
+
+    def delete(self, key):
+        with self._lock:
+            self._delete(key)
+            self.connection.commit()
+
+    def _delete(self, key):
+        self._delete_where('key = ?', (key,))
+
+    def _delete_where(self, condition, parameters):
+        """ Delete the entries, in a compressed cache also their blobs which no other entry refers to """
+        blobs = []
+        if self.compress:
+            blobs = [row[0] for row in self.connection.execute(
+                'SELECT DISTINCT blob FROM {0} WHERE blob IS NOT NULL AND {1}'.format(self.table, condition),
+                parameters)]
+        self.connection.execute('DELETE FROM {0} WHERE {1}'.format(self.table, condition), parameters)
+        for blob in blobs:
+            self._remove_blob(blob)
+
+    def _remove_blob(self, blob):
+        """
+            Remove the blob when no entry refers to it.
+        :return: compressed bytes freed
+        """
+        row = self.connection.execute('SELECT stored FROM {0} WHERE hash = ? AND NOT EXISTS '
+                                      '(SELECT 1 FROM {1} WHERE blob = ?)'.format(self.blob_table, self.table),
+                                      (blob, blob)).fetchone()
+        if row is None:
+            return 0
+        self.connection.execute('DELETE FROM {0} WHERE hash = ?'.format(self.blob_table), (blob,))
+        return row[0]
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute('DELETE FROM {0}'.format(self.table))
+            if self.compress:
+                self.connection.execute('DELETE FROM {0}'.format(self.blob_table))
+            self.connection.commit()
+
+    def _evict(self):
+        """ Remove expired entries and the least recently used ones above max_size """
+        if self.ttl is not None:
+            self._delete_where('created < ?', (time.time() - self.ttl,))
+        if self.max_size is not None:
+            self._evict_over_size()
+
+    def _get_total_size(self):
+        """ Bytes counted against max_size, a blob shared by many entries is counted once """
+        if not self.compress:
+            return self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM {0}'.format(self.table)).fetchone()[0]
+        stored = self.connection.execute('SELECT COALESCE(SUM(stored), 0) FROM {0}'.format(
+            self.blob_table)).fetchone()[0]
+        # entries written before the cache was compressed
+        legacy_size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM {0} WHERE blob IS NULL'.format(
+            self.table)).fetchone()[0]
+        return stored + legacy_size
+
+    def _evict_over_size(self):
+        total_size = self._get_total_size()
+        if total_size <= self.max_size:
+            return
+        rows = self.connection.execute('SELECT key, size, {0} FROM {1} ORDER BY accessed'.format(
+            'blob' if self.compress else 'NULL', self.table)).fetchall()
+        for key, size, blob in rows:
+            if total_size <= self.max_size:
+                break
+            self.connection.execute('DELETE FROM {0} WHERE key = ?'.format(self.table), (key,))
+            # the blob of a deduplicated value is freed with the last entry referring to it
+            total_size -= size if blob is None else self._remove_blob(blob)
+
+    def evict(self):
+        """ Remove expired and over the size limit entries """
+        with self._lock:
+            self._evict()
+            self.connection.commit()
+
+    def vacuum(self):
+        """ Give the free space of the whole file (all its caches) back to the filesystem """
+        with self._lock:
+            self.connection.execute('VACUUM')
+
+    def compact(self):
+        """ Remove expired and over the size limit entries, then give the free space back to the filesystem """
+        self.evict()
+        self.vacuum()
+
+    def _connect_read_only(self):
+        """ Connection which does not create the file nor the tables """
+        if sys.version_info[0] >= 3:
+            from urllib.request import pathname2url
+            return sqlite3.connect('file:{0}?mode=ro'.format(pathname2url(os.path.abspath(self.path))), uri=True,
+                                   timeout=30)
+        # the file exists and no statement creates tables
+        return sqlite3.connect(self.path, timeout=30)
+
+    def stats(self):
+        """
+            Statistics of the cache.
+        :return: dict with entries, size (values in bytes), file_size (bytes on disk), hits, misses,
+                 oldest and newest (creation timestamps or None) and other counters; a compressed cache adds
+                 blobs (distinct values), raw_size (bytes of the distinct values) and stored_size (their bytes
+                 after compression)
+        """
+        stats = {'entries': 0, 'size': 0, 'file_size': 0, 'hits': 0, 'misses': 0, 'oldest': None, 'newest': None}
+        if not os.path.exists(self.path):
+            return stats
+        # statistics of a cache which is not open (howdoi --stats) are read without changing the file
+        connection = self._connection or self._connect_read_only()
+        with self._lock:
+            try:
+                self._read_stats(connection, stats)
+            except sqlite3.OperationalError:
+                # the tables of this cache were not created yet
+                pass
+            finally:
+                if connection is not self._connection:
+                    connection.close()
+        stats['file_size'] = os.path.getsize(self.path)
+        return stats
+
+    def _read_stats(self, connection, stats):
+        row = connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0), MIN(created), MAX(created) FROM {0}'.format(
+                self.table)).fetchone()
+        stats['entries'], stats['size'], stats['oldest'], stats['newest'] = row
+        prefix = self.table + '_'
+        for name, value in connection.execute('SELECT name, value FROM counters WHERE '
+                                              'substr(name, 1, ?) = ?', (len(prefix), prefix)):
+            stats[name[len(prefix):]] = value
+        if self.compress:
+            stats['blobs'], stats['raw_size'], stats['stored_size'] = connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(stored), 0) FROM {0}'.format(
+                    self.blob_table)).fetchone()
+            # entries written before the cache was compressed
+            legacy_size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM {0} WHERE blob IS NULL'
+                                             .format(self.table)).fetchone()[0]
+            stats['raw_size'] += legacy_size
+            stats['stored_size'] += legacy_size
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
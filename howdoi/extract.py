@@ -0,0 +1,359 @@
+######################################################
+#
+# Extraction of answers and search result links with lxml.
+#
+# The same elements as the pyquery code in howdoi.py are selected with XPath
+# expressions compiled once (the ones pyquery translates from CSS on every
+# call) and links in answers are replaced by their text in place, without
+# wrapping every element in a PyQuery object. The output is the same as of the
+# pyquery code, byte for byte; pyquery is still used with HOWDOI_PARSER=pyquery.
+# The inner text is computed the way pyquery.text.extract_text does it, copied
+# here because importing pyquery imports requests as well.
+#
+# read_until() feeds a page downloaded in chunks to an incremental parser and
+# stops reading as soon as the needed elements (the top answers, the first
+# result links) are complete, so the rest of the page is not downloaded.
+#
+######################################################
+
+import codecs
+import re
+import sys
+
+import lxml.html
+from lxml import etree
+
+from .tracing import traced
+
+if sys.version < '3':
+    string_types = basestring  # noqa: F821
+else:
+    string_types = str
+
+
+def _has_class(name):
+    """ XPath condition of the CSS class selector, as translated by pyquery """
+    return ("@class and contains(@class, '{0}') and "
+            "contains(concat(' ', normalize-space(@class), ' '), ' {0} ')".format(name))
+
+
+ANSWERS = etree.XPath('descendant-or-self::*[{0}]'.format(_has_class('answer')))
+TAGS = etree.XPath('descendant-or-self::*[{0}]'.format(_has_class('post-tag')))
+POST_TEXT = etree.XPath('descendant::*[{0}]'.format(_has_class('post-text')))
+POST_TEXT_CHILDREN = etree.XPath('descendant-or-self::*[{0}]/*'.format(_has_class('post-text')))
+POST_TEXT_PRE = etree.XPath('descendant::*[{0}]/descendant::pre'.format(_has_class('post-text')))
+POST_TEXT_CODE = etree.XPath('descendant::*[{0}]/descendant::code'.format(_has_class('post-text')))
+PRE = etree.XPath('descendant::pre')
+CODE = etree.XPath('descendant::code')
+LINKS = etree.XPath('descendant::a')
+BING_RESULTS = etree.XPath('descendant-or-self::*[{0}]'.format(_has_class('b_algo')))
+H2 = etree.XPath('descendant-or-self::h2')
+A = etree.XPath('descendant-or-self::a')
+GOOGLE_L = etree.XPath('descendant-or-self::*[{0}]'.format(_has_class('l')))
+GOOGLE_R = etree.XPath('descendant-or-self::*[{0}]'.format(_has_class('r')))
+
+
+def parse(page):
+    """
+        Parse the page like pyquery does: as XML if it is well formed, as HTML otherwise.
+    :return: root element or None for empty page
+    """
+    if not page or not page.strip():
+        return None
+    try:
+        return etree.fromstring(page)
+    except etree.XMLSyntaxError:
+        return lxml.html.fromstring(page)
+
+
+def _select(elements, xpath):
+    """ Matches of xpath in every element, in order (like chained pyquery selections) """
+    results = []
+    for element in elements:
+        results.extend(xpath(element))
+    return results
+
+
+def _replace_with_text(element, text):
+    """ Replace the element with text, as PyQuery.replace_with does for a string """
+    text += element.tail or ''
+    children = []
+    if '<' in text or '&' in text:
+        # pyquery parses the string as markup
+        root = parse('<root>' + text + '</root>')
+        children = list(root)
+        text = root.text if isinstance(root.text, string_types) else ''
+    previous = element.getprevious()
+    parent = element.getparent()
+    if previous is not None:
+        previous.tail = (previous.tail or '') + text
+    else:
+        parent.text = (parent.text or '') + text
+    index = parent.index(element)
+    parent[index:index] = children
+    parent.remove(element)
+
+
+# https://developer.mozilla.org/en-US/docs/Web/HTML/Inline_elements#Elements
+INLINE_TAGS = frozenset([
+    'a', 'abbr', 'acronym', 'b', 'bdo', 'big', 'br', 'button', 'cite',
+    'code', 'dfn', 'em', 'i', 'img', 'input', 'kbd', 'label', 'map',
+    'object', 'q', 'samp', 'script', 'select', 'small', 'span', 'strong',
+    'sub', 'sup', 'textarea', 'time', 'tt', 'var'
+])
+# whitespace in HTML: https://www.w3.org/TR/html4/struct/text.html#h-9.1
+WHITESPACE = re.compile(u'[\x20\x09\x0C\u200B\x0A\x0D]+')
+# markers among the text parts: an inserted newline around a block and a <br>
+BLOCK = None
+BREAK = True
+
+
+def _text_parts(element):
+    """ Text parts of the element and its children with BLOCK and BREAK markers """
+    if callable(element.tag):  # comments and processing instructions
+        return []
+    parts = []
+    if element.tag == 'br':
+        parts.append(BREAK)
+    elif element.tag not in INLINE_TAGS:
+        parts.append(BLOCK)
+    if element.text is not None:
+        parts.append(element.text)
+    for child in element:
+        parts.extend(_text_parts(child))
+        if child.tail is not None:
+            parts.append(child.tail)
+    if element.tag not in INLINE_TAGS and element.tag != 'br':
+        parts.append(BLOCK)
+    return parts
+
+
+def _squash_blocks(parts):
+    """ One BLOCK marker of several in a row """
+    output = []
+    for part in parts:
+        if part is not BLOCK or not output or output[-1] is not BLOCK:
+            output.append(part)
+    return output
+
+
+def _strip_blocks(parts):
+    """ Markers before the first and after the last text part removed """
+    if not parts:
+        return parts
+    for start, part in enumerate(parts):
+        if isinstance(part, string_types):
+            break
+    # as in pyquery, without a text part one marker is left
+    for end, part in enumerate(parts[:start - 1 if start > 0 else None:-1]):
+        if isinstance(part, string_types):
+            break
+    return parts[start:-end if end > 0 else None]
+
+
+def _merge_texts(parts):
+    """ Adjacent text parts joined, with the whitespace squashed and stripped """
+    output, texts = [], []
+
+    def flush():
+        text = WHITESPACE.sub(' ', ''.join(texts)).strip()
+        if text:
+            output.append(text)
+        texts[:] = []
+
+    for part in parts:
+        if isinstance(part, string_types):
+            texts.append(part)
+        else:
+            flush()
+            output.append(part)
+    flush()
+    return output
+
+
+def extract_text(element, squash_space=True):
+    """ Inner text of the element, the same as of pyquery.text.extract_text """
+    parts = _text_parts(element)
+    if squash_space:
+        parts = _strip_blocks(_squash_blocks(_merge_texts(_strip_blocks(_squash_blocks(parts)))))
+    else:
+        parts = _strip_blocks(parts)
+    text = ''.join('\n' if part is BLOCK or part is BREAK else part for part in parts)
+    return text.strip() if squash_space else text
+
+
+def _add_links_to_text(element):
+    """ Replace links with their text or [text](href) """
+    for hyperlink in LINKS(element):
+        href = hyperlink.attrib['href']
+        copy = extract_text(hyperlink)
+        if copy == href:
+            replacement = copy
+        else:
+            replacement = '[{0}]({1})'.format(copy, href)
+        _replace_with_text(hyperlink, replacement)
+
+
+@traced('get_text')
+def get_text(element):
+    """ Inner text of the element with links written out, '' for None """
+    if element is None:
+        return ''
+    _add_links_to_text(element)
+    return extract_text(element, squash_space=False)
+
+
+def get_tags(root):
+    return [tag.text for tag in TAGS(root)] if root is not None else []
+
+
+def get_answers(root):
+    """ .answer elements of the question page """
+    return ANSWERS(root) if root is not None else []
+
+
+def _first(elements):
+    return elements[0] if elements else None
+
+
+def get_answer_text(answer, all_text, format_output):
+    """
+        Text of one answer before stripping, see howdoi._get_answer_text.
+    :param answer: .answer element or None
+    :param all_text: whole answer (-a), not only the first code block
+    :param format_output: function highlighting code
+    """
+    if answer is None:
+        return ''
+    instructions = PRE(answer) or CODE(answer)
+
+    if not instructions and not all_text:
+        text = get_text(_first(POST_TEXT(answer)))
+    elif all_text:
+        texts = []
+        for html_tag in POST_TEXT_CHILDREN(answer):
+            current_text = get_text(html_tag)
+            if current_text:
+                if html_tag.tag in ['pre', 'code']:
+                    texts.append(format_output(current_text))
+                else:
+                    texts.append(current_text)
+        text = '\n'.join(texts)
+    else:
+        text = format_output(get_text(instructions[0]))
+    return text
+
+
+def get_answer_record(answer):
+    """
+        Text and code blocks of one answer for --json.
+    :return: (text, list of code texts)
+    """
+    if answer is None:
+        return '', []
+    code_blocks = POST_TEXT_PRE(answer) or POST_TEXT_CODE(answer)
+    text = (get_text(_first(POST_TEXT(answer))) or '').strip()
+    return text, [get_text(code_block) for code_block in code_blocks]
+
+
+def _remove_namespaces(root):
+    """ Tags without namespace, as PyQuery.remove_namespaces (only XML parsed pages have namespaces) """
+    for element in root.getroottree().iter('{*}*'):
+        if element.tag.startswith('{'):
+            element.tag = element.tag.split('}', 1)[1]
+    etree.cleanup_namespaces(root)
+
+
+def extract_links(page, search_engine):
+    """ Result links of search engine page, see howdoi._extract_links """
+    root = parse(page)
+    if root is None:
+        return []
+    if search_engine == 'bing':
+        if not isinstance(root, lxml.html.HtmlElement):
+            _remove_namespaces(root)
+        return [a.attrib['href'] for a in _select(_select(BING_RESULTS(root), H2), A)]
+    return [a.attrib['href'] for a in GOOGLE_L(root)] or \
+        [a.attrib['href'] for a in _select(GOOGLE_R(root), A)]
+
+
+class StopAfter(object):
+    """ Condition of read_until: count elements passing test are complete """
+
+    def __init__(self, name, count, test):
+        """
+        :param name: describes the condition, part of the page cache key of pages read until it
+        :param count: number of elements
+        :param test: function element -> bool, called when the element ends
+        """
+        self.name = name
+        self.count = count
+        self.test = test
+
+    @property
+    def key(self):
+        return '{0}={1}'.format(self.name, self.count)
+
+
+def _has_class_token(element, name):
+    return name in (element.get('class') or '').split()
+
+
+def _is_answer(element):
+    return _has_class_token(element, 'answer')
+
+
+def stop_after_answers(count):
+    """ Question page is read until count answers are complete """
+    return StopAfter('answers', count, _is_answer)
+
+
+def _is_result_link(search_engine):
+    def is_google_link(element):
+        return element.tag == 'a' and (_has_class_token(element, 'l') or
+                                       any(_has_class_token(parent, 'r') for parent in element.iterancestors()))
+
+    def is_bing_link(element):
+        if element.tag != 'a':
+            return False
+        for parent in element.iterancestors('h2'):
+            if any(_has_class_token(result, 'b_algo') for result in parent.iterancestors()):
+                return True
+        return False
+    return is_bing_link if search_engine == 'bing' else is_google_link
+
+
+def stop_after_links(search_engine, count):
+    """ Search page is read until count result links are complete """
+    return StopAfter('links', count, _is_result_link(search_engine))
+
+
+def read_until(chunks, encoding, stop):
+    """
+        Decode and parse the chunks of a page until the stop condition is met.
+    :param chunks: iterator over bytes of the page
+    :param encoding: encoding of the page
+    :param stop: StopAfter
+    :return: (text read so far, True if the whole page was read)
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(encoding or 'utf-8')('replace')
+    except LookupError:
+        # unknown charset sent by the server, response.text of requests falls back as well
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    parser = etree.HTMLPullParser(events=('end',))
+    texts = []
+    found = 0
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if not text:
+            continue
+        texts.append(text)
+        parser.feed(text)
+        for _, element in parser.read_events():
+            if stop.test(element):
+                found += 1
+        if found >= stop.count:
+            return ''.join(texts), False
+    texts.append(decoder.decode(b'', True))
+    return ''.join(texts), True
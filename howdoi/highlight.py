@@ -0,0 +1,128 @@
+######################################################
+#
+# Syntax highlighting of code in answers (-c).
+#
+# pygments get_lexer_by_name scans all lexers and the installed plugins on
+# every call, and howdoi tries every query word and tag. Here the aliases are
+# indexed once, lexers and the terminal formatter are created once and the
+# highlighted code is kept in memory under the hash of the code and the lexer,
+# so answers with many code blocks and repeated queries in one process (howdoi
+# server, --batch) are highlighted only once.
+#
+######################################################
+
+import collections
+import hashlib
+import threading
+
+from .tracing import annotate
+
+# Highlighted code blocks kept in memory
+HIGHLIGHT_CACHE_SIZE = 512
+# Lexer name in the highlight cache key of code whose lexer is guessed
+GUESS = 'guess'
+
+_lock = threading.RLock()
+# alias -> (module, class name) of builtin lexer or class of plugin lexer, built on first use
+_lexer_index = None
+# index entry -> lexer instance
+_lexers = {}
+_formatter = None
+# hash of lexer name and code -> highlighted code, least recently used first
+_highlighted = collections.OrderedDict()
+
+
+def _build_lexer_index():
+    """ Aliases of builtin lexers, then of plugins, the first lexer with alias wins as in get_lexer_by_name """
+    from pygments.lexers import LEXERS
+    from pygments.plugin import find_plugin_lexers
+    index = {}
+    for class_name, (module_name, _, aliases, _, _) in LEXERS.items():
+        for alias in aliases:
+            index.setdefault(alias, (module_name, class_name))
+    for lexer_class in find_plugin_lexers():
+        for alias in lexer_class.aliases:
+            index.setdefault(alias, lexer_class)
+    return index
+
+
+def get_lexer(alias):
+    """
+        Lexer with the alias, as pygments get_lexer_by_name but without scanning all lexers.
+    :return: lexer instance, shared by all callers, or None if there is no lexer with the alias
+    """
+    global _lexer_index
+    with _lock:
+        if _lexer_index is None:
+            _lexer_index = _build_lexer_index()
+        entry = _lexer_index.get(alias.lower()) if alias else None
+        if entry is None:
+            return None
+        if entry not in _lexers:
+            if isinstance(entry, tuple):
+                module = __import__(entry[0], None, None, [entry[1]])
+                _lexers[entry] = getattr(module, entry[1])()
+            else:
+                _lexers[entry] = entry()
+        return _lexers[entry]
+
+
+def _get_formatter():
+    global _formatter
+    if _formatter is None:
+        from pygments.formatters.terminal import TerminalFormatter
+        _formatter = TerminalFormatter(bg='dark')
+    return _formatter
+
+
+def _cache_key(lexer_name, code):
+    return hashlib.sha1((lexer_name + '\0' + code).encode('utf-8')).hexdigest()
+
+
+def _get_cached(key):
+    with _lock:
+        highlighted = _highlighted.pop(key, None)
+        if highlighted is not None:
+            _highlighted[key] = highlighted
+        return highlighted
+
+
+def _set_cached(key, highlighted):
+    with _lock:
+        _highlighted[key] = highlighted
+        while len(_highlighted) > HIGHLIGHT_CACHE_SIZE:
+            _highlighted.popitem(last=False)
+
+
+def highlight_code(code, keywords):
+    """
+        Highlight code with the lexer of the first keyword which is a lexer alias, guessed lexer otherwise.
+    :param code: code to highlight
+    :param keywords: query words and question tags
+    :return: highlighted code, or the code itself if no lexer fits
+    """
+    lexer = None
+    for keyword in keywords:
+        lexer = get_lexer(keyword)
+        if lexer is not None:
+            break
+
+    key = _cache_key(lexer.name if lexer is not None else GUESS, code)
+    highlighted = _get_cached(key)
+    annotate(cache='hit' if highlighted is not None else 'miss', lexer=lexer.name if lexer is not None else GUESS)
+    if highlighted is not None:
+        return highlighted
+
+    from pygments import highlight
+    if lexer is None:
+        from pygments.lexers import guess_lexer
+        from pygments.util import ClassNotFound
+        try:
+            lexer = guess_lexer(code)
+        except ClassNotFound:
+            _set_cached(key, code)
+            return code
+
+    highlighted = highlight(code, lexer, _get_formatter())
+    _set_cached(key, highlighted)
+    return highlighted
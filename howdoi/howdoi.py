@@ -12,34 +12,57 @@
 #   XDG_CACHE_HOME - lokalizacja folderu dla cache. Domyslnie ~/.cache
 #   HOWDOI_DISABLE_CACHE (default: ) - czy cache jest wlaczony. Jezeli taka zmienna jest ustawiona to cache jest wylaczony.
 #   HOWDOI_COLORIZE - kolorowanie outputu. Jezeli ustawie ta zmianna to niezaleznie od tego czy -c jest ustawione czy nie
+#   HOWDOI_MAX_WORKERS (default: 4) - max number of question pages downloaded in parallel.
+#   HOWDOI_CACHE_TTL (default: 2592000) - seconds after which cached page is downloaded again.
+#   HOWDOI_CACHE_SIZE (default: 52428800) - max size in bytes of cached pages (compressed).
+#   HOWDOI_LINK_CACHE_TTL (default: 86400) - seconds after which search is repeated. Either one value for all
+#       search engines or values per engine, e.g. google=3600,bing=86400.
+#   HOWDOI_ANSWER_CACHE_TTL (default: 604800) - seconds after which cached answer is fetched again.
+#   HOWDOI_ANSWER_CACHE_SIZE (default: 10485760) - max size in bytes of cached answers.
+#   HOWDOI_ANSWER_BACKEND (default: scrape) - scrape question pages or use Stack Exchange API (api).
+#   HOWDOI_INDEX (default: <cache dir>/index.sqlite) - offline index used by HOWDOI_SEARCH_ENGINE=local.
+#   HOWDOI_SEARCH_ENGINE (default: google) - google, bing, local (offline index), race (all engines at once,
+#       first usable answer wins) or merge (all engines at once, ranked links merged).
+#   HOWDOI_STREAM_PARSE (default: ) - stop downloading question page when the needed answers are parsed and
+#       search page when the first STREAM_SEARCH_LINKS result links are parsed.
+#   HOWDOI_PARSER (default: lxml) - lxml (extract.py) or pyquery, both extract the same answers.
+#   HOWDOI_PREFETCH (default: 0) - number of next question pages downloaded into the page cache in background
+#       after answering, see prefetch.py.
+#   HOWDOI_PARSE_PROCESSES (default: 0) - processes parsing pages and highlighting answers in howdoi --serve and
+#       --batch, see workers.py.
+#   HOWDOI_FUZZY_CACHE (default: disabled) - similarity (0-1) of queries above which cached answer of similar
+#       query is returned, e.g. 0.8.
+#   HOWDOI_SOCKET (default: <cache dir>/howdoi.sock) - socket of the howdoi server (howdoi --serve).
+#   HOWDOI_POOL_SIZE, HOWDOI_MAX_CONNECTIONS, HOWDOI_HTTP2, HOWDOI_TIMINGS - connection pool, HTTP/2 and request
+#       timings, see transport.py.
+#   HOWDOI_CONNECT_TIMEOUT, HOWDOI_READ_TIMEOUT, HOWDOI_RETRIES, HOWDOI_RETRY_BACKOFF, HOWDOI_HEDGE - timeouts,
+#       retries and hedged requests, see transport.py.
 #
 #
 ######################################################
 
+from __future__ import print_function
+
 import argparse
 import glob
+import json
 import os
-import random
 import re
-import requests
-import requests_cache
 import sys
+import threading
+import time
 from . import __version__
+from . import tracing
+from .workers import offload
 
-# Potrzebne do pokolorowania kodu
-from pygments import highlight
-from pygments.lexers import guess_lexer, get_lexer_by_name
-from pygments.formatters.terminal import TerminalFormatter
-from pygments.util import ClassNotFound
-
-from pyquery import PyQuery as pq
-from requests.exceptions import ConnectionError
-from requests.exceptions import SSLError
+# requests, pyquery i pygments sa importowane dopiero gdy sa potrzebne,
+# dzieki temu -v, -C i --help nie placa za ich zaladowanie
 
 # Handle imports for Python 2 and 3
 # Funkcka u pomaga uzywac Unicode
 if sys.version < '3':
     import codecs
+    from Queue import Queue
     from urllib import quote as url_quote
     from urllib import getproxies
 
@@ -47,9 +70,13 @@ if sys.version < '3':
     def u(x):
         return codecs.unicode_escape_decode(x)[0]
 else:
-    from urllib.request import getproxies
+    from queue import Queue
     from urllib.parse import quote as url_quote
 
+    def getproxies():
+        from urllib.request import getproxies as system_getproxies
+        return system_getproxies()
+
     def u(x):
         return x
 
@@ -83,6 +110,10 @@ ANSWER_HEADER = u('{2}  Answer from {0} {2}\n{1}')
 NOANSWER_HEADER = u('{1}  No valid answer from link {0} {1}\n')
 # Wyswietlane gdy istnieje odpowiedz (znaleziono ja), ale nie ma dla niej tekstu
 NO_ANSWER_MSG = '< no answer given >'
+NETWORK_ERROR_MSG = 'Failed to establish network connection\n'
+QUERY_ERROR_MSG = 'Failed to answer the query\n'
+# Separator odpowiedzi gdy jest ich wiecej niz jedna
+ANSWER_SPLITER = '\n' + '=' * 80 + '\n\n'
 # Lokalizacja cache.
 # Czym rozni sie os.getenv od os.environ.get ? Odp.: os.environ.get pozwala ustawic domyslna wartosc.
 # Przy os.getenv trzeba sprawdzac czy istnieje zmienna i odpowiednio na to reagowac
@@ -93,8 +124,46 @@ CACHE_DIR = os.path.join(XDG_CACHE_DIR, 'howdoi')
 # Lokalizacja pliku cache uzalezniona od wersji Pythona. Ale po co ?
 CACHE_FILE = os.path.join(CACHE_DIR, 'cache{0}'.format(
     sys.version_info[0] if sys.version_info[0] == 3 else ''))
-# sesja do pobierania zasobow z netu
-howdoi_session = requests.session()
+# Cache of downloaded pages (HTTP responses)
+PAGE_CACHE_FILE = CACHE_FILE + '_pages.sqlite'
+DEFAULT_CACHE_TTL = 30 * 24 * 60 * 60
+DEFAULT_CACHE_SIZE = 50 * 1024 * 1024
+# Cache of rendered answers. Repeated query is answered without search, parsing and highlighting.
+ANSWER_CACHE_FILE = CACHE_FILE + '_answers.sqlite'
+DEFAULT_ANSWER_CACHE_TTL = 7 * 24 * 60 * 60
+DEFAULT_ANSWER_CACHE_SIZE = 10 * 1024 * 1024
+# Words skipped in cache keys of queries
+STOP_WORDS = frozenset(['a', 'an', 'and', 'are', 'can', 'do', 'does', 'for', 'from', 'how', 'i', 'in', 'into', 'is',
+                        'it', 'my', 'of', 'on', 'or', 'the', 'to', 'what', 'with'])
+# Cache of question links found by search engines. Search results change often,
+# so they expire much sooner than the question pages.
+LINK_CACHE_FILE = CACHE_FILE + '_links.sqlite'
+DEFAULT_LINK_CACHE_TTL = 24 * 60 * 60
+LINK_CACHE_TTLS = {'google': 24 * 60 * 60, 'bing': 24 * 60 * 60}
+DEFAULT_LINK_CACHE_SIZE = 1024 * 1024
+# Max number of question pages fetched concurrently for -n answers
+DEFAULT_MAX_WORKERS = 4
+# With HOWDOI_STREAM_PARSE pages are read in chunks of this size, search pages until this many links are found
+STREAM_CHUNK_SIZE = 16 * 1024
+STREAM_SEARCH_LINKS = 10
+# cache stron, cache odpowiedzi i cache linkow (dla kazdej wyszukiwarki), instalowane przez _enable_cache
+page_cache = None
+answer_cache = None
+link_caches = {}
+# sesja do pobierania zasobow z netu, tworzona przy pierwszym zapytaniu (get_session, transport.py)
+howdoi_session = None
+# watki batch, serwera i executora aio tworza sesje tylko raz
+_session_lock = threading.Lock()
+
+
+def get_session():
+    global howdoi_session
+    if howdoi_session is None:
+        with _session_lock:
+            if howdoi_session is None:
+                from .transport import create_session
+                howdoi_session = create_session()
+    return howdoi_session
 
 
 def get_proxies():
@@ -109,23 +178,88 @@ def get_proxies():
     return filtered_proxies
 
 
-def _get_result(url):
+@tracing.traced('get_result')
+def _get_result(url, use_cache=True, stop=None):
     """
-        Get result using agent and proxy and ssl (if set).
+        Get result using agent and proxy and ssl (if set), with timeouts and retries (transport.fetch).
         SSL exception is printed here. Other exceptions are passed through.
     :param url: Zapytanie uzytkownika
+    :param use_cache: store the page in the page cache (search pages are not stored, their links are)
+    :param stop: extract.StopAfter, with HOWDOI_STREAM_PARSE the page is read only until it is met
     :return: Pobrana odpowiedz.
     """
+    tracing.annotate(url=url)
+    use_cache = use_cache and page_cache is not None
+    stream = stop is not None and _get_stream_parse()
+    keys = _get_page_cache_keys(url, stop)
+    if use_cache:
+        page = _get_cached_page(keys)
+        if page is not None:
+            return page
+
+    from requests.exceptions import SSLError
+    from .transport import fetch
     try:
-        return howdoi_session.get(url, headers={'User-Agent': random.choice(USER_AGENTS)}, proxies=get_proxies(),
-                                  verify=VERIFY_SSL_CERTIFICATE).text
-    except requests.exceptions.SSLError as e:
+        # user agent, proxies and certificate verification are set on the session (transport.create_session)
+        response = fetch(get_session(), url, stream=stream)
+    except SSLError as e:
         print('[ERROR] Encountered an SSL Error. Try using HTTP instead of '
               'HTTPS by setting the environment variable "HOWDOI_DISABLE_SSL".\n')
         raise e
+    if not stream:
+        page, complete = response.text, True
+        if tracing.is_enabled():
+            tracing.annotate(status=response.status_code, bytes=len(response.content))
+    else:
+        from .extract import read_until
+        from .transport import iter_chunks
+        try:
+            page, complete = read_until(iter_chunks(response, STREAM_CHUNK_SIZE), response.encoding, stop)
+        finally:
+            # the rest of the page is not downloaded
+            response.close()
+        if tracing.is_enabled():
+            tracing.annotate(status=response.status_code, bytes=len(page.encode('utf-8')), complete=complete)
+    if use_cache:
+        _set_cached_page(keys, response.status_code, page, complete)
+    return page
+
+
+def _get_cached_page(keys):
+    """ Strona z cache stron pod pierwszym znalezionym kluczem (_get_page_cache_keys) albo None """
+    for key in keys:
+        page = page_cache.get(key, count=False)
+        if page is not None:
+            page_cache.count('hits')
+            tracing.annotate(cache='hit')
+            return page
+    page_cache.count('misses')
+    tracing.annotate(cache='miss')
+    return None
+
+
+def _set_cached_page(keys, status_code, page, complete=True):
+    """ Pobrana strona do cache stron, pelna pod kluczem url, przeczytana do warunku pod drugim kluczem """
+    if status_code == 200:
+        page_cache.set(keys[0] if complete else keys[1], page)
+
+
+def _get_page_cache_keys(url, stop=None):
+    """
+        Klucze strony w cache stron: strona przeczytana do warunku jest pod osobnym kluczem,
+        pelna strona tez go spelnia.
+    """
+    if stop is not None and _get_stream_parse():
+        return [url, '{0}#{1}'.format(url, stop.key)]
+    return [url]
+
+
+def _get_stream_parse():
+    return bool(os.getenv('HOWDOI_STREAM_PARSE'))
 
 
 def _add_links_to_text(element):
+    from pyquery import PyQuery as pq
     hyperlinks = element.find('a')
 
     for hyperlink in hyperlinks:
@@ -138,6 +272,8 @@ def _add_links_to_text(element):
             replacement = "[{0}]({1})".format(copy, href)
         pquery_object.replace_with(replacement)
 
+
+@tracing.traced('get_text')
 def get_text(element):
     ''' return inner text in pyquery element '''
     _add_links_to_text(element)
@@ -166,25 +302,170 @@ def _extract_links(html, search_engine):
     return _extract_links_from_google(html)
 
 
+def _get_html_parser():
+    """ lxml (extract.py, default) or pyquery, both give the same output """
+    return os.getenv('HOWDOI_PARSER') or 'lxml'
+
+
+@tracing.traced('extract_links')
+def _extract_links_from_page(page, search_engine):
+    """ Linki z pobranej strony wyszukiwarki """
+    if _get_html_parser() == 'pyquery':
+        from pyquery import PyQuery as pq
+        # bibliotek pyquery ladnie zamienia przydka odpowiedz na html
+        links = _extract_links(pq(page), search_engine)
+    else:
+        from .extract import extract_links
+        links = extract_links(page, search_engine)
+    tracing.annotate(engine=search_engine, links=len(links))
+    return links
+
+
 def _get_search_url(search_engine):
     return SEARCH_URLS.get(search_engine, SEARCH_URLS['google'])
 
 
+def _get_search_engine():
+    return os.getenv('HOWDOI_SEARCH_ENGINE') or 'google'
+
+
+@tracing.traced('get_links')
 def _get_links(query):
     """ Zwroc linki dla zadanego pytania """
     """ 
         Zwraca url przegladarki. Taki link odnosi sie do strony oraz tego co na tej stronie szukamy. 
         Pierwszy parametr to URL stackoverflow. 
     """
-    search_engine = os.getenv('HOWDOI_SEARCH_ENGINE', 'google')
-    search_url = _get_search_url(search_engine)
+    search_engine = _get_search_engine()
+    tracing.annotate(engine=search_engine)
+    if search_engine == 'local':
+        from .local_index import search
+        return search(query)
+
+    """ Powtorzone zapytanie bierze linki z cache, bez odpytywania wyszukiwarki """
+    cached_links = _get_cached_links(query, search_engine)
+    if cached_links is not None:
+        return cached_links
+
+    if search_engine in ('race', 'merge'):
+        links = _race_links(query, merge=search_engine == 'merge')
+    else:
+        links = _get_links_from_engine(query, search_engine)
+
+    _set_cached_links(query, search_engine, links)
+    return links
+
+
+def _get_link_cache_key(query):
+    """ Linki zaleza od zapytania i strony (HOWDOI_URL), wyszukiwarka ma osobna tabele """
+    return json.dumps([_normalize_query(query), URL])
+
+
+def _get_cached_links(query, search_engine):
+    """ Linki z cache linkow wyszukiwarki albo None """
+    link_cache = link_caches.get(search_engine)
+    if link_cache is None:
+        return None
+    cached_links = link_cache.get(_get_link_cache_key(query))
+    tracing.annotate(cache='hit' if cached_links is not None else 'miss')
+    return json.loads(cached_links) if cached_links is not None else None
+
+
+def _set_cached_links(query, search_engine, links):
+    """ Linki do pytan do cache linkow wyszukiwarki, wynik bez pytan nie jest zapisywany """
+    link_cache = link_caches.get(search_engine)
+    question_links = _get_questions(links)
+    if link_cache is not None and question_links:
+        link_cache.set(_get_link_cache_key(query), json.dumps(question_links))
+
+
+def _get_search_request(query, search_engine):
+    """ Strona wynikow wyszukiwania dla zapytania: (url, extract.StopAfter or None), see _get_search_stop """
+    return _get_search_url(search_engine).format(URL, url_quote(query)), _get_search_stop(search_engine)
+
+
+def _get_search_stop(search_engine):
+    """ Z HOWDOI_STREAM_PARSE strona wynikow jest czytana tylko do STREAM_SEARCH_LINKS linkow """
+    if _get_stream_parse():
+        from .extract import stop_after_links
+        return stop_after_links(search_engine, STREAM_SEARCH_LINKS)
+    return None
+
+
+def _get_search_result(search_url, search_engine):
+    """ Strona wynikow wyszukiwania, see _get_search_stop """
+    return _get_result(search_url, use_cache=False, stop=_get_search_stop(search_engine))
+
+
+def _get_links_from_engine(query, search_engine):
+    """ Linki z jednej wyszukiwarki """
+    search_url, stop = _get_search_request(query, search_engine)
 
     # Odpowiedz na zapytanie ktore jest textem
-    result = _get_result(search_url.format(URL, url_quote(query)))
-    # bibliotek pyquery ladnie zamienia przydka odpowiedz na html
-    html = pq(result)
+    result = _get_result(search_url, use_cache=False, stop=stop)
     # zwraca linki z pobranego htmla. Ok, ale po co search engine ? W odpowiedzi pojawia sie search engine, ktory trzeba odseparowac ????
-    return _extract_links(html, search_engine)
+    return offload(_extract_links_from_page, result, search_engine)
+
+
+def _race_links(query, merge=False):
+    """
+        Query every engine from SEARCH_URLS at the same time.
+        Without merge the first engine whose links contain questions wins and the results of the
+        others are ignored (they are not parsed). With merge the ranked links of all engines are
+        interleaved and duplicates removed.
+    :return: list of links
+    """
+    results = Queue()
+    cancelled = threading.Event()
+
+    def search(search_engine):
+        try:
+            search_url, stop = _get_search_request(query, search_engine)
+            result = _get_result(search_url, use_cache=False, stop=stop)
+            if cancelled.is_set():
+                return
+            results.put((search_engine, offload(_extract_links_from_page, result, search_engine), None))
+        except Exception as e:
+            results.put((search_engine, [], e))
+
+    search_engines = sorted(SEARCH_URLS)
+    for search_engine in search_engines:
+        thread = threading.Thread(target=search, args=(search_engine,))
+        thread.daemon = True
+        thread.start()
+
+    links_by_engine = {}
+    errors = []
+    for _ in search_engines:
+        search_engine, links, error = results.get()
+        if error is not None:
+            errors.append(error)
+            continue
+        links_by_engine[search_engine] = links
+        if not merge and _get_questions(links):
+            cancelled.set()
+            return links
+
+    if not links_by_engine and errors:
+        raise errors[0]
+    return _merge_links([links_by_engine.get(search_engine, []) for search_engine in search_engines])
+
+
+def _merge_links(ranked_links):
+    """ Przeplata listy linkow wedlug pozycji, ten sam link (to samo pytanie) tylko raz """
+    merged = []
+    seen = set()
+    for position in range(max([len(links) for links in ranked_links] or [0])):
+        for links in ranked_links:
+            if position >= len(links):
+                continue
+            link = links[position]
+            key = _get_question_id(link) or link
+            if key not in seen:
+                seen.add(key)
+                merged.append(link)
+    return merged
+
 
 """
     Zwroc link z danej pozycji
@@ -200,6 +481,7 @@ def get_link_at_pos(links, position):
     return link
 
 
+@tracing.traced('format_output')
 def _format_output(code, args):
     """
         Zwroc pokolorowany kod.
@@ -212,27 +494,12 @@ def _format_output(code, args):
     """
     if not args['color']:
         return code
-    lexer = None
+    # Potrzebne do pokolorowania kodu (lexery, formatter i pokolorowany kod sa zapamietywane)
+    from .highlight import highlight_code
 
     # try to find a lexer using the StackOverflow tags
-    # or the query arguments
-    for keyword in args['query'].split() + args['tags']:
-        try:
-            lexer = get_lexer_by_name(keyword)
-            break
-        except ClassNotFound:
-            pass
-
-    # no lexer found above, use the guesser
-    if not lexer:
-        try:
-            lexer = guess_lexer(code)
-        except ClassNotFound:
-            return code
-
-    return highlight(code,
-                     lexer,
-                     TerminalFormatter(bg='dark'))
+    # or the query arguments, no lexer found - use the guesser
+    return highlight_code(code, args['query'].split() + args['tags'])
 
 
 def _is_question(link):
@@ -244,6 +511,11 @@ def _is_question(link):
     return re.search('questions/\d+/', link)
 
 
+def _get_question_id(link):
+    match = re.search(r'questions/(\d+)/', link)
+    return int(match.group(1)) if match else None
+
+
 def _get_questions(links):
     """
         Filtruje list. Zostawia tylko te linki ktore
@@ -252,36 +524,171 @@ def _get_questions(links):
     """
     return [link for link in links if _is_question(link)]
 
-"""
-    Zwraca odpowiedz z linka
-"""
-def _get_answer(args, links):
+
+def _get_int_env(name, default):
+    """ Integer value of environment variable or default if not set or invalid """
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def _get_max_workers():
+    """ Concurrency limit for page downloads, taken from HOWDOI_MAX_WORKERS """
+    return max(1, _get_int_env('HOWDOI_MAX_WORKERS', DEFAULT_MAX_WORKERS))
+
+
+def _get_question_page_request(link, answers=1):
     """
-        Odpowiedz z linku -> skomplikowane toto
+        Po co ta zakladka votes ? Wybor tej zakladki robi sortowanie po votes malejaca
+    :param answers: number of top answers needed, with HOWDOI_STREAM_PARSE the page is read only until them
+    :return: (url, extract.StopAfter or None) of the question page
+    """
+    if _get_stream_parse():
+        from .extract import stop_after_answers
+        return link + '?answertab=votes', stop_after_answers(answers)
+    return link + '?answertab=votes', None
+
+
+def _get_question_page(link, answers=1):
+    """ Strona pytania, see _get_question_page_request """
+    url, stop = _get_question_page_request(link, answers)
+    if stop is not None:
+        return _get_result(url, stop=stop)
+    return _get_result(url)
+
+
+def _is_question_page_cached(link, answers=1):
+    """ Strona pytania jest w cache stron (sprawdzenie nie liczy sie do statystyk) """
+    if page_cache is None:
+        return False
+    url, stop = _get_question_page_request(link, answers)
+    return any(page_cache.contains(key) for key in _get_page_cache_keys(url, stop))
+
+
+def _get_answer_backend():
+    return os.getenv('HOWDOI_ANSWER_BACKEND') or 'scrape'
+
+
+def _fetch_question_pages(links, answers=1):
+    """
+        All question pages at once, see _iter_question_pages.
+    :param links: question links
+    :return: dict link -> page
+    """
+    return dict(_iter_question_pages(links, answers))
+
+
+def _iter_question_pages(links, answers=1):
+    """
+        Pobranie stron z pytaniami przez wybrany backend (HOWDOI_ANSWER_BACKEND).
+        Backend api pobiera odpowiedzi wszystkich pytan jednym zapytaniem do Stack Exchange API,
+        strony ktorych nie zwrocil sa pobierane tak jak w backendzie scrape.
+        Every link is fetched only once, even if it is repeated on the list. Pages are yielded in the order
+        of the links, each one as soon as it and all pages before it are downloaded.
+    :param links: question links
+    :param answers: number of top answers needed from every page
+    :return: iterator over (link, page)
+    """
+    unique_links = _get_unique_links(links)
+
+    if _get_search_engine() == 'local':
+        # bez sieci: pytania ktorych nie ma w indeksie nie maja odpowiedzi
+        from .local_index import fetch_question_pages
+        pages = fetch_question_pages(unique_links)
+        for link in unique_links:
+            yield link, pages.get(link, '')
+        return
+
+    pages = {}
+    if _get_answer_backend() == 'api' and unique_links:
+        from requests.exceptions import RequestException
+        from .stackexchange import fetch_question_pages
+        try:
+            pages = fetch_question_pages(unique_links)
+        except (RequestException, ValueError):
+            pages = {}
+    scraped_pages = _iter_scraped_pages([link for link in unique_links if link not in pages], answers)
+    try:
+        for link in unique_links:
+            if link in pages:
+                yield link, pages[link]
+            else:
+                yield next(scraped_pages)
+    finally:
+        scraped_pages.close()
+
+
+def _get_unique_links(links):
+    """ Linki bez pustych i powtorzonych, w kolejnosci """
+    unique_links = []
+    for link in links:
+        if link and link not in unique_links:
+            unique_links.append(link)
+    return unique_links
+
+
+def _render_question_page(tags, answers):
+    """
+        Question page with Stack Overflow markup understood by the parser,
+        built from answers which do not come from a scraped page (API, offline index).
+    :param tags: list of question tags
+    :param answers: list of dicts with answer_id and body (html), best answer first
+    :return: html
+    """
+    # xml.sax.saxutils imports urllib.request, which -v, -C and --help do not need
+    from xml.sax.saxutils import escape, quoteattr
+    tags_html = ''.join('<a class="post-tag">{0}</a>'.format(escape(tag)) for tag in tags)
+    answers_html = ''.join('<div class="answer" data-answerid={0}><div class="post-text">{1}</div></div>'.format(
+        quoteattr(str(answer['answer_id'])), answer['body']) for answer in answers)
+    return '<html><body><div class="question">{0}</div>{1}</body></html>'.format(tags_html, answers_html)
+
+
+def _iter_scraped_pages(unique_links, answers=1):
+    """
+        Download question pages in parallel using a bounded thread pool.
+    :param unique_links: question links without duplicates
+    :param answers: number of top answers needed from every page
+    :return: iterator over (link, page) in order of the links
+    """
+    workers = min(_get_max_workers(), len(unique_links))
+    if workers <= 1:
+        for link in unique_links:
+            yield link, _get_question_page(link, answers)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        for index, page in enumerate(pool.imap(lambda link: _get_question_page(link, answers), unique_links)):
+            yield unique_links[index], page
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _get_answer_text(args, answer):
+    """
+        Tekst pojedynczej odpowiedzi (element .answer) sformatowany tak jak zadal uzytkownik.
     :param args:
-    :param links:
+    :param answer: element with one answer (pyquery or lxml, see _get_html_parser)
     :return:
     """
-    link = get_link_at_pos(links, args['pos'])
-    if not link:
-        return False
-    if args.get('link'):
-        return link
-    """ Po co ta zakladka votes ? Wybor tej zakladki robi sortowanie po votes malejaca """
-    page = _get_result(link + '?answertab=votes')
-    html = pq(page)
-    """ Odpowiedz o najwyzszej liczbie glosow """
-    first_answer = html('.answer').eq(0)
+    if _get_html_parser() != 'pyquery':
+        from .extract import get_answer_text
+        text = get_answer_text(answer, args['all'], lambda code: _format_output(code, args))
+        if text is None:
+            text = NO_ANSWER_MSG
+        return text.strip()
 
-    instructions = first_answer.find('pre') or first_answer.find('code')
-    args['tags'] = [t.text for t in html('.post-tag')]
+    instructions = answer.find('pre') or answer.find('code')
 
     if not instructions and not args['all']:
         # Jezeli nie udalo sie znalesc kodu ktory jest odpowiedzia to
-        text = get_text(first_answer.find('.post-text').eq(0))
+        text = get_text(answer.find('.post-text').eq(0))
     elif args['all']:
         texts = []
-        for html_tag in first_answer.items('.post-text > *'):
+        for html_tag in answer.items('.post-text > *'):
             current_text = get_text(html_tag)
             if current_text:
                 if html_tag[0].tag in ['pre', 'code']:
@@ -293,9 +700,121 @@ def _get_answer(args, links):
         text = _format_output(get_text(instructions.eq(0)), args)
     if text is None:
         text = NO_ANSWER_MSG
-    text = text.strip()
-    return text
+    return text.strip()
+
 
+def _get_answer_elements(args, link, pages=None):
+    """
+        Top answers from the question page. The page is parsed only once,
+        up to args['answers_per_question'] answers are taken from it. Sets args['tags'].
+    :param args:
+    :param link: question link
+    :param pages: optional dict link -> already downloaded question page
+    :return: list of (answer link, element with the answer)
+    """
+    answers_per_question = max(1, args.get('answers_per_question') or 1)
+    if pages and link in pages:
+        page = pages[link]
+    else:
+        page = _get_question_page(link, answers_per_question)
+    if _get_html_parser() != 'pyquery':
+        from . import extract
+        root = extract.parse(page)
+        args['tags'] = extract.get_tags(root)
+        answer_elements = extract.get_answers(root) or [None]
+        results = []
+        for answer in answer_elements[:answers_per_question]:
+            answer_link = link
+            if answers_per_question > 1 and answer is not None and answer.get('data-answerid'):
+                answer_link = '{0}#{1}'.format(link, answer.get('data-answerid'))
+            results.append((answer_link, answer))
+        return results
+
+    from pyquery import PyQuery as pq
+    html = pq(page)
+    args['tags'] = [t.text for t in html('.post-tag')]
+
+    """ Odpowiedzi sa posortowane po liczbie glosow (answertab=votes) """
+    answer_elements = html('.answer')
+    results = []
+    for index in range(max(1, min(answers_per_question, len(answer_elements)))):
+        answer = answer_elements.eq(index)
+        answer_link = link
+        if answers_per_question > 1 and answer.attr('data-answerid'):
+            answer_link = '{0}#{1}'.format(link, answer.attr('data-answerid'))
+        results.append((answer_link, answer))
+    return results
+
+
+@tracing.traced('get_answer')
+def _get_answers(args, links, pages=None):
+    """
+        Answers from the question at args['pos'] formatted as text.
+    :param args:
+    :param links:
+    :param pages: optional dict link -> already downloaded question page
+    :return: list of (answer link, answer text)
+    """
+    link = get_link_at_pos(links, args['pos'])
+    if not link:
+        return []
+    if args.get('link'):
+        return [(link, link)]
+    return [(answer_link, _get_answer_text(args, answer))
+            for answer_link, answer in _get_answer_elements(args, link, pages)]
+
+
+@tracing.traced('get_answer')
+def _get_answer_records(args, links, pages=None):
+    """
+        Answers from the question at args['pos'] as records for --json. Code is not highlighted.
+    :param args:
+    :param links:
+    :param pages: optional dict link -> already downloaded question page
+    :return: list of dicts
+    """
+    link = get_link_at_pos(links, args['pos'])
+    if not link:
+        return []
+    record = {'position': args['pos'], 'link': link, 'question_id': _get_question_id(link)}
+    if args.get('link'):
+        return [record]
+    records = []
+    if _get_html_parser() != 'pyquery':
+        from .extract import get_answer_record
+        for answer_link, answer in _get_answer_elements(args, link, pages):
+            text, code = get_answer_record(answer)
+            records.append(dict(record,
+                                link=answer_link,
+                                answer_id=answer.get('data-answerid') if answer is not None else None,
+                                tags=args['tags'],
+                                answer=text,
+                                code=code))
+        return records
+    for answer_link, answer in _get_answer_elements(args, link, pages):
+        code_blocks = answer.find('.post-text pre') or answer.find('.post-text code')
+        records.append(dict(record,
+                            link=answer_link,
+                            answer_id=answer.attr('data-answerid'),
+                            tags=args['tags'],
+                            answer=(get_text(answer.find('.post-text').eq(0)) or '').strip(),
+                            code=[get_text(code_block) for code_block in code_blocks.items()]))
+    return records
+
+
+# Zwraca odpowiedz z linka
+def _get_answer(args, links, pages=None):
+    """
+        Odpowiedz z linku -> skomplikowane toto
+    :param args:
+    :param links:
+    :param pages: optional dict link -> already downloaded question page
+    :return: text of the highest voted answer
+    """
+    answers = _get_answers(args, links, pages)
+    if not answers:
+        return False
+    return answers[0][1]
 
 
 def format_no_answer(link, star_headers):
@@ -313,6 +832,15 @@ def _get_instructions(args):
         Wyrzucenie tych ktore nie sa pytaniami
         Jezeli jakies sa filtrowane to jest wyswietl.
         Wyswietl tyle odpowiedzi ile zarzadano i z zadanej pozycji.
+    :return: all answers as one text, False if there are none
+    """
+    return ''.join(_iter_instructions(args)) or False
+
+
+def _iter_instructions(args):
+    """
+        Answers as in _get_instructions, yielded one by one as soon as the answer
+        and all answers before it are ready. Nothing is yielded if there are no answers.
     """
 
 
@@ -321,54 +849,119 @@ def _get_instructions(args):
     """
     links = _get_links(args['query'])
     if not links:
-        return False
+        return
 
     """
         Only leave questions. Czyli inne filtruje
     """
     question_links = _get_questions(links)
     if not question_links:
-        return False
+        return
 
+    _report_filtered_links(links, question_links)
+
+    only_hyperlinks = args.get('link')
+    answers = []
+    initial_position = args['pos']
+
+    """ Strony z pytaniami pobierane sa rownolegle, odpowiedzi sa skladane w kolejnosci pozycji """
+    positions = _get_positions(args)
+    pages = {}
+    page_iterator = None
+    if not only_hyperlinks:
+        page_iterator = _iter_question_pages([get_link_at_pos(question_links, pos) for pos in positions],
+                                             max(1, args.get('answers_per_question') or 1))
+
+    if args.get('json'):
+        pages.update(page_iterator or [])
+        yield offload(_get_json_answers, args, question_links, pages, positions)
+        _prefetch_next(args, question_links, initial_position + args['num_answers'], page_iterator)
+        return
+
+    """ Wyswietl tyle odpowiedzi ile chce uzytkownik (domyslnie 1)"""
+    for current_position in positions:
+        link = get_link_at_pos(question_links, current_position)
+        """ Czekamy tylko na strone tej pozycji (i wczesniejszych), kolejne pobieraja sie dalej """
+        while not only_hyperlinks and link not in pages:
+            fetched_link, page = next(page_iterator)
+            pages[fetched_link] = page
+        for answer in _get_position_answers(args, question_links, pages, current_position):
+            """ Lista odpowiedzi, miedzy odpowiedziami separator """
+            yield ANSWER_SPLITER + answer if answers else answer
+            answers.append(answer)
+    if not only_hyperlinks:
+        _prefetch_next(args, question_links, initial_position + args['num_answers'], page_iterator)
+
+
+def _report_filtered_links(links, question_links):
     """ Liczne przefiltrowanych linkow """
     if len(links) != len(question_links):
         diff = abs(len(question_links) - len(links))
-        print("{0} links filtered as not a question.".format(diff))
-        print("Total links: {0}. Filtered links: {1}".format(len(question_links),len(links)))
+        print("{0} links filtered as not a question.".format(diff), file=sys.stderr)
+        print("Total links: {0}. Filtered links: {1}".format(len(question_links), len(links)), file=sys.stderr)
     if len(links) > len(question_links):
         diff = [item for item in links if item not in question_links]
-        print(diff)
+        print(diff, file=sys.stderr)
 
-    only_hyperlinks = args.get('link')
-    star_headers = (args['num_answers'] > 1 or args['all'])
 
-    answers = []
-    initial_position = args['pos']
-    spliter_length = 80
-    answer_spliter = '\n' + '=' * spliter_length + '\n\n'
+def _get_positions(args):
+    """ Pozycje pytan z odpowiedziami: od -p, tyle ile -n """
+    return range(args['pos'], args['pos'] + args['num_answers'])
 
-    """ Wyswietl tyle odpowiedzi ile chce uzytkownik (domyslnie 1)"""
-    for answer_number in range(args['num_answers']):
-        current_position = answer_number + initial_position
+
+def _get_json_answers(args, question_links, pages, positions):
+    """ Odpowiedzi --json z pytan na pozycjach, strony pytan musza byc w pages """
+    records = []
+    for current_position in positions:
         args['pos'] = current_position
-        link = get_link_at_pos(question_links, current_position)
-        """ Teraz z linka pobieramy  """
-        answer = _get_answer(args, question_links)
+        records += _get_answer_records(args, question_links, pages)
+    return json.dumps(records, indent=2) + '\n'
+
+
+def _get_position_answers(args, question_links, pages, position):
+    """
+        Lista odpowiedzi z pytania na pozycji. Z pula procesow (workers.py) odpowiedzi sa skladane w procesie puli,
+        przekazywana jest tylko strona tego pytania.
+    """
+    args['pos'] = position
+    link = get_link_at_pos(question_links, position)
+    if link in pages:
+        pages = {link: pages[link]}
+    return offload(_render_position_answers, args, question_links, pages, position)
+
+
+def _render_position_answers(args, question_links, pages, position):
+    return list(_iter_position_answers(args, question_links, pages, position))
+
+
+def _iter_position_answers(args, question_links, pages, position):
+    """
+        Sformatowane odpowiedzi z pytania na pozycji, kazda zakonczona nowa linia.
+        Strona pytania musi byc w pages (poza -l).
+    """
+    args['pos'] = position
+    star_headers = (args['num_answers'] > 1 or args['all'] or args.get('answers_per_question', 1) > 1)
+    for answer_link, answer in _get_answers(args, question_links, pages):
         """ Odpowiedzi moze byc mniej niz num_answers. W szczegolnosci moze byc pusta odpowiedz """
         if not answer:
             continue
-        if not only_hyperlinks:
+        if not args.get('link'):
             """ Formatowanie odpowiedzi """
-            answer = format_answer(link, answer, star_headers)
-        answer += '\n'
-        """ Lista odpowiedzi"""
-        answers.append(answer)
+            answer = format_answer(answer_link, answer, star_headers)
+        yield answer + '\n'
 
-        """ If not answers then return information about that"""
-        if ''.join(answers) == '\n' * args['num_answers']:
-            return format_no_answer(link, star_headers)
 
-    return answer_spliter.join(answers)
+def _prefetch_next(args, question_links, next_position, page_iterator=None):
+    """
+        Z HOWDOI_PREFETCH strony kolejnych pytan sa pobierane w tle do cache (prefetch.py).
+        page_iterator jest zamykany wczesniej, zeby proces prefetch nie startowal obok watkow pobierajacych strony.
+    """
+    if not os.getenv('HOWDOI_PREFETCH'):
+        return
+    if page_iterator is not None:
+        page_iterator.close()
+    from .prefetch import prefetch
+    prefetch(question_links, next_position, max(1, args.get('answers_per_question') or 1))
 
 
 def format_answer(link, answer, star_headers):
@@ -377,17 +970,113 @@ def format_answer(link, answer, star_headers):
     return answer
 
 
+def _get_link_cache_ttl(search_engine):
+    """ TTL linkow dla wyszukiwarki: HOWDOI_LINK_CACHE_TTL=3600 albo HOWDOI_LINK_CACHE_TTL=google=3600,bing=86400 """
+    ttl = LINK_CACHE_TTLS.get(search_engine, DEFAULT_LINK_CACHE_TTL)
+    for item in os.getenv('HOWDOI_LINK_CACHE_TTL', '').split(','):
+        name, _, value = item.rpartition('=')
+        if not value.strip().isdigit():
+            continue
+        if name.strip() == search_engine:
+            return int(value)
+        if not name.strip():
+            ttl = int(value)
+    return ttl
+
+
+def _open_caches():
+    """
+        Cache stron pobranych przez _get_result, cache gotowych odpowiedzi i cache linkow
+        (osobna tabela dla kazdej wyszukiwarki). Limity (TTL, rozmiar) sa brane ze zmiennych srodowiskowych.
+    :return: list of caches
+    """
+    from .cache import Cache
+    caches = [Cache(PAGE_CACHE_FILE, table='pages',
+                    ttl=_get_int_env('HOWDOI_CACHE_TTL', DEFAULT_CACHE_TTL),
+                    max_size=_get_int_env('HOWDOI_CACHE_SIZE', DEFAULT_CACHE_SIZE), compress=True),
+              Cache(ANSWER_CACHE_FILE, table='answers',
+                    ttl=_get_int_env('HOWDOI_ANSWER_CACHE_TTL', DEFAULT_ANSWER_CACHE_TTL),
+                    max_size=_get_int_env('HOWDOI_ANSWER_CACHE_SIZE', DEFAULT_ANSWER_CACHE_SIZE), indexed=True)]
+    for search_engine in sorted(SEARCH_URLS) + ['race', 'merge']:
+        caches.append(Cache(LINK_CACHE_FILE, table='links_' + search_engine,
+                            ttl=_get_link_cache_ttl(search_engine), max_size=DEFAULT_LINK_CACHE_SIZE))
+    return caches
+
+
 def _enable_cache():
     """
         Procedura wewnetrzna.
         Dwa etapy:
             1. Stworz folder ktory zawiera cache.
-            2. Zainstalowanie cache (za pomoca biblioteki requests_cache.
+            2. Zainstalowanie cache stron, cache odpowiedzi i cache linkow.
     :return:
     """
+    global page_cache, answer_cache, link_caches
     if not os.path.exists(CACHE_DIR):
         os.makedirs(CACHE_DIR)
-    requests_cache.install_cache(CACHE_FILE)
+    caches = _open_caches()
+    page_cache, answer_cache = caches[:2]
+    link_caches = dict((cache.table[len('links_'):], cache) for cache in caches[2:])
+
+
+def _format_timestamp(timestamp):
+    if timestamp is None:
+        return '-'
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def _get_cache_name(cache):
+    if cache.table.startswith('links_'):
+        return 'Link cache, {0}'.format(cache.table[len('links_'):])
+    return {'pages': 'Page cache', 'answers': 'Answer cache'}.get(cache.table, cache.table)
+
+
+def _get_cache_stats():
+    """ Statystyki wszystkich cache (howdoi --stats), czytane bez zmiany plikow """
+    lines = []
+    # cache linkow wszystkich wyszukiwarek sa w jednym pliku, jego rozmiar jest podany raz
+    file_caches = {}
+    for cache in _open_caches():
+        stats = cache.stats()
+        cache.close()
+        if cache.path in file_caches:
+            file_size = 'shared with {0}'.format(file_caches[cache.path])
+        else:
+            file_caches[cache.path] = _get_cache_name(cache)
+            file_size = '{0} bytes'.format(stats['file_size'])
+        lookups = stats['hits'] + stats['misses'] + stats.get('fuzzy_hits', 0)
+        hit_ratio = float(stats['hits']) / lookups if lookups else 0
+        lines += ['{0} ({1})'.format(_get_cache_name(cache), cache.path),
+                  '  entries: {0}'.format(stats['entries']),
+                  '  size on disk: {0}'.format(file_size),
+                  '  hits/misses: {0}/{1} (hit ratio {2:.1%})'.format(stats['hits'], stats['misses'], hit_ratio),
+                  '  oldest entry: {0}'.format(_format_timestamp(stats['oldest'])),
+                  '  newest entry: {0}'.format(_format_timestamp(stats['newest']))]
+        if 'stored_size' in stats:
+            lines.append('  pages: {0} bytes compressed to {1} bytes ({2:.1%}), {3} unique'.format(
+                stats['raw_size'], stats['stored_size'],
+                float(stats['stored_size']) / stats['raw_size'] if stats['raw_size'] else 0, stats['blobs']))
+        if 'prefetched' in stats:
+            lines.append('  prefetched pages: {0}'.format(stats['prefetched']))
+        if 'fuzzy_hits' in stats:
+            lines.append('  similar query hits: {0} (hit ratio {1:.1%})'.format(
+                stats['fuzzy_hits'], float(stats['fuzzy_hits']) / lookups if lookups else 0))
+    lines.append('Total size on disk: {0} bytes'.format(
+        sum(os.path.getsize(path) for path in file_caches if os.path.exists(path))))
+    return '\n'.join(lines)
+
+
+def _compact_cache():
+    """ Usuwa przeterminowane wpisy i wpisy ponad limit rozmiaru, potem VACUUM kazdego pliku (raz) """
+    caches = [cache for cache in _open_caches() if os.path.exists(cache.path)]
+    for cache in caches:
+        cache.evict()
+    vacuumed = set()
+    for cache in caches:
+        if cache.path not in vacuumed:
+            cache.vacuum()
+            vacuumed.add(cache.path)
+        cache.close()
 
 
 def _clear_cache():
@@ -398,18 +1087,167 @@ def _clear_cache():
         os.remove(cache)
 
 
+def _normalize_query(query):
+    """
+        Klucz zapytania dla cache: male litery, bez stop words, slowa posortowane.
+        "Format  date in bash" i "bash format date" maja ten sam klucz.
+    """
+    words = re.findall(r'[^\W_]+|[^\w\s]+', query.lower(), re.UNICODE)
+    significant_words = [word for word in words if word not in STOP_WORDS] or words
+    return ' '.join(sorted(set(significant_words)))
+
+
+def _get_fuzzy_threshold():
+    """ Minimalne podobienstwo (0-1) zapytan z HOWDOI_FUZZY_CACHE, 0 wylacza wyszukiwanie podobnych """
+    try:
+        return float(os.getenv('HOWDOI_FUZZY_CACHE') or 0)
+    except ValueError:
+        return 0
+
+
+def _get_similar_answer(cache_key):
+    """
+        Odpowiedz na najbardziej podobne zapytanie z cache odpowiedzi (podobienstwo Jaccarda zbiorow slow)
+        zadane z tymi samymi opcjami. Uzywane tylko gdy ustawione HOWDOI_FUZZY_CACHE.
+    :return: answer or None
+    """
+    threshold = _get_fuzzy_threshold()
+    if not threshold or answer_cache is None:
+        return None
+    key = json.loads(cache_key)
+    words, options = set(key[0].split()), key[1:]
+    best_key, best_similarity = None, threshold
+    # tylko zapytania majace wspolne slowa (indeks slow cache odpowiedzi)
+    for other_key, shared, total in answer_cache.find_similar(words):
+        similarity = float(shared) / (len(words) + total - shared)
+        if similarity >= best_similarity and json.loads(other_key)[1:] == options:
+            best_key, best_similarity = other_key, similarity
+    if best_key is None:
+        return None
+    return answer_cache.get(best_key, count=False)
+
+
+def _get_answer_cache_key(args):
+    """ Odpowiedz zalezy od zapytania, opcji formatowania, wyszukiwarki i strony (HOWDOI_URL) """
+    return json.dumps([_normalize_query(args['query']), args['pos'], args['num_answers'], bool(args['all']),
+                       bool(args.get('link')), bool(args['color']), args.get('answers_per_question', 1),
+                       bool(args.get('json')),
+                       _get_search_engine(), URL])
+
+
 def howdoi(args):
     """
 
     :param args - parameter with value.
     :return:
     """
+    return ''.join(howdoi_stream(args))
+
+
+def howdoi_stream(args):
+    """
+        Output of howdoi(args) in chunks, every answer is yielded as soon as it is ready.
+        When the network fails after some answers the failure message follows them.
+    :param args - parameter with value.
+    :return: iterator over text chunks
+    """
     # Przygotowanie query
+    from requests.exceptions import ConnectionError, SSLError, Timeout
     args['query'] = ' '.join(args['query']).replace('?', '')
+    # klucz liczony przed _iter_instructions, ktore zmienia args['pos']
+    cache_key = _get_answer_cache_key(args)
+    answer = _get_cached_answer(cache_key)
+    if answer is not None:
+        yield answer
+        return
+    chunks = []
+    try:
+        for chunk in _iter_instructions(args):
+            chunks.append(chunk)
+            yield chunk
+    except (ConnectionError, SSLError, Timeout):
+        yield NETWORK_ERROR_MSG
+        return
+    if not chunks:
+        yield _get_no_answers_message(args)
+        return
+    _set_cached_answer(cache_key, ''.join(chunks))
+
+
+def _get_cached_answer(cache_key):
+    """ Odpowiedz z cache odpowiedzi (albo odpowiedz na podobne zapytanie) lub None """
+    if answer_cache is None:
+        return None
+    with tracing.span('answer_cache') as attrs:
+        counter = 'hits'
+        answer = answer_cache.get(cache_key, count=False)
+        if answer is None:
+            answer = _get_similar_answer(cache_key)
+            counter = 'fuzzy_hits' if answer is not None else 'misses'
+        answer_cache.count(counter)
+        attrs['cache'] = 'hit' if answer is not None else 'miss'
+    return answer
+
+
+def _set_cached_answer(cache_key, answer):
+    """ Odpowiedz do cache odpowiedzi, slowa zapytania do indeksu podobnych zapytan """
+    if answer_cache is not None:
+        answer_cache.set(cache_key, answer, words=json.loads(cache_key)[0].split())
+
+
+def _get_no_answers_message(args):
+    return '[]\n' if args.get('json') else 'Sorry, couldn\'t find any help with that topic\n'
+
+
+def _iter_batch_queries(source):
+    """ Zapytania z pliku lub ze standardowego wejscia (-), jedno w linii. Puste linie sa pomijane. """
+    in_file = sys.stdin if source == '-' else open(source)
+    try:
+        for line in in_file:
+            query = line.strip()
+            if query:
+                yield query
+    finally:
+        if in_file is not sys.stdin:
+            in_file.close()
+
+
+def _answer_batch_query(item):
+    line, query, args = item
+    try:
+        answer = howdoi(dict(args, query=query.split()))
+    except Exception as e:
+        # blad jednego zapytania (np. strona ktorej parser nie rozumie) nie przerywa calego batcha
+        return {'line': line, 'query': query, 'answer': QUERY_ERROR_MSG,
+                'error': '{0}: {1}'.format(type(e).__name__, e)}
+    return {'line': line, 'query': query, 'answer': answer}
+
+
+def howdoi_batch(args, source, output, ordered=True):
+    """
+        Answer many queries with a pool of HOWDOI_MAX_WORKERS threads sharing one session and cache.
+        Every answer is written to output as one JSON line.
+    :param args: options used for every query (from get_parser())
+    :param source: file name with one query per line or - for standard input
+    :param output: text stream for the JSON lines
+    :param ordered: write answers in input order (True) or as soon as they are ready (False)
+    :return: number of answered queries
+    """
+    from multiprocessing.pool import ThreadPool
+    items = ((line, query, args) for line, query in enumerate(_iter_batch_queries(source), 1))
+    pool = ThreadPool(_get_max_workers())
+    count = 0
     try:
-        return _get_instructions(args) or 'Sorry, couldn\'t find any help with that topic\n'
-    except (ConnectionError, SSLError):
-        return 'Failed to establish network connection\n'
+        answers = pool.imap(_answer_batch_query, items) if ordered else \
+            pool.imap_unordered(_answer_batch_query, items)
+        for answer in answers:
+            output.write(json.dumps(answer) + '\n')
+            output.flush()
+            count += 1
+    finally:
+        pool.close()
+        pool.join()
+    return count
 
 
 def get_parser():
@@ -428,20 +1266,58 @@ def get_parser():
     parser.add_argument('-c', '--color', help='enable colorized output',
                         action='store_true')
     parser.add_argument('-n', '--num-answers', help='number of answers to return', default=1, type=int)
+    parser.add_argument('--answers-per-question', help='number of answers to take from each question (default: 1)',
+                        default=1, type=int, metavar='K')
+    parser.add_argument('-j', '--json', help='display answers as JSON records (link, question id, tags, answer, '
+                        'code blocks, position)', action='store_true')
     parser.add_argument('-C', '--clear-cache', help='clear the cache',
                         action='store_true')
     parser.add_argument('-v', '--version', help='displays the current version of howdoi',
                         action='store_true')
-    parser.add_argument('-s', '--stats', help='displays the filtering statistics of howdoi',
+    parser.add_argument('-s', '--stats', help='displays the cache statistics of howdoi',
                         action='store_true')
+    parser.add_argument('--compact-cache', help='remove expired cache entries and shrink the cache files',
+                        action='store_true')
+    parser.add_argument('--batch', help='answer queries from file (one per line, - for stdin) as JSON lines',
+                        metavar='FILE')
+    parser.add_argument('--batch-order', help='write batch answers in input order (default) or completion order',
+                        choices=['input', 'completion'], default='input')
+    parser.add_argument('--build-index', help='build offline index (HOWDOI_SEARCH_ENGINE=local) from Posts.xml '
+                        'of a Stack Exchange data dump', metavar='POSTS_XML')
+    parser.add_argument('--serve', help='run howdoi server which answers queries of other howdoi calls',
+                        action='store_true')
+    parser.add_argument('--trace', help='print time spent in every stage of the query to stderr',
+                        action='store_true')
+    parser.add_argument('--trace-output', help='write the timed spans of the query stages to file', metavar='FILE')
+    parser.add_argument('--trace-format', help='format of --trace-output: chrome trace events (default) or json',
+                        choices=['chrome', 'json'], default='chrome')
+    parser.add_argument('--profile', help='print the functions with the highest cumulative time (cProfile) to stderr',
+                        action='store_true')
+    # uzywane przez proces pobierajacy strony w tle (prefetch.py), QUERY to linki pytan
+    parser.add_argument('--prefetch-pages', help=argparse.SUPPRESS, action='store_true')
     return parser
 
 
+def _start_trace(args):
+    """ --trace, --trace-output i --profile: pomiar jest wypisywany / zapisywany przy wyjsciu z programu """
+    import atexit
+    if args['trace'] or args['trace_output']:
+        tracing.enable()
+        if args['trace_output']:
+            atexit.register(tracing.export, args['trace_output'], args['trace_format'])
+        if args['trace']:
+            atexit.register(tracing.report)
+    if args['profile']:
+        tracing.profile_start()
+        atexit.register(tracing.profile_report)
+
+
 def command_line_runner():
     # zwraca parser zaladowany ze wszystkimi opcjami
     parser = get_parser()
     # Aby pobrac wartosci ustawione przez uzytkownika trzeba uzyc vars. Mamy slownik argument -> nazwa
     args = vars(parser.parse_args())
+    _start_trace(args)
 
     # jezeli jest wersja
     if args['version']:
@@ -450,12 +1326,64 @@ def command_line_runner():
 
     # nazwa parametru jest atrybutem w obiekcie po parsowaniu. Po uzyciu vars jest kluczem w slowniku.
     if args['clear_cache']:
+        from .server import is_running
+        # serwer trzyma otwarte pliki cache, po ich usunieciu dalej uzywalby usunietych plikow
+        if is_running():
+            print('Stop the howdoi server (howdoi --serve) before clearing the cache', file=sys.stderr)
+            sys.exit(1)
         _clear_cache()
         print('Cache cleared successfully')
         return
 
     if args['stats']:
-        print("TBD")
+        print(_get_cache_stats())
+        return
+
+    if args['compact_cache']:
+        _compact_cache()
+        print('Cache compacted successfully')
+        return
+
+    if args['serve']:
+        if not os.getenv('HOWDOI_DISABLE_CACHE'):
+            _enable_cache()
+        from .server import serve
+        serve()
+        return
+
+    if args['build_index']:
+        from .local_index import build_index, get_index_file
+        questions, answers = build_index(args['build_index'])
+        print('Indexed {0} questions and {1} answers into {2}'.format(questions, answers, get_index_file()))
+        return
+
+    if args['prefetch_pages']:
+        if not os.getenv('HOWDOI_DISABLE_CACHE'):
+            _enable_cache()
+            from .prefetch import prefetch_pages
+            prefetch_pages(args['query'], max(1, args['answers_per_question']))
+        return
+
+    if args['batch']:
+        from . import workers
+        # pool processes are forked before the cache and the threads are created
+        workers.start()
+        if not os.getenv('HOWDOI_DISABLE_CACHE'):
+            _enable_cache()
+        if os.getenv('HOWDOI_PREFETCH'):
+            from . import prefetch
+            prefetch.in_process = True
+        if os.getenv('HOWDOI_COLORIZE'):
+            args['color'] = True
+        start = time.time()
+        try:
+            count = howdoi_batch(args, args['batch'], sys.stdout, ordered=args['batch_order'] == 'input')
+        finally:
+            workers.stop()
+        elapsed = time.time() - start
+        print('Answered {0} queries in {1:.2f}s ({2:.2f} queries/s)'.format(
+            count, elapsed, count / elapsed if elapsed else 0), file=sys.stderr)
+        get_session().close()
         return
 
     # Jezeli nie podaje sie query to wyswietlany jest help. Fajne jest to ze taki help jest generowany przez argparsera.
@@ -463,22 +1391,42 @@ def command_line_runner():
         parser.print_help()
         return
 
+    # kolorowanie uzaleznione od zmiennej systemowej
+    if os.getenv('HOWDOI_COLORIZE'):
+        args['color'] = True
+
+    # Jezeli dziala serwer (howdoi --serve) to on odpowiada na zapytanie, chyba ze mierzymy etapy zapytania
+    from .server import ServerError, query_server
+    response = None if tracing.is_enabled() or args['profile'] else query_server(args)
+    if response is not None:
+        try:
+            for chunk in response:
+                _write_output(chunk)
+        except ServerError as e:
+            print('[ERROR] howdoi server failed to answer the query: {0}'.format(e), file=sys.stderr)
+            sys.exit(1)
+        return
+
     # enable the cache if user doesn't want it to be disabled
     if not os.getenv('HOWDOI_DISABLE_CACHE'):
         _enable_cache()
 
-    # kolorowanie uzaleznione od zmiennej systemowej
-    if os.getenv('HOWDOI_COLORIZE'):
-        args['color'] = True
+    # kazda odpowiedz jest wypisywana gdy tylko jest gotowa
+    for chunk in howdoi_stream(args):
+        _write_output(chunk.encode('utf-8', 'ignore'))
+    if sys.version < '3':
+        print()
+    # close the session to release connection
+    get_session().close()
+
 
-    utf8_result = howdoi(args).encode('utf-8', 'ignore')
+def _write_output(utf8_text):
     if sys.version < '3':
-        print(utf8_result)
+        sys.stdout.write(utf8_text)
     else:
         # Write UTF-8 to stdout: https://stackoverflow.com/a/3603160
-        sys.stdout.buffer.write(utf8_result)
-    # close the session to release connection
-    howdoi_session.close()
+        sys.stdout.buffer.write(utf8_text)
+    sys.stdout.flush()
 
 
 if __name__ == '__main__':
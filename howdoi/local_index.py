@@ -0,0 +1,187 @@
+######################################################
+#
+# Offline index of a Stack Exchange data dump.
+#
+# `howdoi --build-index Posts.xml` stream-parses the dump (memory use does not
+# depend on its size) into a SQLite database with a full-text index of question
+# titles and tags and the top answers of every question. With
+# HOWDOI_SEARCH_ENGINE=local questions are searched in this index and the
+# question pages are rendered from it, so howdoi works without network.
+#
+# Environment variables used by index:
+#   HOWDOI_INDEX (default: <cache dir>/index.sqlite) - location of the index.
+#
+######################################################
+
+from __future__ import print_function
+
+import os
+import re
+import sqlite3
+import sys
+
+from . import howdoi as core
+
+# Answers kept for every question, ordered by score
+ANSWERS_PER_QUESTION = 5
+# Rows inserted in one executemany call
+BATCH_SIZE = 1000
+
+QUESTION_POST = '1'
+ANSWER_POST = '2'
+
+
+def get_index_file():
+    return os.getenv('HOWDOI_INDEX') or os.path.join(core.CACHE_DIR, 'index.sqlite')
+
+
+def _create_tables(connection):
+    connection.execute('CREATE TABLE questions (id INTEGER PRIMARY KEY, title TEXT, tags TEXT, score INTEGER)')
+    connection.execute('CREATE TABLE answers (id INTEGER PRIMARY KEY, question_id INTEGER, score INTEGER, '
+                       'body TEXT)')
+    connection.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+    # FTS5 ranks matches with bm25, FTS4 is used where SQLite is compiled without FTS5
+    for fts in ('fts5', 'fts4'):
+        try:
+            connection.execute('CREATE VIRTUAL TABLE questions_fts USING {0}(title, tags)'.format(fts))
+            break
+        except sqlite3.OperationalError:
+            continue
+    else:
+        raise RuntimeError('SQLite full-text search (FTS5 or FTS4) is not available')
+    connection.execute('INSERT INTO meta (name, value) VALUES (?, ?)', ('fts', fts))
+
+
+def _split_tags(tags):
+    """ Tags are stored in dumps as <python><django> or |python|django| """
+    return re.findall(r'[^<>|]+', tags or '')
+
+
+def _iter_posts(posts_file):
+    """ Rows of Posts.xml as dicts. Parsed rows are freed, so memory use stays flat. """
+    from lxml import etree
+    for _, row in etree.iterparse(posts_file, events=('end',), tag='row', huge_tree=True):
+        yield dict(row.attrib)
+        row.clear()
+        while row.getprevious() is not None:
+            del row.getparent()[0]
+
+
+def _flush(connection, questions, answers):
+    connection.executemany('INSERT OR REPLACE INTO questions (id, title, tags, score) VALUES (?, ?, ?, ?)',
+                           questions)
+    connection.executemany('INSERT INTO questions_fts (rowid, title, tags) VALUES (?, ?, ?)',
+                           [(question[0], question[1], question[2]) for question in questions])
+    connection.executemany('INSERT OR REPLACE INTO answers (id, question_id, score, body) VALUES (?, ?, ?, ?)',
+                           answers)
+    del questions[:]
+    del answers[:]
+
+
+def build_index(posts_file, index_file=None, answers_per_question=ANSWERS_PER_QUESTION):
+    """
+        Build the index from Posts.xml of a Stack Exchange data dump.
+    :param posts_file: path to Posts.xml
+    :param index_file: path of the index, existing one is replaced
+    :param answers_per_question: number of the best answers kept for every question
+    :return: (number of questions, number of answers) in the index
+    """
+    index_file = index_file or get_index_file()
+    directory = os.path.dirname(index_file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    temp_file = index_file + '.tmp'
+    if os.path.exists(temp_file):
+        os.remove(temp_file)
+
+    connection = sqlite3.connect(temp_file)
+    try:
+        _create_tables(connection)
+        questions, answers = [], []
+        for post in _iter_posts(posts_file):
+            if post.get('PostTypeId') == QUESTION_POST:
+                questions.append((int(post['Id']), post.get('Title', ''), ' '.join(_split_tags(post.get('Tags'))),
+                                  int(post.get('Score', 0))))
+            elif post.get('PostTypeId') == ANSWER_POST and post.get('ParentId'):
+                answers.append((int(post['Id']), int(post['ParentId']), int(post.get('Score', 0)),
+                                post.get('Body', '')))
+            if len(questions) + len(answers) >= BATCH_SIZE:
+                _flush(connection, questions, answers)
+        _flush(connection, questions, answers)
+
+        connection.execute('CREATE INDEX answers_question ON answers (question_id, score)')
+        # only the best answers of existing questions are kept
+        connection.execute('DELETE FROM answers WHERE question_id NOT IN (SELECT id FROM questions)')
+        connection.execute('DELETE FROM answers WHERE (SELECT COUNT(*) FROM answers AS better '
+                           'WHERE better.question_id = answers.question_id AND (better.score > answers.score OR '
+                           '(better.score = answers.score AND better.id < answers.id))) >= ?',
+                           (answers_per_question,))
+        connection.commit()
+        counts = (connection.execute('SELECT COUNT(*) FROM questions').fetchone()[0],
+                  connection.execute('SELECT COUNT(*) FROM answers').fetchone()[0])
+        connection.execute('VACUUM')
+    finally:
+        connection.close()
+    os.rename(temp_file, index_file)
+    return counts
+
+
+def _connect(index_file=None):
+    return sqlite3.connect(index_file or get_index_file())
+
+
+def _slugify(title):
+    return re.sub(r'[^a-z0-9]+', '-', title.lower()).strip('-')
+
+
+def search(query, limit=10, index_file=None):
+    """
+        Search questions matching all words of the query, or any of them if none matches all.
+    :return: list of question links
+    """
+    words = re.findall(r'\w+', query.lower())
+    if not words:
+        return []
+    if not os.path.exists(index_file or get_index_file()):
+        print('[ERROR] howdoi index {0} does not exist. Build it with howdoi --build-index '
+              'Posts.xml.'.format(index_file or get_index_file()), file=sys.stderr)
+        return []
+    connection = _connect(index_file)
+    try:
+        fts = connection.execute("SELECT value FROM meta WHERE name = 'fts'").fetchone()[0]
+        order = 'questions_fts.rank' if fts == 'fts5' else 'questions.score DESC'
+        rows = []
+        for operator in (' ', ' OR '):
+            match = operator.join('"{0}"'.format(word) for word in words)
+            rows = connection.execute(
+                'SELECT questions.id, questions.title FROM questions_fts '
+                'JOIN questions ON questions.id = questions_fts.rowid '
+                'WHERE questions_fts MATCH ? ORDER BY {0} LIMIT ?'.format(order), (match, limit)).fetchall()
+            if rows:
+                break
+    finally:
+        connection.close()
+    return ['{0}{1}/questions/{2}/{3}'.format(core.SCHEME, core.URL, question_id, _slugify(title))
+            for question_id, title in rows]
+
+
+def fetch_question_pages(links, index_file=None):
+    """
+        Question pages rendered from the index.
+    :param links: question links
+    :return: dict link -> page, links of questions missing in the index are left out
+    """
+    connection = _connect(index_file)
+    pages = {}
+    try:
+        for link in links:
+            question_id = core._get_question_id(link)
+            question = connection.execute('SELECT tags FROM questions WHERE id = ?', (question_id,)).fetchone()
+            if question is None:
+                continue
+            answers = [{'answer_id': answer_id, 'body': body} for answer_id, body in connection.execute(
+                'SELECT id, body FROM answers WHERE question_id = ? ORDER BY score DESC, id', (question_id,))]
+            pages[link] = core._render_question_page(question[0].split(), answers)
+    finally:
+        connection.close()
+    return pages
@@ -0,0 +1,133 @@
+######################################################
+#
+# Predictive prefetch of the next question pages.
+#
+# After answering the questions at positions up to N, the pages of the
+# questions at N+1 ... N+K are downloaded into the page cache, so a follow-up
+# `howdoi -p N+1 ...` (its links come from the link cache) is answered without
+# waiting for the network. In a long running process (howdoi --serve, --batch)
+# the pages are downloaded by a daemon thread; a command line run starts a
+# detached `howdoi --prefetch-pages LINK...` process and exits right away.
+#
+# Only scraped pages are prefetched: answers of the Stack Exchange API backend
+# and of the offline index are not stored in the page cache.
+#
+# Environment variables used by prefetch:
+#   HOWDOI_PREFETCH (default: 0 - off) - number of next question pages to prefetch.
+#
+######################################################
+
+import os
+import subprocess
+import sys
+import threading
+
+from . import howdoi as core
+
+# Long running process: prefetch in a thread instead of a detached process (set by server and batch mode)
+in_process = False
+
+_lock = threading.Lock()
+# links being prefetched by threads of this process
+_pending = set()
+
+
+def get_prefetch_count():
+    return max(0, core._get_int_env('HOWDOI_PREFETCH', 0))
+
+
+def get_next_links(question_links, next_position, count):
+    """ Links of the questions at next_position ... next_position + count - 1 which exist """
+    start = max(0, next_position - 1)
+    return question_links[start:start + count]
+
+
+def prefetch(question_links, next_position, answers=1):
+    """
+        Start downloading the pages of the next HOWDOI_PREFETCH questions into the page cache.
+    :param question_links: ranked question links of the query
+    :param next_position: position of the first question which was not answered
+    :param answers: answers needed from every page (--answers-per-question)
+    :return: list of links which are prefetched
+    """
+    count = get_prefetch_count()
+    if not count or core.page_cache is None or core._get_search_engine() == 'local' or \
+            core._get_answer_backend() == 'api':
+        return []
+    links = [link for link in get_next_links(question_links, next_position, count)
+             if not core._is_question_page_cached(link, answers)]
+    if not links:
+        return []
+    if in_process:
+        with _lock:
+            links = [link for link in links if link not in _pending]
+            _pending.update(links)
+        if links:
+            thread = threading.Thread(target=_prefetch_in_thread, args=(links, answers))
+            thread.daemon = True
+            thread.start()
+    else:
+        _start_process(links, answers)
+    return links
+
+
+def _prefetch_in_thread(links, answers):
+    try:
+        prefetch_pages(links, answers)
+    finally:
+        with _lock:
+            _pending.difference_update(links)
+
+
+def prefetch_pages(links, answers=1):
+    """
+        Download the pages into the page cache, pages already there are skipped.
+    :return: number of pages stored in the page cache
+    """
+    from requests.exceptions import RequestException
+    links = [link for link in links if not core._is_question_page_cached(link, answers)]
+    try:
+        core._fetch_question_pages(links, answers)
+    except RequestException:
+        # prefetch is only a guess, a failed download is tried again by the query which needs the page
+        return 0
+    # pages which were not stored (not 200) are not prefetched
+    stored = [link for link in links if core._is_question_page_cached(link, answers)]
+    for _ in stored:
+        core.page_cache.count('prefetched')
+    return len(stored)
+
+
+def _is_on_child_path(directory):
+    """
+        The directory is on sys.path of the detached process. It has the paths of this process
+        (same interpreter and environment), except sys.path[0], which is the current directory with -c.
+    """
+    paths = [os.getcwd()] + sys.path[1:]
+    return os.path.abspath(directory) in [os.path.abspath(path) for path in paths]
+
+
+def _start_process(links, answers):
+    """ Detached howdoi process downloading the pages, it outlives this one """
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    if not _is_on_child_path(package_dir):
+        # appended, so the paths of the user and the standard library keep their order
+        env['PYTHONPATH'] = os.pathsep.join([path for path in [env.get('PYTHONPATH')] if path] + [package_dir])
+    # as the howdoi script does; with -m howdoi.howdoi this module would see another copy of howdoi (__main__)
+    command = [sys.executable, '-c', 'from howdoi.howdoi import command_line_runner; command_line_runner()',
+               '--prefetch-pages', '--answers-per-question', str(answers)] + list(links)
+    kwargs = {}
+    if os.name == 'nt':
+        # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+        kwargs['creationflags'] = 0x00000008 | 0x00000200
+    elif sys.version_info[0] >= 3:
+        kwargs['start_new_session'] = True
+    else:
+        # preexec_fn is not safe with threads, Python 2 has no other way to call setsid
+        kwargs['preexec_fn'] = os.setsid
+    devnull = open(os.devnull, 'r+b')
+    try:
+        subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True, env=env, **kwargs)
+    finally:
+        devnull.close()
@@ -0,0 +1,240 @@
+######################################################
+#
+# howdoi server - keeps howdoi warm between queries
+#
+# `howdoi --serve` listens on a Unix socket and answers queries with the
+# already opened HTTP session, installed cache and loaded pyquery/pygments
+# modules. The command line client forwards its parsed arguments to the
+# server when the socket exists and falls back to a local run otherwise.
+#
+# The client sends its HOWDOI_* environment variables with the arguments. The
+# server answers only when they are the same as its own (they select the site,
+# search engine, backend, cache, ...), otherwise the client answers the query
+# itself.
+#
+# Environment variables used by server:
+#   HOWDOI_SOCKET (default: <cache dir>/howdoi.sock) - path of the Unix socket.
+#
+######################################################
+
+import json
+import os
+import signal
+import socket
+import sys
+import traceback
+
+from . import howdoi as core
+
+if sys.version < '3':
+    import SocketServer as socketserver
+else:
+    import socketserver
+
+# Size of the chunks read from the socket by the client
+CHUNK_SIZE = 4096
+# First line of the response: the server answers or the client runs the query itself
+STATUS_OK = b'ok\n'
+STATUS_ENVIRONMENT = b'environment differs\n'
+# Written after the part of the answer sent when the query fails, followed by the error; the UTF-8 text of
+# answers never contains this byte
+ERROR_MARKER = b'\xff'
+# Variables which do not change the answer: the socket is chosen by the client, colors are in the arguments
+CLIENT_VARIABLES = ('HOWDOI_SOCKET', 'HOWDOI_COLORIZE')
+
+
+class ServerError(Exception):
+    """ The query failed on the server after a part of the answer was sent """
+
+
+def get_socket_file():
+    return os.getenv('HOWDOI_SOCKET') or os.path.join(core.CACHE_DIR, 'howdoi.sock')
+
+
+def get_environment():
+    """ HOWDOI_* variables which change the answers """
+    return dict((name, value) for name, value in os.environ.items()
+                if name.startswith('HOWDOI_') and name not in CLIENT_VARIABLES)
+
+
+class HowdoiRequestHandler(socketserver.StreamRequestHandler):
+    """
+        One request is one line with JSON encoded arguments from get_parser() (args) and the HOWDOI_* environment
+        of the client (env). The response starts with a status line, then the answer is written as UTF-8, answer
+        by answer, and the connection is closed. When the query fails, ERROR_MARKER and the error follow the part
+        of the answer already written.
+    """
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+            args, environment = request['args'], request['env']
+        except (ValueError, KeyError, TypeError):
+            return
+        # os.environ is shared by the threads of the server, it is not changed per request
+        if environment != get_environment():
+            self.wfile.write(STATUS_ENVIRONMENT)
+            return
+        self.wfile.write(STATUS_OK)
+        chunks = core.howdoi_stream(args)
+        while True:
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                return
+            except Exception as e:
+                # network errors are answered by howdoi_stream, anything else is a bug worth a traceback
+                traceback.print_exc()
+                self.wfile.write(ERROR_MARKER + '{0}: {1}'.format(type(e).__name__, e).encode('utf-8', 'replace'))
+                return
+            self.wfile.write(chunk.encode('utf-8', 'ignore'))
+            self.wfile.flush()
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class HowdoiServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+else:
+    HowdoiServer = None
+
+
+def is_running(socket_file=None):
+    """ Check if some server already accepts connections on the socket """
+    socket_file = socket_file or get_socket_file()
+    return hasattr(socket, 'AF_UNIX') and os.path.exists(socket_file) and _is_running(socket_file)
+
+
+def _is_running(socket_file):
+    """ Check if some server already accepts connections on the socket """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_file)
+        return True
+    except socket.error:
+        return False
+    finally:
+        client.close()
+
+
+def _warm_up():
+    """ Load the parsing and highlighting modules before the first query arrives """
+    from pyquery import PyQuery as pq
+    from pygments.lexers import get_lexer_by_name
+    from .extract import parse
+    pq('<p></p>')
+    parse('<p></p>')
+    get_lexer_by_name('python')
+
+
+def make_server(socket_file=None):
+    """
+        Create the server bound to the socket. Stale socket left by a killed server is removed.
+    :param socket_file: path of the Unix socket
+    :return: HowdoiServer
+    """
+    if HowdoiServer is None:
+        raise RuntimeError('howdoi server requires Unix domain sockets')
+    socket_file = socket_file or get_socket_file()
+    if os.path.exists(socket_file):
+        if _is_running(socket_file):
+            raise RuntimeError('howdoi server is already running on {0}'.format(socket_file))
+        os.remove(socket_file)
+    directory = os.path.dirname(socket_file)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    server = HowdoiServer(socket_file, HowdoiRequestHandler)
+    os.chmod(socket_file, 0o600)
+    return server
+
+
+def serve(socket_file=None):
+    """ Run the server until interrupted """
+    from . import prefetch, workers
+    server = make_server(socket_file)
+    _warm_up()
+    # after the warm up the pool processes start with the parser and lexers imported
+    workers.start()
+    # the server outlives the queries, next question pages are prefetched by its threads
+    prefetch.in_process = True
+    # remove the socket also when the server is stopped with kill
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('howdoi server listening on {0}'.format(server.server_address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        workers.stop()
+        if os.path.exists(server.server_address):
+            os.remove(server.server_address)
+
+
+def _read_status(client):
+    """ Status line of the response and the part of the answer received with it """
+    data = b''
+    while b'\n' not in data:
+        chunk = client.recv(CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    status, _, rest = data.partition(b'\n')
+    return status + b'\n', rest
+
+
+def _iter_chunks(client, first_chunk):
+    if first_chunk:
+        yield first_chunk
+    while True:
+        chunk = client.recv(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _iter_response(client, first_chunk):
+    """ Chunks of the answer, ServerError after them when the server sent an error (ERROR_MARKER) """
+    error = None
+    try:
+        for chunk in _iter_chunks(client, first_chunk):
+            if error is not None:
+                error += chunk
+                continue
+            chunk, marker, error_part = chunk.partition(ERROR_MARKER)
+            if chunk:
+                yield chunk
+            if marker:
+                error = error_part
+    finally:
+        client.close()
+    if error is not None:
+        raise ServerError(error.decode('utf-8', 'replace'))
+
+
+def query_server(args, socket_file=None):
+    """
+        Forward the arguments to a running server.
+    :param args: parsed arguments (dict) from get_parser()
+    :param socket_file: path of the Unix socket
+    :return: iterator over UTF-8 encoded chunks of the answer or None when no server is running or its
+             environment differs; the iterator raises ServerError when the query failed on the server
+    """
+    socket_file = socket_file or get_socket_file()
+    if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_file):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_file)
+    except socket.error:
+        client.close()
+        return None
+    try:
+        client.sendall((json.dumps({'args': args, 'env': get_environment()}) + '\n').encode('utf-8'))
+        status, first_chunk = _read_status(client)
+    except socket.error:
+        client.close()
+        return None
+    if status != STATUS_OK:
+        client.close()
+        return None
+    return _iter_response(client, first_chunk)
@@ -0,0 +1,69 @@
+######################################################
+#
+# Stack Exchange API answer backend.
+#
+# Instead of downloading every rendered question page, the answers of all
+# questions are fetched with one batched API call (ids separated with ;,
+# filter=withbody, sorted by votes) and the tags with a second one. For every
+# question a small page with the same markup as Stack Overflow (.post-tag,
+# .answer, .post-text) is built, so it is parsed by the same code as scraped
+# pages. Questions missing in the API response are scraped as before.
+#
+# Environment variables used by backend:
+#   HOWDOI_API_URL (default: https://api.stackexchange.com/2.2) - API location.
+#   HOWDOI_API_KEY - optional application key, raises the request quota.
+#
+######################################################
+
+import json
+import os
+import sys
+
+from . import howdoi as core
+
+if sys.version < '3':
+    from urllib import urlencode
+else:
+    from urllib.parse import urlencode
+
+API_URL = os.getenv('HOWDOI_API_URL') or 'https://api.stackexchange.com/2.2'
+# Max number of ids and items in one API request
+PAGE_SIZE = 100
+
+
+def _get_items(path, **params):
+    """ Items of the API response, empty list if the API returned an error """
+    params.update({'site': core.URL, 'pagesize': PAGE_SIZE})
+    if os.getenv('HOWDOI_API_KEY'):
+        params['key'] = os.getenv('HOWDOI_API_KEY')
+    url = '{0}/{1}?{2}'.format(API_URL, path, urlencode(sorted(params.items())))
+    return json.loads(core._get_result(url)).get('items', [])
+
+
+def fetch_question_pages(links):
+    """
+        Fetch answers of all questions with batched API requests.
+    :param links: question links
+    :return: dict link -> page, links without answers in the API response are left out
+    """
+    links_by_id = {}
+    for link in links:
+        question_id = core._get_question_id(link)
+        if question_id:
+            links_by_id.setdefault(question_id, []).append(link)
+    if not links_by_id:
+        return {}
+
+    ids = ';'.join(str(question_id) for question_id in sorted(links_by_id)[:PAGE_SIZE])
+    answers_by_id = {}
+    for answer in _get_items('questions/{0}/answers'.format(ids), order='desc', sort='votes', filter='withbody'):
+        answers_by_id.setdefault(answer['question_id'], []).append(answer)
+    tags_by_id = dict((question['question_id'], question.get('tags', []))
+                      for question in _get_items('questions/{0}'.format(ids)))
+
+    pages = {}
+    for question_id, answers in answers_by_id.items():
+        page = core._render_question_page(tags_by_id.get(question_id, []), answers)
+        for link in links_by_id.get(question_id, []):
+            pages[link] = page
+    return pages
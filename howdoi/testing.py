@@ -0,0 +1,74 @@
+######################################################
+#
+# Local HTTP server standing in for the search engine and Stack Overflow.
+#
+# Used by test_howdoi.py and the benchmarks, which serve the search page and
+# question pages from it instead of the network. Not used by howdoi itself.
+#
+######################################################
+
+import socket
+import sys
+import threading
+import time
+
+if sys.version < '3':
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+else:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubServer(object):
+    """
+        Local HTTP server answering GET requests from dict path -> (status, body) or (status, body, delay).
+        A list of responses is answered in order, the last one is repeated.
+    """
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.requested = []
+        self.user_agents = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive connections
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub.requested.append(self.path)
+                stub.user_agents.append(self.headers.get('User-Agent'))
+                route = stub.routes.get(self.path.split('?')[0], (404, ''))
+                if isinstance(route, list):
+                    route = route.pop(0) if len(route) > 1 else route[0]
+                status, body = route[:2]
+                if len(route) > 2:
+                    time.sleep(route[2])
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except socket.error:
+                    # client stopped reading
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
@@ -0,0 +1,235 @@
+######################################################
+#
+# Timed spans of the query stages (howdoi --trace).
+#
+# Functions decorated with @traced and blocks in span() are recorded with their
+# start, duration, thread and attributes such as cache hit/miss or downloaded
+# bytes (added with annotate()). Spans are recorded only after enable(), when
+# tracing is off a decorated function costs one extra call.
+#
+# report() prints the time spent in every stage, export() writes the spans as
+# JSON or in the Chrome trace event format (chrome://tracing, Perfetto).
+# profile_start() and profile_report() run cProfile over the query (--profile).
+#
+######################################################
+
+from __future__ import print_function
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+# wall clock with the best resolution (time.perf_counter is Python 3 only)
+_clock = getattr(time, 'perf_counter', time.time)
+
+_enabled = False
+_started = None
+_lock = threading.Lock()
+_spans = []
+_local = threading.local()
+_profiler = None
+
+
+def enable():
+    """ Start recording spans, spans recorded before are dropped """
+    global _enabled, _started
+    with _lock:
+        del _spans[:]
+        _started = _clock()
+        _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def get_spans():
+    """
+        Finished spans, ordered by start.
+    :return: list of dicts with name, path (names of the enclosing spans and the span), start and duration
+             (seconds since enable()), thread and attrs
+    """
+    with _lock:
+        return sorted(_spans, key=lambda recorded: recorded['start'])
+
+
+def _get_stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class _Span(object):
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.stack = None
+        self.path = None
+        self.start = None
+
+    def __enter__(self):
+        self.stack = _get_stack()
+        self.path = (self.stack[-1].path if self.stack else ()) + (self.name,)
+        self.stack.append(self)
+        self.start = _clock()
+        return self.attrs
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = _clock()
+        # the span can end in another thread than it started in (generators), it leaves its own stack
+        if self in self.stack:
+            self.stack.remove(self)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        with _lock:
+            if _started is not None:
+                _spans.append({'name': self.name, 'path': self.path, 'start': self.start - _started,
+                               'duration': end - self.start, 'thread': threading.current_thread().name,
+                               'attrs': self.attrs})
+        return False
+
+
+class _NoSpan(object):
+
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def span(name, **attrs):
+    """
+        Context manager recording the block as span, it returns the dict of attributes of the span.
+    :param name: stage name
+    :param attrs: attributes of the span
+    """
+    if not _enabled:
+        return _no_span
+    return _Span(name, attrs)
+
+
+def traced(name):
+    """ Decorator recording every call of the function as span """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attrs):
+    """ Add attributes to the innermost span of the current thread """
+    if not _enabled:
+        return
+    stack = _get_stack()
+    if stack:
+        stack[-1].attrs.update(attrs)
+
+
+def get_breakdown(spans=None):
+    """
+        Time spent in every stage, a stage is a span name with the names of the enclosing spans
+        (the same function called directly and from another stage are two stages).
+    :return: list of dicts with path, calls, total and max (seconds), hits, misses and bytes; stages are
+             ordered as a tree, enclosed stages follow their parent, siblings in order of the first start
+    """
+    stages = {}
+    for recorded in spans if spans is not None else get_spans():
+        path = tuple(recorded['path'])
+        stage = stages.get(path)
+        if stage is None:
+            stage = stages[path] = {'path': path, 'first': recorded['start'], 'calls': 0, 'total': 0, 'max': 0,
+                                    'hits': 0, 'misses': 0, 'bytes': 0}
+        stage['calls'] += 1
+        stage['total'] += recorded['duration']
+        stage['max'] = max(stage['max'], recorded['duration'])
+        cache = recorded['attrs'].get('cache')
+        if cache == 'hit':
+            stage['hits'] += 1
+        elif cache == 'miss':
+            stage['misses'] += 1
+        stage['bytes'] += recorded['attrs'].get('bytes') or 0
+
+    def tree_order(stage):
+        path = stage['path']
+        return [stages[path[:index]]['first'] if path[:index] in stages else 0 for index in range(1, len(path) + 1)]
+    return sorted(stages.values(), key=tree_order)
+
+
+def report(out=None):
+    """ Print the time spent in every stage, nested stages are indented """
+    out = out or sys.stderr
+    breakdown = get_breakdown()
+    wall = (_clock() - _started) if _started is not None else 0
+    print('Trace: {0:.1f} ms wall time, {1} spans (stages in parallel threads can sum up over the wall time)'.format(
+        wall * 1000, sum(stage['calls'] for stage in breakdown)), file=out)
+    print('{0:<24}{1:>7}{2:>12}{3:>10}  {4}'.format('stage', 'calls', 'total ms', 'max ms', 'cache, bytes'), file=out)
+    for stage in breakdown:
+        details = []
+        if stage['hits'] or stage['misses']:
+            details.append('{0} hit / {1} miss'.format(stage['hits'], stage['misses']))
+        if stage['bytes']:
+            details.append('{0} bytes'.format(stage['bytes']))
+        name = '  ' * (len(stage['path']) - 1) + stage['path'][-1]
+        print('{0:<24}{1:>7}{2:>12.1f}{3:>10.1f}  {4}'.format(
+            name, stage['calls'], stage['total'] * 1000, stage['max'] * 1000, ', '.join(details)), file=out)
+
+
+def export(path, trace_format='chrome'):
+    """
+        Write the spans to file.
+    :param trace_format: chrome (trace event format with complete events) or json (list of spans)
+    """
+    spans = get_spans()
+    if trace_format == 'chrome':
+        threads = {}
+        events = []
+        for recorded in spans:
+            thread_id = threads.setdefault(recorded['thread'], len(threads) + 1)
+            events.append({'name': recorded['name'], 'cat': 'howdoi', 'ph': 'X', 'pid': os.getpid(),
+                           'tid': thread_id, 'ts': round(recorded['start'] * 1e6, 1),
+                           'dur': round(recorded['duration'] * 1e6, 1), 'args': recorded['attrs']})
+        for name, thread_id in threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread_id,
+                           'args': {'name': name}})
+        data = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    else:
+        data = spans
+    with open(path, 'w') as out_file:
+        json.dump(data, out_file, indent=1, default=str)
+
+
+def profile_start():
+    """ Start cProfile for profile_report() """
+    global _profiler
+    import cProfile
+    _profiler = cProfile.Profile()
+    _profiler.enable()
+
+
+def profile_report(out=None, limit=30):
+    """ Print limit functions with the highest cumulative time since profile_start() """
+    if _profiler is None:
+        return
+    _profiler.disable()
+    import pstats
+    stats = pstats.Stats(_profiler, stream=out or sys.stderr)
+    stats.sort_stats('cumulative').print_stats(limit)
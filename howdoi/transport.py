@@ -0,0 +1,444 @@
+######################################################
+#
+# HTTP transport of howdoi.
+#
+# One session is shared by all requests of the process (search, question pages,
+# API calls, the threads of -n, --batch and the server). Its connection pool is
+# sized for the parallel downloads, the proxies and the user agent are resolved
+# once when it is created and the connections are kept alive between requests.
+# With HOWDOI_HTTP2 the session is an httpx client speaking HTTP/2, so the search
+# and all question pages of one host are multiplexed over a single connection.
+#
+# Every request records its timings (connect, tls, wait for the first byte,
+# transfer of the body) on response.timings and in recent_timings.
+#
+# fetch() bounds the time of one request: connect and read timeouts, retries of
+# failed connections and 429/5xx responses after a jittered exponential backoff
+# and, optionally, a hedged duplicate request sent when the first one is slower
+# than usual (p95 of the recent requests). The worst case of a fetch is
+# (HOWDOI_RETRIES + 1) attempts of connect + read timeout plus the backoffs.
+#
+# Environment variables used by transport:
+#   HOWDOI_POOL_SIZE (default: 10) - number of hosts with a pool of kept-alive connections.
+#   HOWDOI_MAX_CONNECTIONS (default: HOWDOI_MAX_WORKERS squared) - connections kept alive per host.
+#       In --batch every one of HOWDOI_MAX_WORKERS queries downloads up to HOWDOI_MAX_WORKERS pages.
+#   HOWDOI_HTTP2 (default: ) - use HTTP/2 (requires httpx with h2: pip install httpx[http2]).
+#   HOWDOI_TIMINGS (default: ) - print the timings of every request to stderr.
+#   HOWDOI_CONNECT_TIMEOUT (default: 5) - seconds to establish connection.
+#   HOWDOI_READ_TIMEOUT (default: 10) - seconds to wait for the server between received bytes.
+#   HOWDOI_RETRIES (default: 2) - retries of failed connections and 429/5xx responses.
+#   HOWDOI_RETRY_BACKOFF (default: 0.5) - base of the exponential backoff in seconds, capped at 10s.
+#   HOWDOI_HEDGE (default: ) - send duplicate request if there is no response after this many seconds,
+#       or after p95 of the recent request times with `auto`.
+#
+######################################################
+
+from __future__ import print_function
+
+import collections
+import os
+import random
+import sys
+import threading
+import time
+
+from . import howdoi as core
+
+if sys.version < '3':
+    from Queue import Empty, Queue
+else:
+    from queue import Empty, Queue
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 10.0
+DEFAULT_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 10.0
+# Responses which are worth repeating: throttling and server errors
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# Hedge delay with HOWDOI_HEDGE=auto until enough requests were timed
+DEFAULT_HEDGE_DELAY = 1.0
+HEDGE_MIN_SAMPLES = 5
+# Number of requests whose timings are kept in recent_timings
+TIMINGS_HISTORY = 100
+
+# Timings of the last requests, newest at the end
+recent_timings = collections.deque(maxlen=TIMINGS_HISTORY)
+# timings of the request running in the current thread, filled by the connection classes
+_current = threading.local()
+
+
+def get_pool_size():
+    return core._get_int_env('HOWDOI_POOL_SIZE', DEFAULT_POOL_SIZE)
+
+
+def get_max_connections():
+    # a pool keeps only the connections which were used, a single query does not open more of them
+    return core._get_int_env('HOWDOI_MAX_CONNECTIONS', core._get_max_workers() ** 2)
+
+
+def _get_float_env(name, default):
+    """ Float value of environment variable or default if not set or invalid """
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        return default
+
+
+def get_timeout():
+    """ (connect, read) timeout in seconds """
+    return (_get_float_env('HOWDOI_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+            _get_float_env('HOWDOI_READ_TIMEOUT', DEFAULT_READ_TIMEOUT))
+
+
+def get_hedge_delay():
+    """ Seconds after which duplicate request is sent or None when hedging is disabled """
+    hedge = os.getenv('HOWDOI_HEDGE')
+    if not hedge:
+        return None
+    if hedge == 'auto':
+        totals = sorted(timings['total'] for timings in list(recent_timings))
+        if len(totals) < HEDGE_MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        return totals[int(len(totals) * 0.95) - 1]
+    delay = _get_float_env('HOWDOI_HEDGE', None)
+    return delay if delay and delay > 0 else None
+
+
+def _get_verify():
+    """ Certificate bundle from the environment is used, as the environment is not read per request """
+    if not core.VERIFY_SSL_CERTIFICATE:
+        return False
+    return os.getenv('REQUESTS_CA_BUNDLE') or os.getenv('CURL_CA_BUNDLE') or True
+
+
+def get_httpx_verify():
+    """ _get_verify() for httpx clients, which take a SSL context instead of a path to certificates """
+    verify = _get_verify()
+    if verify is True or verify is False:
+        return verify
+    import ssl
+    if os.path.isdir(verify):
+        return ssl.create_default_context(capath=verify)
+    return ssl.create_default_context(cafile=verify)
+
+
+def _add_timing(name, seconds):
+    timings = getattr(_current, 'timings', None)
+    if timings is not None:
+        timings[name] = timings.get(name, 0) + seconds
+
+
+def _record(url, timings, start, headers_time, end):
+    """ Complete timings of one request, connect and tls are zero when a kept-alive connection was reused """
+    timings.setdefault('connect', 0)
+    timings.setdefault('tls', 0)
+    timings['reused'] = not (timings['connect'] or timings['tls'])
+    timings['wait'] = max(headers_time - start - timings['connect'] - timings['tls'], 0)
+    timings['transfer'] = end - headers_time
+    timings['total'] = end - start
+    timings['url'] = url
+    recent_timings.append(timings)
+    if os.getenv('HOWDOI_TIMINGS'):
+        print('[TIMING] {0} connect={1:.3f}s tls={2:.3f}s wait={3:.3f}s transfer={4:.3f}s total={5:.3f}s{6}'.format(
+            url, timings['connect'], timings['tls'], timings['wait'], timings['transfer'], timings['total'],
+            ' (reused connection)' if timings['reused'] else ''), file=sys.stderr)
+
+
+def _create_requests_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    class TimedHTTPConnection(HTTPConnection):
+        def _new_conn(self):
+            start = time.time()
+            connection = super(TimedHTTPConnection, self)._new_conn()
+            _add_timing('connect', time.time() - start)
+            return connection
+
+    class TimedHTTPSConnection(HTTPSConnection):
+        def _new_conn(self):
+            start = time.time()
+            connection = super(TimedHTTPSConnection, self)._new_conn()
+            _add_timing('connect', time.time() - start)
+            return connection
+
+        def connect(self):
+            # TCP connect is timed by _new_conn, the rest is the TLS handshake
+            start = time.time()
+            connect_before = (getattr(_current, 'timings', None) or {}).get('connect', 0)
+            super(TimedHTTPSConnection, self).connect()
+            connect = (getattr(_current, 'timings', None) or {}).get('connect', 0) - connect_before
+            _add_timing('tls', max(time.time() - start - connect, 0))
+
+    class TimedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    pool_classes = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+    class TimedHTTPAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super(TimedHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = pool_classes
+
+        def proxy_manager_for(self, *args, **kwargs):
+            manager = super(TimedHTTPAdapter, self).proxy_manager_for(*args, **kwargs)
+            manager.pool_classes_by_scheme = pool_classes
+            return manager
+
+    class TimedSession(requests.Session):
+        def request(self, method, url, **kwargs):
+            _current.timings = {}
+            start = time.time()
+            try:
+                stream = kwargs.pop('stream', False)
+                response = super(TimedSession, self).request(method, url, stream=True, **kwargs)
+                headers_time = time.time()
+                if not stream:
+                    response.content
+                response.timings = _current.timings
+                _record(url, _current.timings, start, headers_time, time.time())
+            finally:
+                _current.timings = None
+            return response
+
+    session = TimedSession()
+    adapter = TimedHTTPAdapter(pool_connections=get_pool_size(), pool_maxsize=get_max_connections())
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # proxies and certificates are taken from the environment once, not on every request
+    session.trust_env = False
+    session.proxies = core.get_proxies()
+    session.verify = _get_verify()
+    session.headers['User-Agent'] = random.choice(core.USER_AGENTS)
+    return session
+
+
+def get_httpx_trace(timings):
+    """ httpx trace extension adding connect and tls time to timings """
+    started = {}
+
+    def trace(event, info):
+        if event.endswith('.started'):
+            started[event[:-len('.started')]] = time.time()
+        elif event.endswith('.complete'):
+            name = event[:-len('.complete')]
+            if name in ('connection.connect_tcp', 'connection.start_tls') and name in started:
+                key = 'connect' if name == 'connection.connect_tcp' else 'tls'
+                timings[key] = timings.get(key, 0) + time.time() - started[name]
+    return trace
+
+
+def map_httpx_error(error):
+    """ requests exception for httpx TransportError, so callers handle both clients the same way """
+    import httpx
+    import requests
+    if isinstance(error, httpx.TimeoutException):
+        return requests.exceptions.Timeout(str(error))
+    if 'SSL' in str(error) or 'CERTIFICATE' in str(error):
+        return requests.exceptions.SSLError(str(error))
+    return requests.exceptions.ConnectionError(str(error))
+
+
+def has_http2():
+    """ httpx with HTTP/2 support (h2) is installed """
+    try:
+        import httpx  # noqa: F401
+        import h2  # noqa: F401 (httpx needs it for HTTP/2)
+        return True
+    except ImportError:
+        return False
+
+
+def get_httpx_options(http2):
+    """ Keyword arguments of httpx.Client and httpx.AsyncClient with the settings of the requests session """
+    import httpx
+    connections = get_pool_size() * get_max_connections()
+    connect_timeout, read_timeout = get_timeout()
+    # trust_env reads the proxies once, when the client is created
+    return {'http2': http2, 'verify': get_httpx_verify(), 'follow_redirects': True,
+            'limits': httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+            'timeout': httpx.Timeout(read_timeout, connect=connect_timeout),
+            'headers': {'User-Agent': random.choice(core.USER_AGENTS)}}
+
+
+class Http2Session(object):
+    """
+        httpx client with HTTP/2 behind the part of requests.Session interface used by howdoi.
+        Errors are raised as requests exceptions, so callers handle both sessions the same way.
+    """
+
+    def __init__(self, http2=True):
+        import httpx
+        self._httpx = httpx
+        self.client = httpx.Client(**get_httpx_options(http2))
+
+    def get(self, url, headers=None, timeout=None, stream=False, **kwargs):
+        if isinstance(timeout, tuple):
+            timeout = self._httpx.Timeout(timeout[1], connect=timeout[0])
+        timings = {}
+        start = time.time()
+        try:
+            request = self.client.build_request('GET', url, headers=headers, timeout=timeout,
+                                                extensions={'trace': get_httpx_trace(timings)})
+            response = self.client.send(request, stream=True)
+            headers_time = time.time()
+            if not stream:
+                response.read()
+        except self._httpx.TransportError as e:
+            raise map_httpx_error(e)
+        response.timings = timings
+        _record(url, timings, start, headers_time, time.time())
+        return response
+
+    def close(self):
+        self.client.close()
+
+
+def create_session():
+    """
+        Create the session shared by all requests.
+    :return: requests.Session or Http2Session (HOWDOI_HTTP2 with httpx installed)
+    """
+    if os.getenv('HOWDOI_HTTP2'):
+        if has_http2():
+            return Http2Session()
+        print('[WARNING] HOWDOI_HTTP2 requires httpx with HTTP/2 support (pip install httpx[http2]), '
+              'using HTTP/1.1.', file=sys.stderr)
+    return _create_requests_session()
+
+
+def _get_backoff(attempt, retry_after=None):
+    """ Full jitter: random time up to base * 2 ** attempt, at least Retry-After of 429/503 response """
+    backoff = random.uniform(0, min(MAX_RETRY_BACKOFF,
+                                    _get_float_env('HOWDOI_RETRY_BACKOFF', DEFAULT_RETRY_BACKOFF) * 2 ** attempt))
+    if retry_after and retry_after.isdigit():
+        backoff = max(backoff, min(float(retry_after), MAX_RETRY_BACKOFF))
+    return backoff
+
+
+def get_retries():
+    return max(0, core._get_int_env('HOWDOI_RETRIES', DEFAULT_RETRIES))
+
+
+def get_retry_delay(attempt, retries, error=None, response=None):
+    """
+        Retry policy of fetch(): seconds to wait before the next attempt or None when the attempt is final.
+    :param attempt: number of the attempt from 0
+    :param retries: get_retries()
+    :param error: requests exception raised by the attempt
+    :param response: response of the attempt
+    """
+    from requests.exceptions import SSLError
+    if attempt >= retries:
+        return None
+    if error is not None:
+        # certificate errors do not go away when repeated
+        return None if isinstance(error, SSLError) else _get_backoff(attempt)
+    if response.status_code not in RETRY_STATUSES:
+        return None
+    return _get_backoff(attempt, response.headers.get('Retry-After'))
+
+
+def _hedged_get(session, url, timeout, delay, stream=False):
+    """
+        Send duplicate request when the first one has not finished after delay, first response wins.
+        The response of the other request is closed, so its connection goes back to the pool.
+    """
+    results = Queue()
+    lock = threading.Lock()
+    answered = []
+
+    def attempt():
+        try:
+            response, error = session.get(url, timeout=timeout, stream=stream), None
+        except Exception as e:
+            response, error = None, e
+        with lock:
+            if not answered:
+                results.put((response, error))
+                return
+        if response is not None:
+            response.close()
+
+    def start():
+        thread = threading.Thread(target=attempt)
+        thread.daemon = True
+        thread.start()
+
+    start()
+    launched, finished, error = 1, 0, None
+    while finished < launched:
+        try:
+            response, error = results.get(timeout=delay if launched == 1 else None)
+        except Empty:
+            start()
+            launched += 1
+            continue
+        finished += 1
+        if error is None:
+            with lock:
+                answered.append(response)
+                # the other response arrived before the winner was taken
+                while not results.empty():
+                    other, _ = results.get_nowait()
+                    if other is not None:
+                        other.close()
+            return response
+    raise error
+
+
+def fetch(session, url, stream=False):
+    """
+        GET the url with timeouts, retries and optional hedging.
+    :param stream: return as soon as the headers are received, the body is read by the caller
+    :return: response, the last one when all attempts ended with 429/5xx
+    :raise: requests ConnectionError, Timeout or SSLError when no attempt got a response
+    """
+    from requests.exceptions import ConnectionError, Timeout
+    timeout = get_timeout()
+    hedge_delay = get_hedge_delay()
+    retries = get_retries()
+    attempt = 0
+    while True:
+        try:
+            if hedge_delay is None:
+                response = session.get(url, timeout=timeout, stream=stream)
+            else:
+                response = _hedged_get(session, url, timeout, hedge_delay, stream)
+        except (ConnectionError, Timeout) as e:
+            delay = get_retry_delay(attempt, retries, error=e)
+            if delay is None:
+                raise
+        else:
+            delay = get_retry_delay(attempt, retries, response=response)
+            if delay is None:
+                return response
+            response.close()
+        time.sleep(delay)
+        attempt += 1
+
+
+def iter_chunks(response, chunk_size):
+    """
+        Body of streamed response (requests or httpx) in chunks of bytes.
+        Read errors of httpx are raised as requests exceptions (map_httpx_error).
+    """
+    if hasattr(response, 'iter_content'):
+        return response.iter_content(chunk_size)
+    return _iter_httpx_chunks(response, chunk_size)
+
+
+def _iter_httpx_chunks(response, chunk_size):
+    import httpx
+    try:
+        for chunk in response.iter_bytes(chunk_size):
+            yield chunk
+    except httpx.TransportError as e:
+        raise map_httpx_error(e)
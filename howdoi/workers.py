@@ -0,0 +1,84 @@
+######################################################
+#
+# Process pool for the CPU bound part of queries.
+#
+# In howdoi --serve and --batch the downloads run in threads, but parsing the
+# pages, writing out the links of answers and highlighting the code hold the
+# GIL, so many queries at once are served by one core. With
+# HOWDOI_PARSE_PROCESSES these steps run in a pool of processes: a page goes
+# to the pool as text and only the extracted links or the formatted answers
+# come back. A single command line query does not start the pool, starting it
+# costs more than it saves.
+#
+# Environment variables used by workers:
+#   HOWDOI_PARSE_PROCESSES (default: 0 - off) - processes parsing pages and highlighting answers in
+#       howdoi --serve and --batch, `auto` for one per CPU.
+#
+######################################################
+
+import os
+import signal
+import threading
+
+_pool = None
+_lock = threading.Lock()
+
+
+def get_process_count():
+    """ Number of pool processes from HOWDOI_PARSE_PROCESSES, 0 when the pool is off """
+    value = os.getenv('HOWDOI_PARSE_PROCESSES') or '0'
+    if value == 'auto':
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    try:
+        return max(0, int(value))
+    except ValueError:
+        return 0
+
+
+def _init_worker():
+    # Ctrl-C is handled by the main process, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # spans of a forked process would never be reported
+    from . import tracing
+    tracing.disable()
+
+
+def start(processes=None):
+    """
+        Start the pool used by offload().
+    :param processes: number of processes (default: HOWDOI_PARSE_PROCESSES)
+    :return: True if the pool is running
+    """
+    global _pool
+    processes = get_process_count() if processes is None else processes
+    with _lock:
+        if _pool is None and processes > 0:
+            import multiprocessing
+            _pool = multiprocessing.Pool(processes, _init_worker)
+        return _pool is not None
+
+
+def stop():
+    """ Stop the pool, offload() runs the functions in the calling thread again """
+    global _pool
+    with _lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def is_running():
+    return _pool is not None
+
+
+def offload(func, *args):
+    """
+        func(*args) in a pool process when the pool is running, in the calling thread otherwise.
+        func is a module level function, the arguments and the result are pickled.
+    """
+    pool = _pool
+    if pool is None:
+        return func(*args)
+    return pool.apply(func, args)
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
 
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 import howdoi
 import os
+import sys
 
 # For dependency list add argparse when Python version < 2.7.
 # Retrun list for extra installation -> [] or ['argparse']
@@ -27,6 +29,17 @@ def read(*names):
         values[name] = value
     return values
 
+
+# howdoi/aio.py uses async/await syntax, on Python < 3.5 it is not installed,
+# otherwise byte compiling it during the installation fails.
+class BuildPy(build_py):
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 5):
+            modules = [module for module in modules if (module[0], module[1]) != ('howdoi', 'aio')]
+        return modules
+
+
 # Description used in application metadata.
 # String formatting used.
 long_description = """
@@ -66,6 +79,7 @@ setup(
     url='https://github.com/gleitz/howdoi',
     license='MIT',
     packages=find_packages(),
+    cmdclass={'build_py': BuildPy},
     entry_points={
         'console_scripts': [
             'howdoi = howdoi.howdoi:command_line_runner',
@@ -75,6 +89,5 @@ setup(
         'pyquery',
         'pygments',
         'requests',
-        'requests-cache'
     ] + extra_dependencies(),
 )
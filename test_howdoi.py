@@ -1,14 +1,26 @@
 #!/usr/bin/env python
 
 """Tests for Howdoi."""
+import io
+import json
 import os
 import unittest
 import re
 import subprocess
 import ctypes
 import sys
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import zlib
 
 from howdoi import howdoi
+from howdoi import server
+from howdoi import stackexchange
+from howdoi.cache import COMPRESS_LEVEL, Cache
+from howdoi.testing import StubServer
 """
     Zapytanie pyquery do parsowania html
 """
@@ -302,5 +314,1285 @@ class HowdoiTestCaseEnvProxies(unittest.TestCase):
         self.assertTrue('ftp' not in filtered_proxies.keys())
 
 
+def _question_page(answers, tags=()):
+    """ Minimal StackOverflow question page with the given answers (list of html) and tags """
+    tag_html = ''.join('<a class="post-tag">{0}</a>'.format(tag) for tag in tags)
+    answers_html = ''.join('<div class="answer" data-answerid="{0}"><div class="post-text">{1}</div></div>'.format(
+                           index + 100, answer) for index, answer in enumerate(answers))
+    return '<html><body>{0}{1}</body></html>'.format(tag_html, answers_html)
+
+
+class StubSearchMixin(object):
+    """
+        StubServer installed as the google engine: its search page links the question pages /questions/N/q.
+        The session is created anew for the test and closed after it.
+    """
+
+    def start_stub(self, question_pages):
+        """
+        :param question_pages: html of the question pages (or StubServer routes) in the order of the search results
+        """
+        self.temp_session = howdoi.howdoi_session
+        self.temp_search_url = howdoi.SEARCH_URLS['google']
+        routes = {}
+        for question_id, page in enumerate(question_pages, 1):
+            routes['/questions/{0}/q'.format(question_id)] = page if isinstance(page, tuple) else (200, page)
+        self.stub = StubServer(routes)
+        self.stub.routes['/search'] = (200, ''.join('<a class="l" href="{0}/questions/{1}/q">q</a>'.format(
+            self.stub.url, question_id) for question_id in range(1, len(question_pages) + 1)))
+        howdoi.SEARCH_URLS['google'] = self.stub.url + '/search?q=site:{0}%20{1}'
+        howdoi.howdoi_session = None
+        self.addCleanup(self.stop_stub)
+
+    def stop_stub(self):
+        if howdoi.howdoi_session is not None:
+            howdoi.howdoi_session.close()
+        howdoi.howdoi_session = self.temp_session
+        howdoi.SEARCH_URLS['google'] = self.temp_search_url
+        self.stub.stop()
+
+    def call_howdoi(self, query):
+        return howdoi.howdoi(vars(howdoi.get_parser().parse_args(query.split(' '))))
+
+
+class FakeResponse(object):
+
+    def __init__(self, text, status_code=200):
+        self.text = text
+        self.status_code = status_code
+
+
+class FakeSession(object):
+    """ Replaces requests session, returns pages from dict url -> text """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.requested = []
+
+    def get(self, url, **kwargs):
+        self.requested.append(url)
+        if url in self.pages:
+            return FakeResponse(self.pages[url])
+        return FakeResponse('', 404)
+
+    def close(self):
+        pass
+
+
+class HowdoiTestCaseLocal(unittest.TestCase):
+    """ Tests with search and question pages served from memory instead of the network """
+
+    def setUp(self):
+        self.temp_get_links = howdoi._get_links
+        self.temp_get_result = howdoi._get_result
+        self.temp_answer_cache = howdoi.answer_cache
+        self.temp_page_cache = howdoi.page_cache
+        self.temp_session = howdoi.howdoi_session
+        self.temp_cache_files = (howdoi.PAGE_CACHE_FILE, howdoi.ANSWER_CACHE_FILE, howdoi.LINK_CACHE_FILE)
+        self.temp_dir = tempfile.mkdtemp()
+        howdoi.PAGE_CACHE_FILE = os.path.join(self.temp_dir, 'pages.sqlite')
+        howdoi.ANSWER_CACHE_FILE = os.path.join(self.temp_dir, 'answers.sqlite')
+        howdoi.LINK_CACHE_FILE = os.path.join(self.temp_dir, 'links.sqlite')
+        self.links = ['https://stackoverflow.com/questions/{0}/question-{0}'.format(i) for i in range(1, 6)]
+        self.fetched = []
+        howdoi._get_links = lambda query: self.links
+        howdoi._get_result = self.fake_get_result
+
+    def tearDown(self):
+        howdoi._get_links = self.temp_get_links
+        howdoi._get_result = self.temp_get_result
+        if howdoi.answer_cache is not self.temp_answer_cache:
+            howdoi.answer_cache.close()
+        howdoi.answer_cache = self.temp_answer_cache
+        if howdoi.page_cache is not self.temp_page_cache:
+            howdoi.page_cache.close()
+        howdoi.page_cache = self.temp_page_cache
+        howdoi.howdoi_session = self.temp_session
+        howdoi.PAGE_CACHE_FILE, howdoi.ANSWER_CACHE_FILE, howdoi.LINK_CACHE_FILE = self.temp_cache_files
+        for link_cache in howdoi.link_caches.values():
+            link_cache.close()
+        howdoi.link_caches = {}
+        shutil.rmtree(self.temp_dir)
+        os.environ.pop('HOWDOI_MAX_WORKERS', None)
+
+    def fake_get_result(self, url, use_cache=True):
+        self.fetched.append(url)
+        question_id = re.search(r'questions/(\d+)/', url).group(1)
+        return _question_page(['<pre><code>answer {0}</code></pre>'.format(question_id)], ['bash'])
+
+    def call_howdoi(self, query):
+        parser = howdoi.get_parser()
+        args = vars(parser.parse_args(query.split(' ')))
+        return howdoi.howdoi(args)
+
+    def test_multiple_answers_fetched_concurrently(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def slow_get_result(url):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.1)
+            with lock:
+                running[0] -= 1
+            return self.fake_get_result(url)
+
+        howdoi._get_result = slow_get_result
+        response = self.call_howdoi('format date bash -n3 -p2')
+        self.assertGreater(running[1], 1)
+        self.assertEqual(len(self.fetched), 3)
+        positions = [response.find('answer {0}'.format(i)) for i in (2, 3, 4)]
+        self.assertNotIn(-1, positions)
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(response.find('answer 1'), -1)
+
+    def test_streaming_answers(self):
+        def slow_get_result(url, use_cache=True):
+            if 'questions/3/' in url:
+                time.sleep(0.5)
+            return self.fake_get_result(url)
+
+        howdoi._get_result = slow_get_result
+        args = vars(howdoi.get_parser().parse_args('format date bash -n3'.split(' ')))
+        start = time.time()
+        chunks = howdoi.howdoi_stream(args)
+        first = next(chunks)
+        # the first answer does not wait for the slow third page
+        self.assertLess(time.time() - start, 0.4)
+        self.assertIn('answer 1', first)
+        rest = list(chunks)
+        self.assertEqual(len(rest), 2)
+        self.assertEqual(''.join([first] + rest), self.call_howdoi('format date bash -n3'))
+
+    def test_max_workers_limit(self):
+        os.environ['HOWDOI_MAX_WORKERS'] = '1'
+        first = self.call_howdoi('format date bash -n3')
+        os.environ['HOWDOI_MAX_WORKERS'] = '3'
+        self.assertEqual(first, self.call_howdoi('format date bash -n3'))
+        os.environ['HOWDOI_MAX_WORKERS'] = 'many'
+        self.assertEqual(howdoi._get_max_workers(), howdoi.DEFAULT_MAX_WORKERS)
+
+    def test_answers_per_question(self):
+        def get_result(url):
+            self.fetched.append(url)
+            return _question_page(['<p>first</p>', '<p>second</p>', '<p>third</p>'])
+
+        howdoi._get_result = get_result
+        response = self.call_howdoi('format date bash --answers-per-question 2')
+        self.assertEqual(len(self.fetched), 1)
+        self.assertIn('Answer from {0}#100'.format(self.links[0]), response)
+        self.assertIn('Answer from {0}#101'.format(self.links[0]), response)
+        self.assertLess(response.find('first'), response.find('second'))
+        self.assertEqual(response.find('third'), -1)
+        self.assertEqual(self.call_howdoi('format date bash'), 'first\n')
+
+    def test_answer_cache(self):
+        howdoi.answer_cache = Cache(os.path.join(self.temp_dir, 'answers.sqlite'), table='answers')
+        first = self.call_howdoi('format date bash -n2')
+        self.assertEqual(len(self.fetched), 2)
+        self.assertEqual(self.call_howdoi('Format  DATE bash -n2'), first)
+        self.assertEqual(len(self.fetched), 2)
+        self.assertNotEqual(self.call_howdoi('format date bash -n2 -p2'), first)
+        self.assertEqual(len(self.fetched), 4)
+
+    def test_normalize_query(self):
+        self.assertEqual(howdoi._normalize_query('format date bash'), howdoi._normalize_query('bash format date'))
+        self.assertEqual(howdoi._normalize_query('format date bash'), howdoi._normalize_query('Format  date in bash'))
+        self.assertNotEqual(howdoi._normalize_query('c++ vector'), howdoi._normalize_query('c vector'))
+        self.assertEqual(howdoi._normalize_query('how to'), 'how to')
+
+    def test_similar_query_from_answer_cache(self):
+        howdoi.answer_cache = Cache(howdoi.ANSWER_CACHE_FILE, table='answers', indexed=True)
+        first = self.call_howdoi('format date bash')
+        self.assertEqual(self.call_howdoi('format date bash shell'), self.call_howdoi('format date bash shell'))
+        self.assertEqual(len(self.fetched), 2)
+
+        os.environ['HOWDOI_FUZZY_CACHE'] = '0.7'
+        try:
+            self.assertEqual(self.call_howdoi('format the date bash script'), first)
+            self.assertEqual(len(self.fetched), 2)
+            self.call_howdoi('format date -a')
+            self.assertEqual(len(self.fetched), 3)
+        finally:
+            os.environ.pop('HOWDOI_FUZZY_CACHE')
+        stats = howdoi._get_cache_stats()
+        self.assertIn('hits/misses: 1/3 (hit ratio 20.0%)', stats)
+        self.assertIn('similar query hits: 1 (hit ratio 20.0%)', stats)
+
+    def test_page_cache_and_stats(self):
+        howdoi._enable_cache()
+        howdoi._get_result = self.temp_get_result
+        howdoi.howdoi_session = FakeSession({'http://example.com/page': 'page'})
+        self.assertEqual(howdoi._get_result('http://example.com/page'), 'page')
+        self.assertEqual(howdoi._get_result('http://example.com/page'), 'page')
+        self.assertEqual(howdoi._get_result('http://example.com/missing'), '')
+        self.assertEqual(howdoi._get_result('http://example.com/missing'), '')
+        self.assertEqual(len(howdoi.howdoi_session.requested), 3)
+
+        stats = howdoi._get_cache_stats()
+        self.assertIn('Page cache ({0})\n  entries: 1\n'.format(howdoi.PAGE_CACHE_FILE), stats)
+        self.assertIn('hits/misses: 1/3 (hit ratio 25.0%)', stats)
+        self.assertIn('Answer cache ({0})\n  entries: 0\n'.format(howdoi.ANSWER_CACHE_FILE), stats)
+        howdoi._compact_cache()
+        self.assertEqual(howdoi._get_result('http://example.com/page'), 'page')
+        self.assertEqual(len(howdoi.howdoi_session.requested), 3)
+
+    def test_stats_read_only(self):
+        page_cache = Cache(howdoi.PAGE_CACHE_FILE, table='pages', compress=True)
+        page_cache.set('http://example.com/page', 'page')
+        page_cache.close()
+        link_cache = Cache(howdoi.LINK_CACHE_FILE, table='links_google')
+        link_cache.set('format date', '[]')
+        link_cache.close()
+        files = dict((path, os.path.getsize(path)) for path in (howdoi.PAGE_CACHE_FILE, howdoi.LINK_CACHE_FILE))
+
+        stats = howdoi._get_cache_stats()
+        self.assertEqual(dict((path, os.path.getsize(path)) for path in files), files)
+        self.assertFalse(os.path.exists(howdoi.ANSWER_CACHE_FILE))
+        self.assertIn('Answer cache ({0})\n  entries: 0\n'.format(howdoi.ANSWER_CACHE_FILE), stats)
+        # the links of all engines are in one file, its size is reported once
+        self.assertIn('Link cache, bing ({0})\n  entries: 0\n  size on disk: {1} bytes\n'.format(
+            howdoi.LINK_CACHE_FILE, files[howdoi.LINK_CACHE_FILE]), stats)
+        self.assertIn('Link cache, google ({0})\n  entries: 1\n  size on disk: shared with Link cache, bing\n'
+                      .format(howdoi.LINK_CACHE_FILE), stats)
+        self.assertIn('Total size on disk: {0} bytes'.format(sum(files.values())), stats)
+
+    def test_batch(self):
+        batch_file = os.path.join(self.temp_dir, 'queries.txt')
+        with open(batch_file, 'w') as out_file:
+            out_file.write('format date bash\n\nprint stack trace python\ncreate tar archive\n')
+        args = vars(howdoi.get_parser().parse_args(['-p2']))
+        output = io.StringIO() if sys.version >= '3' else io.BytesIO()
+        self.assertEqual(howdoi.howdoi_batch(args, batch_file, output), 3)
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([record['line'] for record in records], [1, 2, 3])
+        self.assertEqual(records[1]['query'], 'print stack trace python')
+        self.assertEqual(records[1]['answer'], 'answer 2\n')
+        self.assertEqual(args['pos'], 2)
+
+    def test_batch_query_error(self):
+        batch_file = os.path.join(self.temp_dir, 'queries.txt')
+        with open(batch_file, 'w') as out_file:
+            out_file.write('format date bash\nprint stack trace python\ncreate tar archive\n')
+
+        def get_links(query):
+            if 'stack' in query:
+                raise UnicodeError('malformed page')
+            return self.links
+
+        howdoi._get_links = get_links
+        output = io.StringIO() if sys.version >= '3' else io.BytesIO()
+        args = vars(howdoi.get_parser().parse_args([]))
+        self.assertEqual(howdoi.howdoi_batch(args, batch_file, output), 3)
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([record['answer'] for record in records],
+                         ['answer 1\n', howdoi.QUERY_ERROR_MSG, 'answer 1\n'])
+        self.assertEqual(records[1]['error'], 'UnicodeError: malformed page')
+        self.assertNotIn('error', records[0])
+
+    def test_json_output(self):
+        def get_result(url):
+            return _question_page(['<p>Use <a href="http://man7.org/date">date</a>:</p>'
+                                   '<pre><code>date +%F</code></pre><pre><code>date -I</code></pre>'],
+                                  ['bash', 'date'])
+
+        howdoi._get_result = get_result
+        records = json.loads(self.call_howdoi('format date bash -j -c -n2'))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['position'], 1)
+        self.assertEqual(records[1]['position'], 2)
+        self.assertEqual(records[1]['question_id'], 2)
+        self.assertEqual(records[0]['link'], self.links[0])
+        self.assertEqual(records[0]['tags'], ['bash', 'date'])
+        self.assertEqual(records[0]['code'], ['date +%F', 'date -I'])
+        self.assertIn('Use [date](http://man7.org/date):', records[0]['answer'])
+        self.assertEqual(json.loads(self.call_howdoi('format date bash -j -l')),
+                         [{'position': 1, 'link': self.links[0], 'question_id': 1}])
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'requires Unix domain sockets')
+    def test_server(self):
+        temp_dir = tempfile.mkdtemp()
+        socket_file = os.path.join(temp_dir, 'howdoi.sock')
+        self.assertIsNone(server.query_server({'query': ['format']}, socket_file))
+
+        howdoi_server = server.make_server(socket_file)
+        thread = threading.Thread(target=howdoi_server.serve_forever)
+        thread.start()
+        try:
+            args = vars(howdoi.get_parser().parse_args('format date bash -n2'.split(' ')))
+            response = b''.join(server.query_server(dict(args), socket_file))
+            self.assertEqual(response.decode('utf-8'), howdoi.howdoi(args))
+            self.assertRaises(RuntimeError, server.make_server, socket_file)
+            self.assertTrue(server.is_running(socket_file))
+            # the server does not answer a client with another environment
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(socket_file)
+            environment = dict(server.get_environment(), HOWDOI_URL='unix.stackexchange.com')
+            client.sendall((json.dumps({'args': args, 'env': environment}) + '\n').encode('utf-8'))
+            self.assertEqual(b''.join(server._iter_response(client, b'')), server.STATUS_ENVIRONMENT)
+            # a query failing after the first answer ends with ServerError, not with a truncated answer
+            temp_iter_instructions = howdoi._iter_instructions
+
+            def iter_instructions(args):
+                yield 'first answer'
+                raise ValueError('malformed page')
+
+            howdoi._iter_instructions = iter_instructions
+            try:
+                chunks = []
+                with self.assertRaises(server.ServerError) as context:
+                    for chunk in server.query_server(dict(args), socket_file):
+                        chunks.append(chunk)
+            finally:
+                howdoi._iter_instructions = temp_iter_instructions
+            self.assertEqual(b''.join(chunks), b'first answer')
+            self.assertEqual(str(context.exception), 'ValueError: malformed page')
+        finally:
+            howdoi_server.shutdown()
+            howdoi_server.server_close()
+            thread.join()
+            shutil.rmtree(temp_dir)
+
+
+class HowdoiTestCaseHighlight(unittest.TestCase):
+
+    def test_lexer_index(self):
+        from pygments.lexers import get_lexer_by_name
+        from howdoi import highlight
+        for alias in ('bash', 'Python', 'sh', 'js', 'c++'):
+            self.assertIs(type(highlight.get_lexer(alias)), type(get_lexer_by_name(alias)))
+            self.assertIs(highlight.get_lexer(alias), highlight.get_lexer(alias))
+        self.assertIsNone(highlight.get_lexer('date'))
+        self.assertIsNone(highlight.get_lexer(None))
+
+    def test_same_output_as_pygments(self):
+        import pygments
+        from pygments.formatters.terminal import TerminalFormatter
+        from pygments.lexers import get_lexer_by_name, guess_lexer
+        from howdoi import highlight
+        code = 'for i in range(3):\n    print(i)\n'
+        self.assertEqual(highlight.highlight_code(code, ['format', 'python']),
+                         pygments.highlight(code, get_lexer_by_name('python'), TerminalFormatter(bg='dark')))
+        code = '#!/bin/bash\necho "$HOME"\n'
+        self.assertEqual(highlight.highlight_code(code, ['format', 'date']),
+                         pygments.highlight(code, guess_lexer(code), TerminalFormatter(bg='dark')))
+
+    def test_highlight_cache(self):
+        import pygments
+        from howdoi import highlight
+        calls = []
+        temp_highlight = pygments.highlight
+
+        def counting_highlight(*args):
+            calls.append(1)
+            return temp_highlight(*args)
+
+        pygments.highlight = counting_highlight
+        try:
+            code = 'ls -la /tmp/highlight-cache-test\n'
+            first = highlight.highlight_code(code, ['bash'])
+            self.assertEqual(highlight.highlight_code(code, ['bash']), first)
+            self.assertEqual(len(calls), 1)
+            # other lexer, other entry
+            highlight.highlight_code(code, ['python'])
+            self.assertEqual(len(calls), 2)
+        finally:
+            pygments.highlight = temp_highlight
+
+
+class HowdoiTestCaseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'cache.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_set(self):
+        cache = Cache(self.path)
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+        cache.close()
+        self.assertEqual(Cache(self.path).get('key'), 'value')
+
+    def test_ttl(self):
+        cache = Cache(self.path, ttl=0.05)
+        cache.set('key', 'value')
+        self.assertEqual(cache.get('key'), 'value')
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('key'))
+
+    def test_contains(self):
+        cache = Cache(self.path, ttl=0.05)
+        self.assertFalse(cache.contains('key'))
+        cache.set('key', 'value')
+        self.assertTrue(cache.contains('key'))
+        # not counted in the statistics
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (0, 0))
+        time.sleep(0.1)
+        self.assertFalse(cache.contains('key'))
+
+    def test_word_index(self):
+        cache = Cache(self.path, table='answers', indexed=True)
+        cache.set('a', 'answer a', words=['format', 'date', 'bash'])
+        cache.set('b', 'answer b', words=['format', 'json'])
+        cache.set('c', 'answer c', words=['tar'])
+        self.assertEqual(sorted(cache.find_similar(['format', 'date'])), [('a', 2, 3), ('b', 1, 2)])
+        cache.set('a', 'answer a', words=['date'])
+        cache.delete('b')
+        self.assertEqual(cache.find_similar(['format', 'date']), [('a', 1, 1)])
+        cache.clear()
+        self.assertEqual(cache.find_similar(['date']), [])
+
+    def test_lru_eviction(self):
+        cache = Cache(self.path, max_size=10)
+        cache.set('a', 'aaaa')
+        cache.set('b', 'bbbb')
+        cache.get('a')
+        cache.set('c', 'cccc')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 'aaaa')
+        self.assertEqual(cache.get('c'), 'cccc')
+
+    def test_compressed(self):
+        page = u'<div class="answer"><pre>tar -czf archive.tar.gz dir \u2713</pre></div>' * 200
+        cache = Cache(self.path, table='pages', compress=True)
+        cache.set('complete', page)
+        cache.set('partial', page)
+        self.assertEqual(cache.get('complete'), page)
+        self.assertEqual(cache.get('partial'), page)
+        stats = cache.stats()
+        self.assertEqual((stats['entries'], stats['blobs']), (2, 1))
+        self.assertEqual(stats['raw_size'], len(page.encode('utf-8')))
+        self.assertLess(stats['stored_size'] * 10, stats['raw_size'])
+        # the blob is removed with the last entry referring to it
+        cache.delete('complete')
+        self.assertEqual(cache.get('partial'), page)
+        cache.delete('partial')
+        self.assertEqual(cache.stats()['blobs'], 0)
+
+    def test_compressed_reads_uncompressed_entries(self):
+        cache = Cache(self.path, table='pages')
+        cache.set('old', 'old page')
+        cache.close()
+        cache = Cache(self.path, table='pages', compress=True)
+        cache.set('new', 'new page')
+        self.assertEqual(cache.get('old'), 'old page')
+        self.assertEqual(cache.get('new'), 'new page')
+        self.assertEqual(cache.stats()['raw_size'], len('old page') + len('new page'))
+
+    def test_compressed_lru_eviction(self):
+        pages = [str(index) * 1000 for index in range(3)]
+        stored_size = len(zlib.compress(pages[0].encode('utf-8'), COMPRESS_LEVEL))
+        # the limit counts compressed bytes, two of the pages fit
+        cache = Cache(self.path, table='pages', compress=True, max_size=2 * stored_size)
+        cache.set('a', pages[0])
+        cache.set('b', pages[1])
+        cache.get('a')
+        cache.set('c', pages[2])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), pages[0])
+        self.assertEqual(cache.get('c'), pages[2])
+        self.assertEqual(cache.stats()['blobs'], 2)
+
+    def test_compressed_size_counts_shared_blob_once(self):
+        pages = [str(index) * 1000 for index in range(2)]
+        stored_size = len(zlib.compress(pages[0].encode('utf-8'), COMPRESS_LEVEL))
+        cache = Cache(self.path, table='pages', compress=True, max_size=2 * stored_size)
+        cache.set('complete', pages[0])
+        cache.set('partial', pages[0])
+        cache.set('other', pages[1])
+        self.assertEqual([cache.get(key) for key in ('complete', 'partial', 'other')], [pages[0], pages[0], pages[1]])
+        # the replaced value of a key is removed when no other entry refers to it
+        cache.set('other', pages[0])
+        self.assertEqual(cache.stats()['blobs'], 1)
+
+
+class HowdoiTestCaseApiBackend(unittest.TestCase):
+    """ Stack Exchange API backend against local stand-in server """
+
+    def setUp(self):
+        self.temp_get_links = howdoi._get_links
+        self.temp_get_proxies = howdoi.getproxies
+        self.temp_api_url = stackexchange.API_URL
+        answers = {'items': [
+            {'question_id': 1, 'answer_id': 11, 'score': 10, 'body': '<pre><code>api answer 1</code></pre>'},
+            {'question_id': 2, 'answer_id': 21, 'score': 5, 'body': '<pre><code>api answer 2</code></pre>'},
+            {'question_id': 1, 'answer_id': 12, 'score': 1, 'body': '<pre><code>second answer 1</code></pre>'}]}
+        questions = {'items': [{'question_id': 1, 'tags': ['bash']}, {'question_id': 2, 'tags': ['date']}]}
+        self.stub = StubServer({
+            '/2.2/questions/1;2;3/answers': (200, json.dumps(answers)),
+            '/2.2/questions/1;2;3': (200, json.dumps(questions)),
+            '/questions/3/question-3': (200, _question_page(['<pre><code>scraped answer 3</code></pre>']))})
+        links = ['{0}/questions/{1}/question-{1}'.format(self.stub.url, i) for i in range(1, 4)]
+        howdoi._get_links = lambda query: links
+        howdoi.getproxies = lambda: {}
+        stackexchange.API_URL = self.stub.url + '/2.2'
+        os.environ['HOWDOI_ANSWER_BACKEND'] = 'api'
+
+    def tearDown(self):
+        self.stub.stop()
+        howdoi._get_links = self.temp_get_links
+        howdoi.getproxies = self.temp_get_proxies
+        stackexchange.API_URL = self.temp_api_url
+        os.environ.pop('HOWDOI_ANSWER_BACKEND', None)
+
+    def call_howdoi(self, query):
+        args = vars(howdoi.get_parser().parse_args(query.split(' ')))
+        return howdoi.howdoi(args)
+
+    def test_batched_answers_with_scraper_fallback(self):
+        response = self.call_howdoi('format date -n3')
+        self.assertIn('api answer 1', response)
+        self.assertIn('api answer 2', response)
+        self.assertIn('scraped answer 3', response)
+        self.assertNotIn('second answer 1', response)
+        paths = [path.split('?')[0] for path in self.stub.requested]
+        self.assertEqual(sorted(paths), ['/2.2/questions/1;2;3', '/2.2/questions/1;2;3/answers',
+                                         '/questions/3/question-3'])
+        self.assertIn('filter=withbody', self.stub.requested[0])
+        self.assertIn('sort=votes', self.stub.requested[0])
+
+    def test_api_error_falls_back_to_scraper(self):
+        self.stub.routes['/2.2/questions/1;2;3/answers'] = (400, 'not json')
+        self.stub.routes['/questions/1/question-1'] = (200, _question_page(['<pre><code>scraped 1</code></pre>']))
+        self.assertEqual(self.call_howdoi('format date'), 'scraped 1\n')
+
+
+class HowdoiTestCaseTransport(unittest.TestCase):
+    """ Shared session against local server """
+
+    def setUp(self):
+        self.temp_get_proxies = howdoi.getproxies
+        self.proxy_lookups = []
+        howdoi.getproxies = lambda: self.proxy_lookups.append(1) or {}
+        os.environ['HOWDOI_MAX_CONNECTIONS'] = '3'
+        self.stub = StubServer({'/page': (200, 'page')})
+        from howdoi import transport
+        self.session = transport.create_session()
+
+    def tearDown(self):
+        self.session.close()
+        self.stub.stop()
+        howdoi.getproxies = self.temp_get_proxies
+        os.environ.pop('HOWDOI_MAX_CONNECTIONS', None)
+
+    def test_keep_alive_and_timings(self):
+        from howdoi import transport
+        responses = [self.session.get(self.stub.url + '/page') for _ in range(3)]
+        self.assertEqual([response.text for response in responses], ['page'] * 3)
+        self.assertFalse(responses[0].timings['reused'])
+        self.assertTrue(responses[1].timings['reused'])
+        self.assertTrue(responses[2].timings['reused'])
+        self.assertEqual(responses[1].timings['connect'], 0)
+        for name in ('connect', 'tls', 'wait', 'transfer', 'total'):
+            self.assertGreaterEqual(responses[0].timings[name], 0)
+        self.assertIs(transport.recent_timings[-1], responses[2].timings)
+
+    def test_session_settings(self):
+        for _ in range(2):
+            self.session.get(self.stub.url + '/page')
+        # one user agent per session and proxies looked up once
+        self.assertEqual(len(set(self.stub.user_agents)), 1)
+        self.assertIn(self.stub.user_agents[0], howdoi.USER_AGENTS)
+        self.assertEqual(len(self.proxy_lookups), 1)
+        self.assertEqual(self.session.get_adapter(self.stub.url)._pool_maxsize, 3)
+
+    def test_httpx_session(self):
+        try:
+            import httpx
+        except ImportError:
+            raise unittest.SkipTest('requires httpx')
+        from howdoi import transport
+        from requests.exceptions import ConnectionError
+        # the HTTP/2 session code path over HTTP/1.1, the stub server does not speak HTTP/2
+        session = transport.Http2Session(http2=False)
+        try:
+            response = transport.fetch(session, self.stub.url + '/page')
+            self.assertEqual((response.status_code, response.text), (200, 'page'))
+            for name in ('connect', 'wait', 'transfer', 'total'):
+                self.assertGreaterEqual(response.timings[name], 0)
+            response = transport.fetch(session, self.stub.url + '/page', stream=True)
+            self.assertEqual(b''.join(transport.iter_chunks(response, 2)), b'page')
+            self.assertTrue(response.timings['reused'])
+
+            class BrokenResponse(object):
+                def iter_bytes(self, chunk_size):
+                    yield b'pa'
+                    raise httpx.ReadError('connection reset')
+
+            self.assertRaises(ConnectionError, b''.join, transport.iter_chunks(BrokenResponse(), 2))
+            os.environ['HOWDOI_RETRIES'] = '0'
+            self.assertRaises(ConnectionError, transport.fetch, session, 'http://127.0.0.1:1/page')
+        finally:
+            os.environ.pop('HOWDOI_RETRIES', None)
+            session.close()
+        self.assertIn(self.stub.user_agents[0], howdoi.USER_AGENTS)
+
+    def test_one_session_for_threads(self):
+        from howdoi import transport
+        temp_session, temp_create_session = howdoi.howdoi_session, transport.create_session
+        sessions = []
+
+        def create_session():
+            time.sleep(0.05)
+            sessions.append(temp_create_session())
+            return sessions[-1]
+        transport.create_session = create_session
+        howdoi.howdoi_session = None
+        try:
+            threads = [threading.Thread(target=howdoi.get_session) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            transport.create_session = temp_create_session
+            howdoi.howdoi_session = temp_session
+            for session in sessions:
+                session.close()
+        self.assertEqual(len(sessions), 1)
+
+
+class HowdoiTestCaseFaults(unittest.TestCase):
+    """ Timeouts, retries and hedged requests against local server injecting faults """
+
+    def setUp(self):
+        self.temp_session = howdoi.howdoi_session
+        self.temp_page_cache = howdoi.page_cache
+        howdoi.page_cache = None
+        os.environ.update({'HOWDOI_RETRY_BACKOFF': '0.01', 'HOWDOI_READ_TIMEOUT': '0.3'})
+        self.stub = StubServer({
+            '/flaky': [(503, 'down'), (429, 'slow down'), (200, 'page')],
+            '/down': (500, 'down'),
+            '/stalled': (200, 'late', 2),
+            '/slow-first': [(200, 'slow', 1), (200, 'fast')]})
+        from howdoi import transport
+        howdoi.howdoi_session = transport.create_session()
+
+    def tearDown(self):
+        howdoi.howdoi_session.close()
+        howdoi.howdoi_session = self.temp_session
+        howdoi.page_cache = self.temp_page_cache
+        self.stub.stop()
+        for name in ('HOWDOI_RETRY_BACKOFF', 'HOWDOI_READ_TIMEOUT', 'HOWDOI_RETRIES', 'HOWDOI_HEDGE'):
+            os.environ.pop(name, None)
+
+    def test_retry_throttled_and_server_errors(self):
+        self.assertEqual(howdoi._get_result(self.stub.url + '/flaky'), 'page')
+        self.assertEqual(len(self.stub.requested), 3)
+
+    def test_retries_bounded(self):
+        os.environ['HOWDOI_RETRIES'] = '1'
+        self.assertEqual(howdoi._get_result(self.stub.url + '/down'), 'down')
+        self.assertEqual(len(self.stub.requested), 2)
+
+    def test_read_timeout(self):
+        from requests.exceptions import Timeout
+        os.environ['HOWDOI_RETRIES'] = '1'
+        start = time.time()
+        self.assertRaises(Timeout, howdoi._get_result, self.stub.url + '/stalled')
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(len(self.stub.requested), 2)
+
+    def test_hedged_request(self):
+        os.environ.update({'HOWDOI_HEDGE': '0.1', 'HOWDOI_READ_TIMEOUT': '5'})
+        start = time.time()
+        self.assertEqual(howdoi._get_result(self.stub.url + '/slow-first'), 'fast')
+        self.assertLess(time.time() - start, 0.8)
+        self.assertEqual(len(self.stub.requested), 2)
+
+    def test_hedged_request_closes_slower_response(self):
+        from howdoi import transport
+
+        class Response(object):
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        responses = []
+
+        class Session(object):
+            def get(self, url, timeout=None, stream=False):
+                responses.append(Response())
+                response = responses[-1]
+                if len(responses) == 1:
+                    time.sleep(0.3)
+                return response
+
+        winner = transport._hedged_get(Session(), 'http://example.com', (1, 1), 0.05, stream=True)
+        self.assertIs(winner, responses[1])
+        time.sleep(0.5)
+        self.assertTrue(responses[0].closed)
+        self.assertFalse(winner.closed)
+
+
+class HowdoiTestCaseExtract(unittest.TestCase):
+    """ lxml extraction gives the same output as pyquery on the pages from benchmarks/fixtures """
+
+    fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'fixtures')
+    link = 'https://stackoverflow.com/questions/1401482/how-to-format-a-date'
+
+    def tearDown(self):
+        os.environ.pop('HOWDOI_PARSER', None)
+
+    def iter_fixtures(self, prefix):
+        for name in sorted(os.listdir(self.fixtures_dir)):
+            if name.startswith(prefix):
+                with io.open(os.path.join(self.fixtures_dir, name), encoding='utf-8') as in_file:
+                    yield name, in_file.read()
+
+    def extract(self, parser, page, options):
+        os.environ['HOWDOI_PARSER'] = parser
+        args = vars(howdoi.get_parser().parse_args(['format', 'date', 'bash'] + options.split()))
+        args['query'] = ' '.join(args['query'])
+        if args['json']:
+            return howdoi._get_answer_records(args, [self.link], {self.link: page})
+        return howdoi._get_answers(args, [self.link], {self.link: page})
+
+    def test_same_answers(self):
+        for name, page in self.iter_fixtures('question'):
+            for options in ('', '-a', '-c', '-a -c', '--answers-per-question 3', '-j', '-j --answers-per-question 3'):
+                self.assertEqual(self.extract('lxml', page, options), self.extract('pyquery', page, options),
+                                 '{0} {1}'.format(name, options))
+
+    def test_links_written_out(self):
+        name, page = next(self.iter_fixtures('question.html'))
+        answer = self.extract('lxml', page, '-a')[0][1]
+        self.assertIn('[the bash manual](https://www.gnu.org/software/bash/manual/bash.html#index-printf)', answer)
+        self.assertIn(' https://www.gnu.org/software/bash/manual/ for details', answer)
+
+    def test_same_links(self):
+        found = 0
+        for name, page in self.iter_fixtures('search_'):
+            search_engine = name.split('_')[1]
+            os.environ['HOWDOI_PARSER'] = 'pyquery'
+            expected = howdoi._extract_links_from_page(page, search_engine)
+            os.environ['HOWDOI_PARSER'] = 'lxml'
+            self.assertEqual(howdoi._extract_links_from_page(page, search_engine), expected, name)
+            found += len(expected)
+        self.assertGreater(found, 0)
+
+
+class HowdoiTestCaseStreamParse(unittest.TestCase):
+    """ Pages read only until the needed answers or links are parsed """
+
+    padding = '<div class="sidebar"><p>related question</p></div>\n' * 40000
+
+    def setUp(self):
+        self.temp_session = howdoi.howdoi_session
+        self.temp_page_cache = howdoi.page_cache
+        self.temp_dir = tempfile.mkdtemp()
+        howdoi.page_cache = Cache(os.path.join(self.temp_dir, 'pages.sqlite'), 'pages')
+        fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'fixtures')
+        with io.open(os.path.join(fixtures_dir, 'question.html'), encoding='utf-8') as in_file:
+            self.question_page = in_file.read().replace('</body>', self.padding + '</body>')
+        with io.open(os.path.join(fixtures_dir, 'search_google.html'), encoding='utf-8') as in_file:
+            self.search_page = in_file.read().replace('</body>', self.padding + '</body>')
+        self.stub = StubServer({'/questions/1401482/how-to-format-a-date': (200, self.question_page),
+                                '/search': (200, self.search_page)})
+        self.link = self.stub.url + '/questions/1401482/how-to-format-a-date'
+        from howdoi import transport
+        howdoi.howdoi_session = transport.create_session()
+        os.environ['HOWDOI_STREAM_PARSE'] = '1'
+
+    def tearDown(self):
+        howdoi.howdoi_session.close()
+        howdoi.howdoi_session = self.temp_session
+        howdoi.page_cache.close()
+        howdoi.page_cache = self.temp_page_cache
+        self.stub.stop()
+        shutil.rmtree(self.temp_dir)
+        os.environ.pop('HOWDOI_STREAM_PARSE', None)
+
+    def get_answers(self, page, answers_per_question):
+        args = vars(howdoi.get_parser().parse_args(['format', 'date', 'bash', '--answers-per-question',
+                                                    str(answers_per_question)]))
+        args['query'] = ' '.join(args['query'])
+        return howdoi._get_answers(args, [self.link], {self.link: page})
+
+    def test_question_page_read_until_answers(self):
+        page = howdoi._get_question_page(self.link, 2)
+        self.assertLess(len(page), len(self.question_page) // 4)
+        self.assertEqual(self.get_answers(page, 2), self.get_answers(self.question_page, 2))
+        # cached under the key of the condition, the next request is not sent
+        self.assertEqual(howdoi._get_question_page(self.link, 2), page)
+        self.assertEqual(len(self.stub.requested), 1)
+        self.assertEqual(howdoi.page_cache.stats()['hits'], 1)
+
+    def test_search_page_read_until_links(self):
+        # the fixture has 4 results
+        temp_search_links = howdoi.STREAM_SEARCH_LINKS
+        howdoi.STREAM_SEARCH_LINKS = 4
+        try:
+            page = howdoi._get_search_result(self.stub.url + '/search', 'google')
+        finally:
+            howdoi.STREAM_SEARCH_LINKS = temp_search_links
+        self.assertLess(len(page), len(self.search_page) // 4)
+        os.environ.pop('HOWDOI_STREAM_PARSE')
+        self.assertEqual(howdoi._extract_links_from_page(page, 'google'),
+                         howdoi._extract_links_from_page(self.search_page, 'google'))
+
+    def test_unknown_encoding(self):
+        from howdoi.extract import read_until, stop_after_answers
+        page = _question_page(['<pre>date +%F</pre>']).encode('utf-8')
+        self.assertEqual(read_until(iter([page]), 'no-such-charset', stop_after_answers(1))[0], page.decode('utf-8'))
+
+    def test_short_page_read_completely(self):
+        self.stub.routes['/questions/1/short'] = (200, _question_page(['<pre><code>only answer</code></pre>']))
+        page = howdoi._get_question_page(self.stub.url + '/questions/1/short', 3)
+        self.assertIn('only answer', page)
+        # whole page is cached under its url
+        self.assertEqual(howdoi.page_cache.get(self.stub.url + '/questions/1/short?answertab=votes'), page)
+
+
+class HowdoiTestCaseTracing(StubSearchMixin, unittest.TestCase):
+    """ Timed spans of the query stages (--trace) """
+
+    def setUp(self):
+        from howdoi import tracing
+        self.tracing = tracing
+        self.temp_page_cache = howdoi.page_cache
+        self.temp_dir = tempfile.mkdtemp()
+        howdoi.page_cache = Cache(os.path.join(self.temp_dir, 'pages.sqlite'), 'pages')
+        self.start_stub([_question_page(['<pre>date +%F</pre>'], ['bash'])])
+
+    def tearDown(self):
+        self.tracing.disable()
+        howdoi.page_cache.close()
+        howdoi.page_cache = self.temp_page_cache
+        shutil.rmtree(self.temp_dir)
+
+    def test_stages_recorded(self):
+        self.tracing.enable()
+        self.call_howdoi('format date -c')
+        self.assertEqual(self.call_howdoi('format date'), 'date +%F\n')
+        spans = self.tracing.get_spans()
+        names = set(recorded['name'] for recorded in spans)
+        self.assertTrue(set(['get_links', 'get_result', 'extract_links', 'get_answer', 'get_text',
+                             'format_output']) <= names)
+        search = [recorded for recorded in spans if recorded['path'] == ('get_links', 'get_result')][0]
+        self.assertNotIn('cache', search['attrs'])
+        question_pages = [recorded['attrs'] for recorded in spans if recorded['path'] == ('get_result',)]
+        self.assertEqual([attrs['cache'] for attrs in question_pages], ['miss', 'hit'])
+        self.assertGreater(question_pages[0]['bytes'], 0)
+        breakdown = dict((stage['path'], stage) for stage in self.tracing.get_breakdown())
+        self.assertEqual(breakdown[('get_result',)]['hits'], 1)
+        self.assertEqual(breakdown[('get_links',)]['calls'], 2)
+
+    def test_disabled(self):
+        self.tracing.enable()
+        self.tracing.disable()
+        self.call_howdoi('format date')
+        self.assertEqual(self.tracing.get_spans(), [])
+
+    def test_export(self):
+        self.tracing.enable()
+        self.call_howdoi('format date')
+        chrome_file = os.path.join(self.temp_dir, 'trace.json')
+        self.tracing.export(chrome_file)
+        with open(chrome_file) as in_file:
+            events = [event for event in json.load(in_file)['traceEvents'] if event['ph'] == 'X']
+        self.assertEqual(len(events), len(self.tracing.get_spans()))
+        self.assertTrue(all(event['dur'] >= 0 and event['ts'] >= 0 for event in events))
+        json_file = os.path.join(self.temp_dir, 'spans.json')
+        self.tracing.export(json_file, 'json')
+        with open(json_file) as in_file:
+            self.assertEqual([recorded['name'] for recorded in json.load(in_file)],
+                             [recorded['name'] for recorded in self.tracing.get_spans()])
+
+
+class HowdoiTestCasePrefetch(StubSearchMixin, unittest.TestCase):
+    """ HOWDOI_PREFETCH: pages of the next questions downloaded into the page cache in background """
+
+    def setUp(self):
+        from howdoi import prefetch
+        self.prefetch = prefetch
+        self.temp_cache_dir = howdoi.CACHE_DIR
+        self.temp_cache_files = (howdoi.PAGE_CACHE_FILE, howdoi.ANSWER_CACHE_FILE, howdoi.LINK_CACHE_FILE)
+        self.temp_dir = tempfile.mkdtemp()
+        # the same cache files as in the detached prefetch process
+        os.environ['XDG_CACHE_HOME'] = self.temp_dir
+        howdoi.CACHE_DIR = os.path.join(self.temp_dir, 'howdoi')
+        howdoi.PAGE_CACHE_FILE, howdoi.ANSWER_CACHE_FILE, howdoi.LINK_CACHE_FILE = [
+            cache_file.replace(self.temp_cache_dir, howdoi.CACHE_DIR) for cache_file in self.temp_cache_files]
+        self.start_stub([_question_page(['<pre>answer {0}</pre>'.format(question_id)], ['bash'])
+                         for question_id in range(1, 5)])
+        howdoi._enable_cache()
+        os.environ['HOWDOI_PREFETCH'] = '2'
+
+    def tearDown(self):
+        self.prefetch.in_process = False
+        for cache in [howdoi.page_cache, howdoi.answer_cache] + list(howdoi.link_caches.values()):
+            cache.close()
+        howdoi.page_cache = howdoi.answer_cache = None
+        howdoi.link_caches = {}
+        howdoi.CACHE_DIR = self.temp_cache_dir
+        howdoi.PAGE_CACHE_FILE, howdoi.ANSWER_CACHE_FILE, howdoi.LINK_CACHE_FILE = self.temp_cache_files
+        shutil.rmtree(self.temp_dir)
+        os.environ.pop('XDG_CACHE_HOME', None)
+        os.environ.pop('HOWDOI_PREFETCH', None)
+
+    def wait_for_pages(self, question_ids, timeout=30):
+        links = ['{0}/questions/{1}/q'.format(self.stub.url, question_id) for question_id in question_ids]
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if all(howdoi._is_question_page_cached(link) for link in links):
+                return True
+            time.sleep(0.05)
+        return False
+
+    def requested_questions(self):
+        return [path for path in self.stub.requested if path.startswith('/questions/')]
+
+    def test_prefetch_in_thread(self):
+        self.prefetch.in_process = True
+        self.assertEqual(self.call_howdoi('format date'), 'answer 1\n')
+        self.assertTrue(self.wait_for_pages([2, 3]))
+        self.assertEqual(len(self.requested_questions()), 3)
+        # follow-up queries are answered from the link and page caches
+        requests = len(self.stub.requested)
+        self.assertEqual(self.call_howdoi('format date -p 2'), 'answer 2\n')
+        self.assertEqual(self.call_howdoi('format date -p 3'), 'answer 3\n')
+        self.assertTrue(self.wait_for_pages([4]))
+        self.assertEqual(len(self.stub.requested), requests + 1)
+        self.assertEqual(howdoi.page_cache.stats()['prefetched'], 3)
+
+    def test_prefetch_in_detached_process(self):
+        self.assertIn('answer 2', self.call_howdoi('format date -n 2'))
+        self.assertTrue(self.wait_for_pages([3, 4]))
+        self.assertEqual(sorted(self.requested_questions()),
+                         ['/questions/{0}/q?answertab=votes'.format(question_id) for question_id in range(1, 5)])
+
+    def test_only_stored_pages_counted(self):
+        self.stub.routes['/questions/2/q'] = (404, '')
+        links = ['{0}/questions/{1}/q'.format(self.stub.url, question_id) for question_id in (2, 3)]
+        self.assertEqual(self.prefetch.prefetch_pages(links), 1)
+        self.assertEqual(howdoi.page_cache.stats()['prefetched'], 1)
+
+    def test_child_path(self):
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(howdoi.__file__)))
+        temp_cwd = os.getcwd()
+        os.chdir(package_dir)
+        try:
+            self.assertTrue(self.prefetch._is_on_child_path(package_dir))
+        finally:
+            os.chdir(temp_cwd)
+        self.assertFalse(self.prefetch._is_on_child_path(self.temp_dir))
+
+    def test_prefetch_disabled(self):
+        os.environ['HOWDOI_PREFETCH'] = '0'
+        self.prefetch.in_process = True
+        self.call_howdoi('format date')
+        self.assertEqual(self.prefetch.prefetch(howdoi._get_links('format date'), 2), [])
+        time.sleep(0.2)
+        self.assertEqual(len(self.requested_questions()), 1)
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio API requires Python 3.5+')
+class HowdoiTestCaseAsync(StubSearchMixin, unittest.TestCase):
+    """ howdoi.aio: answers of the asyncio API are the same as of the sync one """
+
+    def setUp(self):
+        from howdoi import aio
+        self.aio = aio
+        self.temp_create_client = aio._create_client
+        self.start_stub([_question_page(['<pre>answer {0}</pre>'.format(question_id), '<p>other</p>'], ['bash'])
+                         for question_id in range(1, 4)])
+
+    def tearDown(self):
+        self.aio._create_client = self.temp_create_client
+        os.environ.pop('HOWDOI_RETRY_BACKOFF', None)
+
+    def make_args(self, query):
+        return vars(howdoi.get_parser().parse_args(query.split(' ')))
+
+    def run_loop(self, *queries):
+        import asyncio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            return loop.run_until_complete(asyncio.gather(*[self.aio.howdoi(self.make_args(query))
+                                                            for query in queries]))
+        finally:
+            loop.run_until_complete(self.aio.close())
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_same_answers(self):
+        queries = ['format date', 'format date -n 3', 'format date -p 2 -a', 'format date -l -n 2',
+                   'format date -j --answers-per-question 2']
+        expected = [howdoi.howdoi(self.make_args(query)) for query in queries]
+        self.assertEqual(self.run_loop(*queries), expected)
+        # without httpx the pages are downloaded in the executor
+        self.aio._create_client = lambda: None
+        self.assertEqual(self.run_loop(*queries), expected)
+
+    def test_client_per_loop(self):
+        import asyncio
+        clients = []
+        for _ in range(2):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            try:
+                clients.append(self.aio.get_client())
+                self.assertIs(self.aio.get_client(), clients[-1])
+                loop.run_until_complete(self.aio.close())
+                self.assertNotIn(loop, self.aio._clients)
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
+        self.assertIsNot(clients[0], clients[1])
+        self.assertTrue(all(client.is_closed for client in clients))
+
+    def test_concurrent_queries(self):
+        for question_id in range(1, 4):
+            route = '/questions/{0}/q'.format(question_id)
+            self.stub.routes[route] = self.stub.routes[route] + (0.3,)
+        start = time.time()
+        answers = self.run_loop(*['format date {0} -n 3'.format(index) for index in range(20)])
+        # 60 pages of 0.3s
+        self.assertLess(time.time() - start, 3)
+        self.assertEqual(set(answers), set([howdoi.howdoi(self.make_args('format date -n 3'))]))
+
+    def test_retry(self):
+        os.environ['HOWDOI_RETRY_BACKOFF'] = '0.01'
+        self.stub.routes['/questions/1/q'] = [(503, ''), self.stub.routes['/questions/1/q']]
+        self.assertEqual(self.run_loop('format date'), ['answer 1\n'])
+        self.assertEqual(self.stub.requested.count('/questions/1/q?answertab=votes'), 2)
+
+    def test_page_cache_keys_of_sync_api(self):
+        temp_page_cache = howdoi.page_cache
+        temp_dir = tempfile.mkdtemp()
+        howdoi.page_cache = Cache(os.path.join(temp_dir, 'pages.sqlite'), 'pages')
+        os.environ['HOWDOI_STREAM_PARSE'] = '1'
+        padding = '<div class="sidebar"><p>related question</p></div>\n' * 40000
+        self.stub.routes['/questions/1/q'] = (200, _question_page(['<pre>answer 1</pre>' + padding]))
+        try:
+            # read by the sync API until the answer, cached under the key of the condition
+            howdoi._get_question_page(self.stub.url + '/questions/1/q')
+            self.assertEqual(self.run_loop('format date'), ['answer 1\n'])
+            self.assertEqual(self.stub.requested.count('/questions/1/q?answertab=votes'), 1)
+            # read completely by aio, the sync API does not download it again
+            self.run_loop('format date -p 2')
+            howdoi._get_question_page(self.stub.url + '/questions/2/q')
+            self.assertEqual(self.stub.requested.count('/questions/2/q?answertab=votes'), 1)
+        finally:
+            os.environ.pop('HOWDOI_STREAM_PARSE')
+            howdoi.page_cache.close()
+            howdoi.page_cache = temp_page_cache
+            shutil.rmtree(temp_dir)
+
+    def test_network_error(self):
+        howdoi.SEARCH_URLS['google'] = 'http://127.0.0.1:1/search?q=site:{0}%20{1}'
+        os.environ['HOWDOI_RETRY_BACKOFF'] = '0.01'
+        self.assertEqual(self.run_loop('format date'), [howdoi.NETWORK_ERROR_MSG])
+
+
+class HowdoiTestCaseWorkers(StubSearchMixin, unittest.TestCase):
+    """ HOWDOI_PARSE_PROCESSES: parsing and highlighting in a process pool give the same answers """
+
+    def setUp(self):
+        from howdoi import workers
+        self.workers = workers
+        self.start_stub([_question_page(['<pre>echo {0}</pre>'.format(question_id), '<p>other</p>'], ['bash'])
+                         for question_id in range(1, 4)])
+
+    def tearDown(self):
+        self.workers.stop()
+        os.environ.pop('HOWDOI_PARSE_PROCESSES', None)
+
+    def test_same_answers(self):
+        queries = ['format date', 'format date -n 3 -c', 'format date -p 2 -a', 'format date -l -n 2',
+                   'format date -j --answers-per-question 2']
+        expected = [self.call_howdoi(query) for query in queries]
+        self.assertTrue(self.workers.start(2))
+        self.assertEqual([self.call_howdoi(query) for query in queries], expected)
+
+    def test_batch(self):
+        source = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+        source.write('format date\nformat date -n 2\nformat date -p 3\n')
+        source.close()
+        args = vars(howdoi.get_parser().parse_args(['--batch', source.name]))
+        try:
+            expected = io.StringIO() if sys.version >= '3' else io.BytesIO()
+            howdoi.howdoi_batch(args, source.name, expected)
+            self.workers.start(2)
+            output = io.StringIO() if sys.version >= '3' else io.BytesIO()
+            self.assertEqual(howdoi.howdoi_batch(args, source.name, output), 3)
+        finally:
+            os.remove(source.name)
+        self.assertEqual(output.getvalue(), expected.getvalue())
+
+    def test_offload(self):
+        self.assertEqual(self.workers.offload(os.getpid), os.getpid())
+        self.workers.start(1)
+        self.assertNotEqual(self.workers.offload(os.getpid), os.getpid())
+        self.workers.stop()
+        self.assertFalse(self.workers.is_running())
+        self.assertEqual(self.workers.offload(os.getpid), os.getpid())
+
+    def test_process_count(self):
+        self.assertEqual(self.workers.get_process_count(), 0)
+        self.assertFalse(self.workers.start())
+        os.environ['HOWDOI_PARSE_PROCESSES'] = '3'
+        self.assertEqual(self.workers.get_process_count(), 3)
+        os.environ['HOWDOI_PARSE_PROCESSES'] = 'many'
+        self.assertEqual(self.workers.get_process_count(), 0)
+        os.environ['HOWDOI_PARSE_PROCESSES'] = 'auto'
+        self.assertGreater(self.workers.get_process_count(), 0)
+
+
+class HowdoiTestCaseLocalIndex(unittest.TestCase):
+    """ HOWDOI_SEARCH_ENGINE=local with index built from a small data dump """
+
+    posts = """<?xml version="1.0" encoding="utf-8"?>
+<posts>
+  <row Id="1" PostTypeId="1" Score="50" Title="YYYY-MM-DD format date in shell script"
+       Tags="&lt;bash&gt;&lt;date&gt;" />
+  <row Id="2" PostTypeId="2" ParentId="1" Score="10"
+       Body="&lt;pre&gt;&lt;code&gt;date -I&lt;/code&gt;&lt;/pre&gt;" />
+  <row Id="3" PostTypeId="2" ParentId="1" Score="900"
+       Body="&lt;pre&gt;&lt;code&gt;date +%F&lt;/code&gt;&lt;/pre&gt;" />
+  <row Id="4" PostTypeId="2" ParentId="1" Score="1" Body="&lt;p&gt;use perl&lt;/p&gt;" />
+  <row Id="5" PostTypeId="1" Score="5" Title="Create tar archive" Tags="|tar|" />
+  <row Id="6" PostTypeId="2" ParentId="5" Score="3"
+       Body="&lt;pre&gt;&lt;code&gt;tar -cf backup.tar www&lt;/code&gt;&lt;/pre&gt;" />
+</posts>
+"""
+
+    def setUp(self):
+        from howdoi import local_index
+        self.temp_dir = tempfile.mkdtemp()
+        posts_file = os.path.join(self.temp_dir, 'Posts.xml')
+        with open(posts_file, 'w') as out_file:
+            out_file.write(self.posts)
+        os.environ['HOWDOI_INDEX'] = os.path.join(self.temp_dir, 'index.sqlite')
+        os.environ['HOWDOI_SEARCH_ENGINE'] = 'local'
+        self.counts = local_index.build_index(posts_file, answers_per_question=2)
+
+    def tearDown(self):
+        os.environ.pop('HOWDOI_INDEX', None)
+        os.environ['HOWDOI_SEARCH_ENGINE'] = ''
+        shutil.rmtree(self.temp_dir)
+
+    def call_howdoi(self, query):
+        args = vars(howdoi.get_parser().parse_args(query.split(' ')))
+        return howdoi.howdoi(args)
+
+    def test_local_search(self):
+        self.assertEqual(self.counts, (2, 3))
+        self.assertEqual(self.call_howdoi('format date bash'), 'date +%F\n')
+        self.assertEqual(self.call_howdoi('tar archive -l'),
+                         'https://stackoverflow.com/questions/5/create-tar-archive\n')
+        response = self.call_howdoi('shell date --answers-per-question 3')
+        self.assertLess(response.find('date +%F'), response.find('date -I'))
+        self.assertNotIn('perl', response)
+        self.assertEqual(self.call_howdoi('compile kernel'), "Sorry, couldn't find any help with that topic\n")
+
+
+class HowdoiTestCaseRace(unittest.TestCase):
+    """ HOWDOI_SEARCH_ENGINE=race and merge with search pages served from memory """
+
+    def setUp(self):
+        self.temp_get_result = howdoi._get_result
+        self.google_links = ['https://stackoverflow.com/questions/1/a', 'https://stackoverflow.com/questions/2/b']
+        self.bing_links = ['https://stackoverflow.com/questions/2/b', 'https://stackoverflow.com/questions/3/c']
+        self.delays = {'google': 0, 'bing': 0}
+        self.captcha = set()
+        self.requested = []
+        howdoi._get_result = self.fake_get_result
+
+    def tearDown(self):
+        howdoi._get_result = self.temp_get_result
+        for link_cache in howdoi.link_caches.values():
+            link_cache.close()
+        howdoi.link_caches = {}
+        os.environ['HOWDOI_SEARCH_ENGINE'] = ''
+        os.environ.pop('HOWDOI_LINK_CACHE_TTL', None)
+
+    def fake_get_result(self, url, use_cache=True, stop=None):
+        self.requested.append(url)
+        search_engine = 'google' if 'google' in url else 'bing'
+        time.sleep(self.delays[search_engine])
+        if search_engine in self.captcha:
+            return '<html><body>Our systems have detected unusual traffic</body></html>'
+        if search_engine == 'google':
+            return ''.join('<a class="l" href="{0}">q</a>'.format(link) for link in self.google_links)
+        return ''.join('<li class="b_algo"><h2><a href="{0}">q</a></h2></li>'.format(link)
+                       for link in self.bing_links)
+
+    def test_fastest_engine_wins(self):
+        os.environ['HOWDOI_SEARCH_ENGINE'] = 'race'
+        self.delays['google'] = 0.3
+        self.assertEqual(howdoi._get_links('format date'), self.bing_links)
+
+    def test_engine_without_links_loses(self):
+        os.environ['HOWDOI_SEARCH_ENGINE'] = 'race'
+        self.delays['google'] = 0.2
+        self.captcha.add('bing')
+        self.assertEqual(howdoi._get_links('format date'), self.google_links)
+
+    def test_link_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            howdoi.link_caches = {'google': Cache(os.path.join(temp_dir, 'links.sqlite'), table='links_google')}
+            self.assertEqual(howdoi._get_links('format date'), self.google_links)
+            self.assertEqual(howdoi._get_links('Format  date'), self.google_links)
+            self.assertEqual(len(self.requested), 1)
+            os.environ['HOWDOI_SEARCH_ENGINE'] = 'bing'
+            self.assertEqual(howdoi._get_links('format date'), self.bing_links)
+            self.assertEqual(len(self.requested), 2)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_link_cache_ttl(self):
+        self.assertEqual(howdoi._get_link_cache_ttl('race'), howdoi.DEFAULT_LINK_CACHE_TTL)
+        os.environ['HOWDOI_LINK_CACHE_TTL'] = 'google=60,300'
+        self.assertEqual(howdoi._get_link_cache_ttl('google'), 60)
+        self.assertEqual(howdoi._get_link_cache_ttl('bing'), 300)
+
+    def test_merge(self):
+        os.environ['HOWDOI_SEARCH_ENGINE'] = 'merge'
+        self.assertEqual(howdoi._get_links('format date'),
+                         ['https://stackoverflow.com/questions/2/b', 'https://stackoverflow.com/questions/1/a',
+                          'https://stackoverflow.com/questions/3/c'])
+
+
+class HowdoiTestCaseStartup(unittest.TestCase):
+    """ -v, -C and --help must not load the heavy dependencies """
+
+    script = """
+import sys
+sys.argv = ['howdoi'] + sys.argv[1:]
+from howdoi import howdoi
+try:
+    howdoi.command_line_runner()
+except SystemExit:
+    pass
+heavy_modules = ('requests', 'requests_cache', 'pyquery', 'lxml', 'pygments', 'urllib.request', 'http.client')
+print(' '.join(m for m in heavy_modules if m in sys.modules))
+"""
+
+    def loaded_modules(self, *arguments):
+        temp_dir = tempfile.mkdtemp()
+        env = dict(os.environ, XDG_CACHE_HOME=temp_dir)
+        try:
+            output = subprocess.check_output([sys.executable, '-c', self.script] + list(arguments), env=env,
+                                             universal_newlines=True)
+        finally:
+            shutil.rmtree(temp_dir)
+        return output.splitlines()[-1].split()
+
+    def test_lazy_imports(self):
+        self.assertEqual(self.loaded_modules('-v'), [])
+        self.assertEqual(self.loaded_modules('-C'), [])
+        self.assertEqual(self.loaded_modules('--help'), [])
+
+
 if __name__ == '__main__':
     unittest.main()